@@ -2,10 +2,14 @@
 #  SPDX-License-Identifier: MIT-0
 
 import json
-import pandas as pd
 import boto3
 import io
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from s3_multipart import MIN_PART_SIZE, MultipartUpload
+import shard_format
 
 ###  This function is triggered when a file with suffix _LAST.csv
 ###  is input into the "processed" bucket. This function then takes
@@ -13,48 +17,224 @@ import os
 ###  together to create a complete processed data set. Then this function 
 ###  writes that dataset to a "destination" bucket
 
-s3_client = boto3.client('s3')
+max_in_flight = int(os.environ.get('MAX_IN_FLIGHT', 10))
+s3_client = boto3.client('s3', config=Config(max_pool_connections=max_in_flight))
 destination_bucket = os.environ.get('DESTINATION_BUCKET')
 process_shards_bucket = os.environ.get("PROCESSED_SHARDS_BUCKET")
+# "stream" concatenates the shards into a multipart upload, copying large
+# shards server-side; "pandas" loads every shard into one DataFrame
+gather_mode = os.environ.get('GATHER_MODE', 'pandas')
+# format of the final dataset, "csv" or "parquet"; shards are read in the format of their key
+output_format = shard_format.check_format(os.environ.get('OUTPUT_FORMAT', 'csv'))
+parquet_compression = os.environ.get('PARQUET_COMPRESSION', shard_format.DEFAULT_COMPRESSION)
+# format of the processed shards, to name them from the raw shards listed in a manifest
+intermediate_format = shard_format.check_format(os.environ.get('INTERMEDIATE_FORMAT', 'csv'))
+
+# written by the scatter function when shards are partitioned by lookup key
+ROW_ORDER_COLUMN = "_Row_Order"
+# leading bytes read from each shard to find the end of its header line
+PROBE_BYTES = 64 * 1024
+
+
+def read_shard(bucket_name, key):
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return shard_format.read_frame(response.get("Body"), shard_format.format_of(key))
+
+
+def gather_with_pandas(bucket_name, list_of_shards):
+    """
+    Read every shard concurrently and concatenate them once
+
+    Returns
+    ------
+        bytes: the complete dataset in OUTPUT_FORMAT
+    """
+    # only this mode needs pandas; the streaming gather of CSV shards never loads it
+    import pandas as pd
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        frames = list(executor.map(lambda key: read_shard(bucket_name, key), list_of_shards))
+    frames = frames[:1] + [data.dropna(thresh=2) for data in frames[1:]]
+    final_doc = pd.concat(frames, ignore_index=True)
+
+    # restore the input row order when the scatter step partitioned shards by key
+    if ROW_ORDER_COLUMN in final_doc.columns:
+        final_doc = final_doc.sort_values(ROW_ORDER_COLUMN, kind="stable").drop(columns=[ROW_ORDER_COLUMN])
+
+    return shard_format.write_frame(final_doc, output_format, parquet_compression)
+
+
+def shard_layout(bucket_name, key):
+    """
+    Find the header line and the size of a shard with one ranged GET
+
+    Returns
+    ------
+        dict: key, header (bytes), header_end and size
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=key, Range="bytes=0-{}".format(PROBE_BYTES - 1))
+    probe = response["Body"].read()
+    content_range = response.get("ContentRange")
+    size = int(content_range.rsplit("/", 1)[1]) if content_range else len(probe)
+    newline = probe.find(b"\n")
+    if newline < 0:
+        if size > len(probe):
+            raise ValueError("No header line in the first {} bytes of {}".format(PROBE_BYTES, key))
+        newline = len(probe) - 1
+    return {"key": key, "header": probe[:newline + 1], "header_end": newline + 1, "size": size}
+
+
+def read_rows(bucket_name, layout):
+    response = s3_client.get_object(
+        Bucket=bucket_name, Key=layout["key"],
+        Range="bytes={}-{}".format(layout["header_end"], layout["size"] - 1))
+    return response["Body"].read()
+
+
+def prefetch(executor, fn, items):
+    """
+    Yield fn(item) for each item in order, running up to max_in_flight
+    calls ahead of the consumer
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def concatenate_csv_shards(executor, bucket_name, list_of_shards, output_key):
+    """
+    Concatenate CSV shards byte for byte. The header is written once;
+    shards of 5 MiB and more are copied with UploadPartCopy and smaller
+    ones are downloaded concurrently and buffered.
+
+    Returns
+    ------
+        dict: S3 response, or None when the shards cannot be concatenated
+        byte for byte (a row order column, or headers that differ)
+    """
+    layouts = list(executor.map(lambda key: shard_layout(bucket_name, key), list_of_shards))
+    header = layouts[0]["header"].decode("utf-8")
+    # key partitioned shards have to be re-sorted, which needs the whole dataset
+    if ROW_ORDER_COLUMN in header.rstrip("\r\n").split(","):
+        print("Shards carry {}, gathering with pandas to restore the row order".format(ROW_ORDER_COLUMN))
+        return None
+    if any(layout["header"] != layouts[0]["header"] for layout in layouts):
+        print("Shard headers differ, gathering with pandas to align the columns")
+        return None
+
+    def small_shard_rows(layout):
+        rows = layout["size"] - layout["header_end"]
+        return read_rows(bucket_name, layout) if 0 < rows < MIN_PART_SIZE else None
+
+    with MultipartUpload(s3_client, destination_bucket, output_key) as upload:
+        upload.write(layouts[0]["header"])
+        for layout, rows in zip(layouts, prefetch(executor, small_shard_rows, layouts)):
+            if rows is not None:
+                upload.write(rows)
+            elif layout["size"] > layout["header_end"]:
+                upload.copy(bucket_name, layout["key"], layout["header_end"], layout["size"])
+        response = upload.close()
+    print("Gathered {} shards, {} bytes ({} copied server-side)".format(
+        len(layouts), upload.bytes_written, upload.bytes_copied))
+    return response
+
+
+def convert_shards(executor, bucket_name, list_of_shards, output_key):
+    """
+    Re-encode the shards one at a time into OUTPUT_FORMAT (Parquet shards,
+    or a Parquet output), so only max_in_flight shards are in memory
+
+    Returns
+    ------
+        dict: S3 response, or None when the shards need the pandas path
+        (a row order column, or columns that differ)
+    """
+    try:
+        with MultipartUpload(s3_client, destination_bucket, output_key) as upload:
+            writer = shard_format.FrameWriter(upload, output_format, parquet_compression)
+            for frame in prefetch(executor, lambda key: read_shard(bucket_name, key), list_of_shards):
+                if ROW_ORDER_COLUMN in frame.columns:
+                    raise ValueError("Shards carry {}".format(ROW_ORDER_COLUMN))
+                writer.write(frame)
+            writer.close()
+            response = upload.close()
+    except ValueError as e:
+        # raised before the upload completes, so the partial upload was aborted
+        print("{}, gathering with pandas".format(e))
+        return None
+    print("Gathered {} shards, {} rows, {} bytes".format(len(list_of_shards), writer.rows, upload.bytes_written))
+    return response
+
+
+def gather_by_streaming(bucket_name, list_of_shards, output_key):
+    """
+    Write the shards to the destination object in order without loading
+    them all: CSV shards into a CSV output are concatenated byte for byte,
+    anything else is re-encoded shard by shard
+
+    Returns
+    ------
+        dict: S3 response, or None when the pandas path is needed
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        if output_format == "csv" and all(shard_format.format_of(key) == "csv" for key in list_of_shards):
+            return concatenate_csv_shards(executor, bucket_name, list_of_shards, output_key)
+        return convert_shards(executor, bucket_name, list_of_shards, output_key)
+
+
+def shards_from_manifest(manifest):
+    """
+    Keys of the processed shards, in order, from the manifest the scatter
+    function wrote (one raw shard descriptor per line). Each raw shard is
+    processed into the key the process function derives from it.
+
+    Returns
+    ------
+        list: processed shard keys
+    """
+    body = s3_client.get_object(Bucket=manifest["bucket"], Key=manifest["key"])["Body"].read()
+    list_of_shards = [
+        shard_format.shard_key(json.loads(line)["shard"], intermediate_format)
+        for line in body.splitlines() if line.strip()
+    ]
+    print("Read {} shards from the manifest s3://{}/{}".format(len(list_of_shards), manifest["bucket"], manifest["key"]))
+    return list_of_shards
+
 
 def lambda_handler(event, context):
     bucket_name = process_shards_bucket
     payload = event["Payload"]
     
     list_of_shards = []
-    for item in payload:
-        print (item["shard"])
-        list_of_shards.append(item["shard"])
-    
-    #Create the data frame (final_doc) using the first shard
-    final_doc = pd.DataFrame()
-    first_object_response = response_2 = s3_client.get_object(Bucket=bucket_name, Key=list_of_shards[0])
-    final_doc = pd.read_csv((first_object_response.get("Body")))
-    count_2 = 1
-    length=len(list_of_shards)
-
-    #Write a new file (final_doc) by iterating through the list of files in the bucekt
-    for i in list_of_shards[1:length]:
-        response_2 = s3_client.get_object(Bucket=bucket_name, Key=i)
-        data_1 = pd.read_csv((response_2.get("Body")))
-        data_1 = data_1.dropna(thresh=2)
-        final_doc = final_doc.append(data_1)
-        count_2 +=1
+    if isinstance(payload, dict) and "Manifest" in payload:
+        # the distributed Map state discards the process outputs; the manifest lists the shards
+        list_of_shards = shards_from_manifest(payload["Manifest"])
+    else:
+        for item in payload:
+            print (item["shard"])
+            list_of_shards.append(item["shard"])
     
     # output_file_name = 'output.csv'
-    output_file_name = list_of_shards[0][:-12]+"/"+"PROCESSED_DATA_"+list_of_shards[0][:-12]+".csv"
+    source_name = list_of_shards[0].rsplit("_SHARD_", 1)[0]
+    output_file_name = source_name+"/"+"PROCESSED_DATA_"+source_name+shard_format.EXTENSIONS[output_format]
+    output_key = "processed_data"+"/"+output_file_name
     response_lambda = {}
+    response_3 = None
+    if gather_mode == "stream":
+        response_3 = gather_by_streaming(bucket_name, list_of_shards, output_key)
     #Put new File back to S3
-    with io.StringIO() as csv_buffer:
-        final_doc.to_csv(csv_buffer, index=False)
+    if response_3 is None:
         response_3 = s3_client.put_object(
-            Bucket=destination_bucket, Key="processed_data"+"/"+output_file_name, Body=csv_buffer.getvalue()
+            Bucket=destination_bucket, Key=output_key, Body=gather_with_pandas(bucket_name, list_of_shards)
         )
-        status = response_3.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            print(f"Successful S3 put_object response. Status - {status}")
-            response_lambda['Payload']={"status": "Processed file uploaded to: "+ destination_bucket + " as "+ output_file_name}
-        else:
-            print(f"Unsuccessful S3 put_object response. Status - {status}")
-            response_lambda['Payload']={"status": status}
+    status = response_3.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if status == 200:
+        print(f"Successful S3 put_object response. Status - {status}")
+        response_lambda['Payload']={"status": "Processed file uploaded to: "+ destination_bucket + " as "+ output_file_name}
+    else:
+        print(f"Unsuccessful S3 put_object response. Status - {status}")
+        response_lambda['Payload']={"status": status}
     return(response_lambda)
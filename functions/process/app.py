@@ -2,490 +2,1347 @@
 #  SPDX-License-Identifier: MIT-0
 import botocore
 import boto3
-import pandas as pd
 import io
 import os
 import urllib.parse
 import random, time
 import json
 import datetime 
+import threading
+from collections import Counter
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+import geokeys
+import shard_format
+import cache_record
+import csv_engine
+from cache_policy import CachePolicy
+from checkpoint import ShardCheckpoint, ShardCheckpointed
+from s3_multipart import MultipartUpload
+from engine import AdaptiveConcurrencyLimit, LatencyTracker, LookupEngine, hedged_call
+from memory_cache import LocationMemoryCache
+from metrics import Log, ShardMetrics
+from place_result import ENRICHMENT_COLUMNS, PlaceResult, enrichment_columns
+from rate_limiter import DynamoDBTokenBucket, LocalTokenBucket
 
 ###  This function takes a raw data shard from the "raw" bucket, 
 ###  uses AWS Locations to GeoCode/ReverseGeoCode based on the columns in the datasets, 
 ###  and puts the processed shard into a "processed" bucket.
 region = os.environ['AWS_REGION']
+# maximum number of cache reads / Location calls / cache writes in flight per shard
+max_in_flight = int(os.environ.get('MAX_IN_FLIGHT', '10'))
+# size the HTTP connection pools so concurrent workers do not queue on a connection
+client_config = Config(max_pool_connections=max(10, max_in_flight))
+# deadline of a single Location request; a request that times out is retried like a throttled one.
+# botocore's own retries are off so call_location alone decides when to retry
+location_config = Config(
+    connect_timeout=int(os.environ.get('LOCATION_CONNECT_TIMEOUT_MS', '1000')) / 1000,
+    read_timeout=int(os.environ.get('LOCATION_READ_TIMEOUT_MS', '3000')) / 1000,
+    retries={'total_max_attempts': 1},
+    # room for the hedged duplicates
+    max_pool_connections=max(10, 2 * max_in_flight))
 
 s3_client = boto3.client('s3',region_name=region)
-location = boto3.client('location',region_name=region)
+location = boto3.client('location',region_name=region, config=location_config)
 destination_bucket = os.environ.get('PROCESSED_SHARDS_BUCKET')
 location_index = os.environ.get('LOCATION_INDEX')
 stepfunctions_client = boto3.client('stepfunctions',region_name=region)
 ddb_table = os.environ.get("DDB_TABLE_NAME")
-ddb_client = boto3.client("dynamodb")
+ddb_client = boto3.client("dynamodb", config=client_config)
 dynamodb = boto3.resource('dynamodb')
+lookup_engine = LookupEngine(max_in_flight)
+# Location calls per second allowed across all concurrent process invocations
+location_rate_limit = int(os.environ.get('LOCATION_RATE_LIMIT', '45'))
+rate_limit_table = os.environ.get('RATE_LIMIT_TABLE_NAME')
+if rate_limit_table:
+    location_rate_limiter = DynamoDBTokenBucket(
+        ddb_client, rate_limit_table, "location", location_rate_limit,
+        lease_size=int(os.environ.get('RATE_LIMIT_LEASE_SIZE', '5')))
+else:
+    # without a shared table the budget only applies to this container
+    location_rate_limiter = LocalTokenBucket(location_rate_limit)
+# number of workers allowed to call Location at once adapts (AIMD) to throttling, up to max_in_flight
+location_concurrency = AdaptiveConcurrencyLimit(
+    initial=int(os.environ.get('LOCATION_INITIAL_CONCURRENCY', '4')), maximum=max_in_flight)
+backoff_base_ms = int(os.environ.get('LOCATION_BACKOFF_BASE_MS', '100'))
+backoff_cap_ms = int(os.environ.get('LOCATION_BACKOFF_CAP_MS', '5000'))
+# a Location call slower than this percentile of recent calls gets a duplicate request; 0 disables hedging
+hedge_percentile = float(os.environ.get('LOCATION_HEDGE_PERCENTILE', '0'))
+hedge_min_delay_ms = int(os.environ.get('LOCATION_HEDGE_MIN_DELAY_MS', '50'))
+location_latency = LatencyTracker()
+# hedged calls run here, not on the lookup engine whose workers wait for them
+hedge_executor = ThreadPoolExecutor(max_workers=2 * max(1, max_in_flight), thread_name_prefix="hedge")
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {'InternalServerException'}
+NON_RETRYABLE_ERRORS = {'ValidationException', 'AccessDeniedException', 'ResourceNotFoundException'}
+TIMEOUT_ERRORS = (botocore.exceptions.ConnectTimeoutError, botocore.exceptions.ReadTimeoutError)
+# classes of a failed lookup, stored as {"Error": <class>} in place of the Location "Place"
+NO_RESULT = 'NoResult'          # Location answered without a result
+INVALID_INPUT = 'InvalidInput'  # Location rejected the query (ValidationException)
+GAVE_UP = 'GaveUp'              # still throttled or failing after every retry
+FAILED = 'Failed'               # access, index or unidentified errors: not the input's fault, never cached
+# permanent failures are cached like results, but for a shorter time
+PERMANENT_FAILURES = {NO_RESULT, INVALID_INPUT}
+# TTLs of the DynamoDB cache per lookup type and confidence, and when entries are refreshed ahead of expiry
+cache_policy = CachePolicy(
+    forward_ttl_seconds=int(os.environ.get('CACHE_TTL_FORWARD_SECONDS', '604800')),
+    reverse_ttl_seconds=int(os.environ.get('CACHE_TTL_REVERSE_SECONDS', '604800')),
+    low_confidence_ttl_seconds=int(os.environ.get('CACHE_TTL_LOW_CONFIDENCE_SECONDS', '86400')),
+    low_confidence_relevance=float(os.environ.get('LOW_CONFIDENCE_RELEVANCE', '0.8')),
+    negative_ttl_seconds=int(os.environ.get('NEGATIVE_CACHE_TTL_SECONDS', '21600')),
+    refresh_ahead_fraction=float(os.environ.get('REFRESH_AHEAD_FRACTION', '0.2')),
+    refresh_hot_hits=int(os.environ.get('REFRESH_HOT_HITS', '10')),
+    refresh_window=os.environ.get('REFRESH_WINDOW_UTC', ''))
+# Location calls a shard may spend re-geocoding cached entries that are due for refresh
+refresh_max_per_shard = int(os.environ.get('REFRESH_MAX_PER_SHARD', '50'))
+# add DynamoDB cache hits to the entries' Hits counter and LastAccess time; hits are summed per container
+# and at most CACHE_ACCESS_MAX_WRITES of the most hit entries are written every CACHE_ACCESS_FLUSH_SECONDS
+track_cache_access = os.environ.get('CACHE_TRACK_ACCESS', 'false').lower() == 'true'
+cache_access_flush_seconds = float(os.environ.get('CACHE_ACCESS_FLUSH_SECONDS', '300'))
+cache_access_max_writes = int(os.environ.get('CACHE_ACCESS_MAX_WRITES', '25'))
+# "compact" writes cache items as one binary record (see cache_record), "legacy" as string attributes; both are read
+cache_record_format = os.environ.get('CACHE_RECORD_FORMAT', 'compact')
+# keys that gave up are only remembered in memory, so this container does not retry them right away
+negative_cache_retry_seconds = int(os.environ.get('NEGATIVE_CACHE_RETRY_SECONDS', '300'))
+# "exact" caches reverse lookups per exact position, "geohash" per geohash cell
+reverse_cache_mode = os.environ.get('REVERSE_CACHE_MODE', 'exact')
+geohash_precision = int(os.environ.get('GEOHASH_PRECISION', '8'))
+# a cell's cached result is only reused for points this close to the point it was looked up for
+reverse_cache_tolerance_m = float(os.environ.get('REVERSE_CACHE_TOLERANCE_M', '50'))
+# offline nearest-neighbour index exported from the cache; empty key disables it
+spatial_index_bucket = os.environ.get('SPATIAL_INDEX_BUCKET')
+spatial_index_key = os.environ.get('SPATIAL_INDEX_KEY', '')
+spatial_index_radius_m = float(os.environ.get('SPATIAL_INDEX_RADIUS_M', '25'))
+# in-memory LRU in front of DynamoDB; lives as long as the container, so warm invocations reuse it
+memory_cache = LocationMemoryCache(
+    max_entries=int(os.environ.get('MEMORY_CACHE_MAX_ENTRIES', '10000')),
+    max_bytes=int(os.environ.get('MEMORY_CACHE_MAX_MB', '24')) * 1024 * 1024,
+    ttl_seconds=int(os.environ.get('MEMORY_CACHE_TTL_SECONDS', '3600')))
+# read the shard in chunks of this many rows and stream the output with a multipart upload; 0 reads it whole
+streaming_chunk_rows = int(os.environ.get('STREAMING_CHUNK_ROWS', '0'))
+# save the shard's progress every CHECKPOINT_ROWS raw rows so a retried invocation resumes; 0 disables checkpoints
+checkpoint_rows = int(os.environ.get('CHECKPOINT_ROWS', '0'))
+# stop and hand the shard to the Map state's retry when less time than this is left (or twice the slowest chunk)
+checkpoint_safety_seconds = float(os.environ.get('CHECKPOINT_SAFETY_SECONDS', '60'))
+# "csv" enriches CSV shards with the csv module, without loading pandas; "pandas" reads them into DataFrames
+process_engine = os.environ.get('PROCESS_ENGINE', 'pandas')
+# encoding of the processed shards ("csv" or "parquet"); raw shards are read in the format of their key
+intermediate_format = shard_format.check_format(os.environ.get('INTERMEDIATE_FORMAT', 'csv'))
+parquet_compression = os.environ.get('PARQUET_COMPRESSION', shard_format.DEFAULT_COMPRESSION)
+# DEBUG adds a line per Location call and response; INFO keeps one summary per step
+log = Log(os.environ.get('LOG_LEVEL', 'INFO'))
+# one EMF record per shard; METRICS_SAMPLE_RATE also writes that fraction of single call timings
+shard_metrics = ShardMetrics(
+    os.environ.get('METRICS_NAMESPACE', 'LocationScatterGather'),
+    dimensions={"FunctionName": os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'process')},
+    sample_rate=float(os.environ.get('METRICS_SAMPLE_RATE', '0')))
+# DynamoDB limits for a single BatchGetItem / BatchWriteItem request
+DDB_BATCH_GET_SIZE = 100
+DDB_BATCH_WRITE_SIZE = 25
 
 
 
 
-def get_location_for_position(IndexName, Position, MAX_RETRIES = 5):
-    retry = True
+def backoff_delay (retries):
+    """
+    Full-jitter backoff: a random wait between zero and the capped exponential delay
+    """
+    return(random.uniform(0, min(backoff_cap_ms, backoff_base_ms * 2**retries)) / 1000)
+
+
+def hedge_delay ():
+    """
+    Seconds to wait for a Location response before sending a duplicate:
+    the LOCATION_HEDGE_PERCENTILE of recent latencies, at least
+    LOCATION_HEDGE_MIN_DELAY_MS
+
+    Returns
+    ------
+        float, or None when hedging is off or too few calls were seen yet
+    """
+    if hedge_percentile <= 0:
+        return(None)
+    observed = location_latency.percentile(hedge_percentile)
+    if observed is None:
+        return(None)
+    return(max(hedge_min_delay_ms / 1000, observed))
+
+
+def send_location_request (operation, IndexName, params):
+    """
+    One Location request, bounded by the client's connect and read
+    deadlines. With hedging on, a request still unanswered after
+    hedge_delay() is duplicated and the first response wins. The duplicate
+    needs a free slot of the concurrency limit, which it holds until it
+    answers, and takes its own token from the rate budget; without a free
+    slot no duplicate is sent. Only successful responses are timed, so
+    fast throttling or errors do not shorten the hedge delay.
+
+    Returns
+    ------
+        dict: the API response; raises the request's error
+    """
+    def request():
+        started = time.perf_counter()
+        response = getattr(location, operation)(IndexName=IndexName, **params)
+        elapsed = time.perf_counter() - started
+        shard_metrics.record("LocationLatency", elapsed * 1000)
+        location_latency.add(elapsed)
+        return(response)
+
+    def start_hedge():
+        slot = location_concurrency.try_acquire()
+        if slot is None:
+            return(None)
+
+        def hedge():
+            outcome = "error"
+            try:
+                location_rate_limiter.acquire()
+                shard_metrics.increment("LocationCalls")
+                shard_metrics.increment("LocationHedges")
+                response = request()
+                outcome = "success"
+                return(response)
+            except botocore.exceptions.ClientError as error:
+                if error.response['Error']['Code'] in THROTTLING_ERRORS:
+                    outcome = "throttled"
+                raise
+            finally:
+                location_concurrency.release(slot, outcome)
+        return(hedge)
+
+    delay = hedge_delay()
+    if delay is None:
+        return(request())
+    response, hedge_won = hedged_call(hedge_executor, request, start_hedge, delay)
+    if hedge_won:
+        shard_metrics.increment("LocationHedgeWins")
+    return(response)
+
+
+def call_location (operation, IndexName, description, MAX_RETRIES, **params):
+    """
+    Call a Location operation under the adaptive concurrency limit and the
+    shared rate budget. Throttling, internal errors and requests that miss
+    their deadline are retried with full-jitter backoff; any other error
+    fails immediately.
+
+    Returns
+    ------
+        dict: the API response, or {"Error": <failure class>} when the call failed
+    """
     retries = 1
-    while (retry and (retries < MAX_RETRIES)):
+    while retries < MAX_RETRIES:
+        slot = location_concurrency.acquire()
+        outcome = "error"
         try:
-            response = location.search_place_index_for_position(
-                IndexName=location_index,
-                Position=Position)
-            retry = False
+            waited = time.perf_counter()
+            location_rate_limiter.acquire()
+            shard_metrics.record("RateLimitWait", (time.perf_counter() - waited) * 1000)
+            shard_metrics.increment("LocationCalls")
+            response = send_location_request(operation, IndexName, params)
+            outcome = "success"
             return(response)
+        except TIMEOUT_ERRORS as error:
+            shard_metrics.increment("LocationTimeouts")
+            log.debug('{}: No response before the deadline; retrying...{}: retries: {}'.format(description, error, retries))
         except botocore.exceptions.ClientError as error:
-            # wait for (2^retries * 100) milliseconds
-            time.sleep(2**retries * 100/1000)
-            if error.response['Error']['Code'] == 'ThrottlingException':
-                print('{}: API call limit exceeded; backing off and retrying...{}: retries: {}'.format(Position,error.response['Error']['Code'],retries))
-                retry = True
-            elif error.response['Error']['Code'] == 'InternalServerException':
-                print('{}: Internal Server Exception; backing off and retrying...{}: retries: {}'.format(Position,error.response['Error']['Code'],retries))
-                retry = True
-            elif error.response['Error']['Code'] == 'ValidationException':
-                print('{}: Exiting...{}'.format(Position,error.response['Error']['Code']))
-                retry = False
-            elif error.response['Error']['Code'] == 'AccessDeniedException':
-                print('{}: Exiting...{}'.format(Position, error.response['Error']['Code']))    
-                retry = False
-            elif error.response['Error']['Code'] == 'ResourceNotFoundException':
-                print('{}: Exiting...{}'.format(Position,error.response['Error']['Code']))   
-                retry = False
-            elif error.response['Error']['Code'] == 'TooManyRequestsException':
-                print('{}: API call limit exceeded; backing off and retrying...{}: retries: {}'.format(Position,error.response['Error']['Code'],retries))  
-                retry = True
-            else:    
-                print ("{}: Un-Identified Exception: {} || {}".format(Position, error, error.response['Error']['Code']))
-                retry = False
-            retries = retries + 1
-    print("{}: Giving up... Too many retries..".format(Position))
-    return("Error")
+            code = error.response['Error']['Code']
+            if code in THROTTLING_ERRORS:
+                outcome = "throttled"
+                shard_metrics.increment("LocationThrottles")
+                log.debug('{}: API call limit exceeded; backing off and retrying...{}: retries: {}'.format(description, code, retries))
+            elif code in RETRYABLE_ERRORS:
+                log.debug('{}: Internal Server Exception; backing off and retrying...{}: retries: {}'.format(description, code, retries))
+            elif code in NON_RETRYABLE_ERRORS:
+                shard_metrics.increment("LocationErrors")
+                log.warning('{}: Exiting...{}'.format(description, code))
+                return({"Error": INVALID_INPUT if code == 'ValidationException' else FAILED})
+            else:
+                shard_metrics.increment("LocationErrors")
+                log.error("{}: Un-Identified Exception: {} || {}".format(description, error, code))
+                return({"Error": FAILED})
+        finally:
+            location_concurrency.release(slot, outcome)
+        shard_metrics.increment("LocationRetries")
+        time.sleep(backoff_delay(retries))
+        retries = retries + 1
+    shard_metrics.increment("LocationErrors")
+    log.warning("{}: Giving up... Too many retries..".format(description))
+    return({"Error": GAVE_UP})
+
+
+def get_location_for_position(IndexName, Position, MAX_RETRIES = 5):
+    return(call_location("search_place_index_for_position", IndexName, Position, MAX_RETRIES, Position=Position))
+
+def location_to_item (location_to_cache, expiryDateTime):
+    """
+    Convert a cache record into a DynamoDB item, in cache_record_format
+    """
+    if cache_record_format == "compact":
+        # ttl and Hits stay top-level attributes for DynamoDB's TTL and the counter updates
+        item = {
+            "id": {"S": location_to_cache["PrimaryKey"]},
+            "Rec": {"B": cache_record.encode(location_to_cache)},
+            "ttl": {"N": str(expiryDateTime)},
+        }
+        for key in ("Hits", "LastAccess"):
+            if key in location_to_cache:
+                item[key] = {"N": str(location_to_cache[key])}
+        return(item)
+    if "Error" in location_to_cache:
+        # negative entry: only the failure class (and the queried position) is kept
+        item = {
+            "id": {"S": location_to_cache["PrimaryKey"]},
+            "Error": {"S": location_to_cache["Error"]},
+            "ttl": {"N": str(expiryDateTime)},
+        }
+        if "QueryPoint" in location_to_cache:
+            item["QueryPoint"] = {"S": json.dumps(location_to_cache["QueryPoint"])}
+        return(item)
+    item = {
+        "id": {
+            "S": location_to_cache["PrimaryKey"]
+          },
+          "Geometry": {
+            "S": json.dumps(location_to_cache["Geometry"])
+          },
+          "Country": {
+            "S": location_to_cache["Country"]
+          },
+          "Zipcode": {
+            "S": location_to_cache["Zipcode"]
+          },
+          "Latitude": {
+            "N": location_to_cache["Latitude"]
+          },
+          "Longitude": {
+            "N": location_to_cache["Longitude"]
+          },
+          "Label": {
+            "S": location_to_cache["Label"]
+          },
+          "Municipality": {
+            "S": location_to_cache["Municipality"]
+          },
+          "Region": {
+            "S": location_to_cache["Region"]
+          },
+          "SubRegion": {
+            "S": location_to_cache["SubRegion"]
+          },
+          "ttl": {
+            "N": str(expiryDateTime)
+          }
+            }
+    if "QueryPoint" in location_to_cache:
+        item["QueryPoint"] = {"S": json.dumps(location_to_cache["QueryPoint"])}
+    if "Relevance" in location_to_cache:
+        item["Relevance"] = {"N": str(location_to_cache["Relevance"])}
+    for key in ("Hits", "LastAccess"):
+        if key in location_to_cache:
+            item[key] = {"N": str(location_to_cache[key])}
+    return(item)
+
+
+def item_to_location (item):
+    """
+    Convert a DynamoDB cache item (compact or legacy) back into a Location "Place"
+    """
+    if "Rec" in item:
+        cached_location = cache_record.decode(item["Rec"]["B"])
+        for key in ("Hits", "LastAccess"):
+            if key in item:
+                cached_location[key] = int(item[key]["N"])
+        if "ttl" in item:
+            cached_location["ExpiresAt"] = int(item["ttl"]["N"])
+        return(cached_location)
+    cached_location = {}
+    for key, value in item.items():
+        if key == 'Geometry':
+            cached_location[key] = json.loads(value['S'])
+            try:
+                cached_location[key]['Point'] = json.loads(cached_location[key]['Point'])
+            except Exception:
+                pass
+        if key == 'Country':
+            cached_location[key] = value['S']
+        if key == 'Zipcode':
+            # stored as Zipcode, but read back under the Location API's name
+            cached_location['PostalCode'] = value['S']
+        if key == 'Latitude':
+            cached_location[key] = value['N']
+        if key == 'Longitude':
+            cached_location[key] = value['N']
+        if key == 'Label':
+            cached_location[key] = value['S']
+        if key == 'Municipality':
+            cached_location[key] = value['S']
+        if key == 'Region':
+            cached_location[key] = value['S']
+        if key == 'SubRegion':
+            cached_location[key] = value['S']
+        if key == 'QueryPoint':
+            cached_location[key] = json.loads(value['S'])
+        if key == 'Error':
+            cached_location[key] = value['S']
+        if key == 'Relevance':
+            cached_location[key] = float(value['N'])
+        if key == 'ttl':
+            cached_location['ExpiresAt'] = int(value['N'])
+        if key in ('Hits', 'LastAccess'):
+            cached_location[key] = int(value['N'])
+    return(cached_location)
+
+
+def cache_expiry (location_to_cache):
+    """
+    Expiry of a cache record: the one set when it was looked up, otherwise
+    the policy's TTL from now (records with a QueryPoint are reverse lookups)
+    """
+    if "ExpiresAt" in location_to_cache:
+        return(int(location_to_cache["ExpiresAt"]))
+    return(cache_policy.expires_at(location_to_cache, reverse="QueryPoint" in location_to_cache))
 
-def write_location_to_cache (table_name, location_to_cache, MAX_RETRIES = 10):
-    retry = True
-    retries = 1
-    week = datetime.datetime.today() + datetime.timedelta(days=1)
-    expiryDateTime = int(time.mktime(week.timetuple()))
-    try:
-        response = ddb_client.put_item(
-        TableName=table_name,
-        Item={
-            "id": {
-                "S": location_to_cache["PrimaryKey"]
-              },
-              "Geometry": {
-                "S": json.dumps(location_to_cache["Geometry"])
-              },
-              "Country": {
-                "S": location_to_cache["Country"]
-              },
-              "Zipcode": {
-                "S": location_to_cache["Zipcode"]
-              },
-              "Latitude": {
-                "N": location_to_cache["Latitude"]
-              },
-              "Longitude": {
-                "N": location_to_cache["Longitude"]
-              },
-              "Label": {
-                "S": location_to_cache["Label"]
-              },
-              "Municipality": {
-                "S": location_to_cache["Municipality"]
-              },
-              "Region": {
-                "S": location_to_cache["Region"]
-              },
-              "SubRegion": {
-                "S": location_to_cache["SubRegion"]
-              },
-              "ttl": {
-                "N": str(expiryDateTime)
-              }
-                })
-        return(response)
-    except Exception as e:
-        print({"error":"cannot write to cache", "exception":str(e)})
-        return({"error":"cannot write to cache", "exception":str(e)}) 
 
 def get_location_from_cache (table_name, primary_key, MAX_RETRIES = 10):
-    retry = True
-    retries = 1
-    
     try:
         response = ddb_client.get_item(TableName=table_name, Key={"id": { "S": primary_key}})
-        cached_location = {}
         if 'Item' in response:
-            for key, value in response['Item'].items():
-                if key == 'Geometry':
-                    cached_location[key] = json.loads(value['S'])
-                if key == 'Country':
-                    cached_location[key] = value['S']
-                if key == 'Zipcode':
-                    cached_location[key] = value['S']
-                if key == 'Latitude':
-                    cached_location[key] = value['N']
-                if key == 'Longitude':
-                    cached_location[key] = value['N']
-                if key == 'Label':
-                    cached_location[key] = value['S']
-                if key == 'Municipality':
-                    cached_location[key] = value['S']
-                    
-                if key == 'Region':
-                    cached_location[key] = value['S']
-                    
-                if key == 'SubRegion':
-                    cached_location[key] = value['S']
-
-            return(cached_location)
-    
+            return(item_to_location(response['Item']))
         else:
-
             return({"error":"not found"})
-        
-        
     except Exception as e:
         print({"error":"cannot read from cache", "exception":str(e)})
         return({"error":"cannot read from cache", "exception":str(e)})
-    
 
-def get_location_for_text (IndexName, Text, MAX_RETRIES = 10):
-    retry = True
+
+def _batch_get_chunk (table_name, primary_keys, MAX_RETRIES):
+    found = {}
+    request = {table_name: {"Keys": [{"id": {"S": primary_key}} for primary_key in primary_keys]}}
     retries = 1
-    while (retry and (retries < MAX_RETRIES)):
+    while request and retries <= MAX_RETRIES:
+        started = time.perf_counter()
         try:
-            response = location.search_place_index_for_text(
-                IndexName=location_index,
-                Text=Text)
-            retry = False
-            return(response)
-        except botocore.exceptions.ClientError as error:
-            # wait for (2^retries * 100) milliseconds
-            time.sleep(2**retries * 100/1000)
-            # status = Get the result of the asynchronous operation.
-            if error.response['Error']['Code'] == 'ThrottlingException':
-                print('{}: API call limit exceeded; backing off and retrying...{}: retries: {}'.format(Text,error.response['Error']['Code'],retries))
-                retry = True
-            elif error.response['Error']['Code'] == 'InternalServerException':
-                print('{}: Internal Server Exception; backing off and retrying...{}: retries: {}'.format(Text,error.response['Error']['Code'],retries))
-                retry = True
-            elif error.response['Error']['Code'] == 'ValidationException':
-                print('{}: Exiting...{}'.format(Text,error.response['Error']['Code']))
-                retry = False
-            elif error.response['Error']['Code'] == 'AccessDeniedException':
-                print('{}: Exiting...{}'.format(Text,error.response['Error']['Code']))    
-                retry = False
-            elif error.response['Error']['Code'] == 'ResourceNotFoundException':
-                print('{}: Exiting...{}'.format(Text,error.response['Error']['Code']))   
-                retry = False
-            elif error.response['Error']['Code'] == 'TooManyRequestsException':
-                print('{}: API call limit exceeded; backing off and retrying...{}: retries: {}'.format(Text,error.response['Error']['Code'],retries))  
-                retry = True
-            else:    
-                print ("{}: Un-Identified Exception: {} || {}".format(Text,error, error.response['Error']['Code']))
-                retry = False
+            response = ddb_client.batch_get_item(RequestItems=request)
+        except Exception as e:
+            log.error({"error":"cannot read from cache", "exception":str(e)})
+            return(found)
+        finally:
+            shard_metrics.record("DynamoDBReadLatency", (time.perf_counter() - started) * 1000)
+        for item in response.get("Responses", {}).get(table_name, []):
+            try:
+                found[item["id"]["S"]] = item_to_location(item)
+            except Exception as e:
+                # a corrupt or unknown-version record is looked up again and overwritten
+                log.warning({"error":"cannot decode cache record", "key":item["id"]["S"], "exception":str(e)})
+                shard_metrics.increment("CacheDecodeErrors")
+        request = response.get("UnprocessedKeys")
+        if request:
+            shard_metrics.increment("DynamoDBReadRetries")
+            # wait for (2^retries * 50) milliseconds before re-requesting throttled keys
+            time.sleep(2**retries * 50/1000)
             retries = retries + 1
-    print("{}: Giving up... Too many retries..".format(Text))
-    return("Error")
-        
-        
-def lambda_handler(event, context):
+    if request:
+        log.error({"error":"cannot read from cache", "unprocessed": len(request[table_name]["Keys"])})
+    return(found)
+
+
+def batch_get_locations_from_cache (table_name, primary_keys, MAX_RETRIES = 10):
+    """
+    Resolve many keys against the cache with BatchGetItem
+
+    Parameters
+    ----------
+    table_name: str, required
+        Name of the DynamoDB cache table
+    primary_keys: iterable, required
+        Cache keys to look up; duplicates are collapsed
+
+    Returns
+    ------
+        dict: cache key to Location "Place" for every key found in the cache
+    """
+    unique_keys = list(dict.fromkeys(primary_keys))
+    chunks = [unique_keys[i:i + DDB_BATCH_GET_SIZE] for i in range(0, len(unique_keys), DDB_BATCH_GET_SIZE)]
+    found = {}
+    for chunk_found in lookup_engine.map(lambda chunk: _batch_get_chunk(table_name, chunk, MAX_RETRIES), chunks):
+        found.update(chunk_found)
+    return(found)
+
+
+def _batch_write_chunk (table_name, items, MAX_RETRIES):
+    request = {table_name: [{"PutRequest": {"Item": item}} for item in items]}
+    retries = 1
+    while request and retries <= MAX_RETRIES:
+        started = time.perf_counter()
+        try:
+            response = ddb_client.batch_write_item(RequestItems=request)
+        except Exception as e:
+            log.error({"error":"cannot write to cache", "exception":str(e)})
+            return(False)
+        finally:
+            shard_metrics.record("DynamoDBWriteLatency", (time.perf_counter() - started) * 1000)
+        request = response.get("UnprocessedItems")
+        if request:
+            shard_metrics.increment("DynamoDBWriteRetries")
+            # wait for (2^retries * 50) milliseconds before re-sending throttled items
+            time.sleep(2**retries * 50/1000)
+            retries = retries + 1
+    if request:
+        log.error({"error":"cannot write to cache", "unprocessed": len(request[table_name])})
+        return(False)
+    return(True)
+
+
+def batch_write_locations_to_cache (table_name, locations_to_cache, MAX_RETRIES = 10):
+    """
+    Write many cache records with BatchWriteItem
+
+    Parameters
+    ----------
+    table_name: str, required
+        Name of the DynamoDB cache table
+    locations_to_cache: iterable, required
+        Cache records as built by location_to_cache_record; a key written
+        more than once keeps its last record. Each record expires as
+        cache_policy decides.
+
+    Returns
+    ------
+        bool: True when every record was written
+    """
+    items = list({
+        location_to_cache["PrimaryKey"]: location_to_item(location_to_cache, cache_expiry(location_to_cache))
+        for location_to_cache in locations_to_cache
+    }.values())
+    chunks = [items[i:i + DDB_BATCH_WRITE_SIZE] for i in range(0, len(items), DDB_BATCH_WRITE_SIZE)]
+    return(all(lookup_engine.map(lambda chunk: _batch_write_chunk(table_name, chunk, MAX_RETRIES), chunks)))
+
+
+# DynamoDB cache hits of this container not yet added to the entries' Hits counters
+_pending_access = Counter()
+_pending_access_lock = threading.Lock()
+_last_access_flush = [time.monotonic()]
+
+
+def note_cache_access (hits):
+    """
+    Add hits (cache key to rows answered) to the container's pending counts
+    """
+    with _pending_access_lock:
+        _pending_access.update(hits)
+
+
+def take_pending_access (primary_key):
+    """
+    Remove and return the pending hits of one entry, for a refresh that
+    writes the entry's Hits itself
+    """
+    with _pending_access_lock:
+        return(_pending_access.pop(primary_key, 0))
+
+
+def flush_cache_access (table_name, force=False):
+    """
+    Every CACHE_ACCESS_FLUSH_SECONDS (or when forced), write the pending
+    hits of the CACHE_ACCESS_MAX_WRITES most hit entries with
+    record_cache_access and drop the rest, so the counters cost a bounded
+    number of writes per container however many shards it serves
+
+    Returns
+    ------
+        int: number of entries updated
+    """
+    with _pending_access_lock:
+        if not _pending_access or not (force or time.monotonic() - _last_access_flush[0] >= cache_access_flush_seconds):
+            return(0)
+        hits = dict(_pending_access.most_common(max(0, cache_access_max_writes)))
+        _pending_access.clear()
+        _last_access_flush[0] = time.monotonic()
+    return(record_cache_access(table_name, hits))
+
+
+def record_cache_access (table_name, hits):
+    """
+    Add hits to the Hits counter of the cached entries and set
+    their LastAccess time. Entries that expired in the meantime are not
+    re-created; failures are only logged, the counters are best effort.
+
+    Parameters
+    ----------
+    table_name: str, required
+        Name of the DynamoDB cache table
+    hits: dict, required
+        Cache key to number of rows it answered
+
+    Returns
+    ------
+        int: number of entries updated
+    """
+    now = str(int(time.time()))
+
+    def update(item):
+        primary_key, count = item
+        try:
+            ddb_client.update_item(
+                TableName=table_name,
+                Key={"id": {"S": primary_key}},
+                UpdateExpression="ADD Hits :hits SET LastAccess = :now",
+                ConditionExpression="attribute_exists(id)",
+                ExpressionAttributeValues={":hits": {"N": str(count)}, ":now": {"N": now}})
+            return(True)
+        except Exception as e:
+            log.debug({"error":"cannot record cache access", "key": primary_key, "exception":str(e)})
+            return(False)
+    return(sum(lookup_engine.map(update, hits.items())))
+    
+
+def get_location_for_text (IndexName, Text, MAX_RETRIES = 10):
+    return(call_location("search_place_index_for_text", IndexName, Text, MAX_RETRIES, Text=Text))
+
+
+def location_to_cache_record (primary_key, place):
+    """
+    Flatten a Location "Place" into the record layout stored in the cache
+    """
+    if "Error" in place:
+        record = {"PrimaryKey": primary_key, "Error": place["Error"]}
+        for key in ("QueryPoint", "ExpiresAt"):
+            if key in place:
+                record[key] = place[key]
+        return(record)
+    point = place.get("Geometry", {}).get("Point", "0")
+    try:
+        longitude = point[0]
+        latitude = point[1]
+    except Exception:
+        longitude = "0"
+        latitude = "0"
+    record = {
+        "PrimaryKey": primary_key,
+        "Geometry": {"Point": str(point)},
+        "Country": place.get("Country", "0"),
+        "Zipcode": place.get("PostalCode", "0"),
+        "Latitude": str(latitude),
+        "Longitude": str(longitude),
+        "Label": place.get("Label", "0"),
+        "Municipality": place.get("Municipality", "0"),
+        "Region": place.get("Region", "0"),
+        "SubRegion": place.get("SubRegion", "0"),
+    }
+    if "QueryPoint" in place:
+        # the position the result was looked up for, used to validate geohash cell hits
+        record["QueryPoint"] = place["QueryPoint"]
+    for key in ("Relevance", "Hits", "LastAccess", "ExpiresAt"):
+        if key in place:
+            record[key] = place[key]
+    return(record)
+
+
+def lookup_location (query, lookup):
+    """
+    Call the Location API for a single cache miss. Runs on the lookup
+    engine's worker threads.
+
+    Parameters
+    ----------
+    query: str or list, required
+        Text or [Longitude, Latitude] position passed to the Location API
+    lookup: function, required
+        get_location_for_text or get_location_for_position
+
+    Returns
+    ------
+        dict: the Location "Place", or {"Error": <failure class>} when there is none
+    """
+    try:
+        log.debug("Making API call to Places API")
+        response = lookup(location_index, query)
+        if "Error" in response:
+            return(response)
+        results = response.get("Results")
+        if not results:
+            shard_metrics.increment("NotFound")
+            log.debug("No result for {}".format(query))
+            return({"Error": NO_RESULT})
+        json_response = results[0]["Place"]
+        if "Relevance" in results[0]:
+            # kept with the place, low confidence results expire sooner
+            json_response = dict(json_response, Relevance=results[0]["Relevance"])
+        log.debug(json_response)
+        return(json_response)
+    except Exception as e:
+        log.error("API Response Error: " + str(e))
+        return({"Error": FAILED})
+
+
+def remember_location (primary_key, place):
+    """
+    Put a lookup result in the in-memory cache: places for the cache's TTL,
+    permanent failures for NEGATIVE_CACHE_TTL_SECONDS and keys that gave up
+    for NEGATIVE_CACHE_RETRY_SECONDS. Other failures are not cached.
+
+    Returns
+    ------
+        bool: True when the result belongs in the DynamoDB cache as well
+    """
+    error = place.get("Error")
+    if error is None:
+        memory_cache.put(primary_key, place)
+        return(True)
+    if error in PERMANENT_FAILURES:
+        memory_cache.put(primary_key, place, ttl_seconds=min(memory_cache.ttl_seconds, cache_policy.negative_ttl_seconds))
+        return(True)
+    if error == GAVE_UP:
+        memory_cache.put(primary_key, place, ttl_seconds=negative_cache_retry_seconds)
+    return(False)
+
+
+def store_lookup_result (primary_key, query, place, reverse):
+    """
+    Stamp a new Location result with the point it was looked up for and its
+    expiry, and put it in the in-memory cache
+
+    Returns
+    ------
+        dict: the record to write to the DynamoDB cache, or None when the
+        result is not cached there
+    """
+    if isinstance(query, list):
+        place["QueryPoint"] = query
+    if "Error" not in place or place["Error"] in PERMANENT_FAILURES:
+        place["ExpiresAt"] = cache_policy.expires_at(place, reverse)
+    if remember_location(primary_key, place):
+        return(location_to_cache_record(primary_key, place))
+    return(None)
+
+
+_spatial_index = {}
+_spatial_index_lock = threading.Lock()
+
+
+def get_spatial_index ():
+    """
+    Load the spatial index from S3 once per container
+
+    Returns
+    ------
+        SpatialIndex, or None when no index is configured or it cannot be loaded
+    """
+    if not spatial_index_key:
+        return(None)
+    with _spatial_index_lock:
+        if "index" not in _spatial_index:
+            try:
+                response = s3_client.get_object(Bucket=spatial_index_bucket, Key=spatial_index_key)
+                # NumPy is only loaded by containers that use the index
+                from spatial_index import SpatialIndex
+                _spatial_index["index"] = SpatialIndex.load(response["Body"])
+                log.info("Loaded spatial index with {} places".format(len(_spatial_index["index"])))
+            except Exception as e:
+                log.error({"error":"cannot load spatial index", "exception":str(e)})
+                _spatial_index["index"] = None
+        return(_spatial_index["index"])
+
+
+def nearest_cached_place (query):
+    """
+    Answer a reverse geocoding query from the spatial index
+
+    Returns
+    ------
+        dict: the closest indexed place within the radius, or None
+    """
+    index = get_spatial_index()
+    if index is None:
+        return(None)
+    match = index.nearest(float(query[0]), float(query[1]), spatial_index_radius_m)
+    if match is None:
+        return(None)
+    place, distance = match
+    place["QueryPoint"] = query
+    return(place)
+
+
+def position_lookups (positions):
+    """
+    Build (cache key, query) pairs for reverse geocoding. In "geohash" mode
+    points are keyed by their geohash cell, anchored at the first point seen
+    in the cell; points farther than the tolerance from that anchor fall back
+    to an exact key.
+
+    Parameters
+    ----------
+    positions: iterable, required
+        (Longitude, Latitude) per row
+
+    Returns
+    ------
+        list: (cache key, [Longitude, Latitude]) per row
+    """
+    lookups = []
+    anchors = {}
+    for longitude, latitude in positions:
+        query = [longitude, latitude]
+        primary_key = geokeys.position_key(longitude, latitude)
+        if reverse_cache_mode == "geohash":
+            cell = geokeys.cell_key(longitude, latitude, geohash_precision)
+            anchor = anchors.setdefault(cell, query)
+            if geokeys.haversine_m(longitude, latitude, anchor[0], anchor[1]) <= reverse_cache_tolerance_m:
+                primary_key = cell
+        lookups.append((primary_key, query))
+    return(lookups)
+
+
+def cached_place_matches (primary_key, query, place):
+    """
+    A result cached under a geohash cell is only reused when the point it
+    was looked up for lies within the tolerance of the queried point
+    """
+    if not geokeys.is_cell_key(primary_key):
+        return(True)
+    anchor = place.get("QueryPoint") or place.get("Geometry", {}).get("Point")
+    try:
+        return(geokeys.haversine_m(query[0], query[1], anchor[0], anchor[1]) <= reverse_cache_tolerance_m)
+    except Exception:
+        return(False)
+
+
+def dedupe_lookups (lookups):
+    """
+    Collapse a shard's lookups to their unique cache keys
+
+    Parameters
+    ----------
+    lookups: list, required
+        (cache key, query) per row
+
+    Returns
+    ------
+        tuple: (unique lookups in first-seen order, index into the unique
+        lookups for every input row)
+    """
+    positions = {}
+    unique_lookups = []
+    inverse = []
+    for primary_key, query in lookups:
+        if primary_key not in positions:
+            positions[primary_key] = len(unique_lookups)
+            unique_lookups.append((primary_key, query))
+        inverse.append(positions[primary_key])
+    return(unique_lookups, inverse)
+
+
+def resolve_unique_locations (lookups, lookup):
+    """
+    Resolve a shard's lookups (see resolve_keys). A place found under a
+    geohash cell was looked up for one point of the cell; rows farther than
+    REVERSE_CACHE_TOLERANCE_M from that point are resolved again under their
+    exact position key.
+
+    Parameters
+    ----------
+    lookups: list, required
+        (cache key, query) per row
+    lookup: function, required
+        get_location_for_text or get_location_for_position
+
+    Returns
+    ------
+        tuple: (the Location "Place" for each unique key, index into them
+        for every row)
+    """
+    shard_metrics.increment("Rows", len(lookups))
+    unique_places, inverse = resolve_keys(lookups, lookup)
+    distant = [
+        row for row, (primary_key, query) in enumerate(lookups)
+        if geokeys.is_cell_key(primary_key) and "Error" not in unique_places[inverse[row]]
+        and not cached_place_matches(primary_key, query, unique_places[inverse[row]])
+    ]
+    if distant:
+        log.info("{} rows are beyond the tolerance of their cell's place, looking them up by position".format(len(distant)))
+        shard_metrics.increment("CellToleranceMisses", len(distant))
+        exact = [(geokeys.position_key(*lookups[row][1]), lookups[row][1]) for row in distant]
+        places, exact_inverse = resolve_keys(exact, lookup)
+        inverse = list(inverse)
+        for row, position in zip(distant, exact_inverse):
+            inverse[row] = len(unique_places) + position
+        unique_places = unique_places + places
+    return(unique_places, inverse)
+
+
+def resolve_keys (lookups, lookup):
+    """
+    Resolve a shard's lookups: de-duplicate the keys, read the in-memory
+    cache, batch-read DynamoDB for the rest, answer positions from the
+    spatial index, call Location once per missing key on the lookup engine
+    and write the new results back to both caches. Cached failures
+    ({"Error": <class>}) are answered like places, without calling Location.
+    Cached places due for refresh (see cache_policy) are re-geocoded as
+    well; the shard keeps the cached place if the refresh fails. With
+    CACHE_TRACK_ACCESS, the rows answered by entries read from DynamoDB are
+    added to the container's pending hit counts (see flush_cache_access).
+
+    Parameters
+    ----------
+    lookups: list, required
+        (cache key, query) per row
+    lookup: function, required
+        get_location_for_text or get_location_for_position
+
+    Returns
+    ------
+        tuple: (the Location "Place" for each unique key, index into them
+        for every row)
+    """
+    unique_lookups, inverse = dedupe_lookups(lookups)
+    queries = dict(unique_lookups)
+    cached = {
+        primary_key: place
+        for primary_key, place in memory_cache.get_many(queries).items()
+        if cached_place_matches(primary_key, queries[primary_key], place)
+    }
+    from_ddb = {
+        primary_key: place
+        for primary_key, place in batch_get_locations_from_cache(
+            ddb_table, [primary_key for primary_key in queries if primary_key not in cached]).items()
+        if cached_place_matches(primary_key, queries[primary_key], place)
+    }
+    for primary_key, place in from_ddb.items():
+        remember_location(primary_key, place)
+    cached.update(from_ddb)
+    negative = sum(1 for place in cached.values() if "Error" in place)
+    from_index = 0
+    if lookup is get_location_for_position:
+        for primary_key, query in unique_lookups:
+            if primary_key not in cached:
+                place = nearest_cached_place(query)
+                if place is not None:
+                    cached[primary_key] = place
+                    memory_cache.put(primary_key, place)
+                    from_index += 1
+    misses = [(primary_key, query) for primary_key, query in unique_lookups if primary_key not in cached]
+    log.info("{} rows, {} unique keys, {} found in Cache ({} in memory, {} from spatial index, {} known failures)".format(
+        len(lookups), len(unique_lookups), len(cached), len(cached) - len(from_ddb) - from_index, from_index, negative))
+    shard_metrics.increment("UniqueKeys", len(unique_lookups))
+    shard_metrics.increment("MemoryCacheHits", len(cached) - len(from_ddb) - from_index)
+    shard_metrics.increment("DynamoDBCacheHits", len(from_ddb))
+    shard_metrics.increment("SpatialIndexHits", from_index)
+    shard_metrics.increment("NegativeCacheHits", negative)
+    shard_metrics.increment("CacheMisses", len(misses))
+    reverse = lookup is get_location_for_position
+    rows_per_key = Counter(inverse)
+    # entries that came from the DynamoDB cache (directly or through memory) carry their expiry
+    stored = {
+        primary_key: rows_per_key[position]
+        for position, (primary_key, query) in enumerate(unique_lookups)
+        if "ExpiresAt" in cached.get(primary_key, {})
+    }
+    if track_cache_access:
+        # only entries read from DynamoDB count; memory hits would cost a write per warm shard
+        note_cache_access({primary_key: hits for primary_key, hits in stored.items() if primary_key in from_ddb})
+    refreshes = [
+        (primary_key, queries[primary_key]) for primary_key, hits in stored.items()
+        if cache_policy.should_refresh(cached[primary_key], reverse, hits)
+    ][:max(0, refresh_max_per_shard)]
+    if refreshes:
+        log.info("Refreshing {} cached locations ahead of expiry".format(len(refreshes)))
+        shard_metrics.increment("CacheRefreshes", len(refreshes))
+    places = lookup_engine.map(lambda item: lookup_location(item[1], lookup), misses + refreshes)
+    locations_to_cache = []
+    for (primary_key, query), place in zip(misses + refreshes, places):
+        if primary_key in cached:
+            if "Error" in place:
+                continue
+            # a refreshed entry keeps its hit count, and its write carries the pending hits
+            place["Hits"] = cached[primary_key].get("Hits", 0)
+            if track_cache_access:
+                place["Hits"] += take_pending_access(primary_key)
+                place["LastAccess"] = int(time.time())
+        cached[primary_key] = place
+        record = store_lookup_result(primary_key, query, place, reverse)
+        if record is not None:
+            locations_to_cache.append(record)
+    if locations_to_cache:
+        log.info("Writing {} locations to Cache".format(len(locations_to_cache)))
+        batch_write_locations_to_cache(ddb_table, locations_to_cache)
+    if track_cache_access:
+        shard_metrics.increment("CacheAccessWrites", flush_cache_access(ddb_table))
+    log.debug("Memory cache: {}".format(memory_cache.stats()))
+    unique_places = [cached[primary_key] for primary_key, query in unique_lookups]
+    return(unique_places, inverse)
+
+
+def enrich_frame (data, typed=False):
+    """
+    Geocode (Address/City/State columns) or reverse geocode (Latitude and
+    Longitude columns) every row of a DataFrame and add the place columns.
+    Each unique key's result is decoded once; the columns are then filled
+    for all rows at once.
+
+    Parameters
+    ----------
+    data: DataFrame, required
+    typed: bool, optional
+        Typed enrichment columns with missing values for failed lookups
+        (Parquet shards) instead of 0
+
+    Returns
+    ------
+        DataFrame: the input rows with the enrichment columns
+    """
+    columns = data.columns
+    ###########################
+    #     ReverseGeocoder     #
+    ###########################
+    if "Latitude" in columns and "Longitude" in columns:
+        lookups = position_lookups(zip(data["Longitude"], data["Latitude"]))
+        lookup = get_location_for_position
+    #########################################################
+    #     Geocoder  (for different possible column labels)  #
+    #########################################################
+    elif "Address" in columns:
+        lookups = [
+            (geokeys.address_key(address, city, state), geokeys.address_query(address, city, state))
+            for address, city, state in zip(data["Address"], data["City"], data["State"])
+        ]
+        lookup = get_location_for_text
+    else:
+        return(data)
+    places, inverse = resolve_unique_locations(lookups, lookup)
+    results = [PlaceResult.from_place(place) for place in places]
+    missing = sum(1 for result in results if not result.found)
+    if missing:
+        log.warning("Error: no place found for {} of {} unique keys".format(missing, len(results)))
+    return(data.assign(**enrichment_columns(results, inverse, typed=typed)))
+
+
+def _to_float (value):
+    try:
+        return(float(value))
+    except (TypeError, ValueError):
+        return(float("nan"))
+
+
+def row_lookups (columns, rows):
+    """
+    Build the lookups for rows parsed by csv_engine: positions when the
+    Latitude and Longitude columns are present, addresses otherwise
+
+    Parameters
+    ----------
+    columns: list, required
+        Title-cased column names
+    rows: list, required
+        One list of str or None per row
+
+    Returns
+    ------
+        tuple: ((cache key, query) per row, get_location_for_position or
+        get_location_for_text), or (None, None) without location columns
+    """
+    index = {column: position for position, column in enumerate(columns)}
+    if "Latitude" in index and "Longitude" in index:
+        longitude, latitude = index["Longitude"], index["Latitude"]
+        lookups = position_lookups((_to_float(row[longitude]), _to_float(row[latitude])) for row in rows)
+        return(lookups, get_location_for_position)
+    if "Address" in index:
+        address, city, state = index["Address"], index["City"], index["State"]
+        lookups = [
+            (geokeys.address_key(row[address], row[city], row[state]), geokeys.address_query(row[address], row[city], row[state]))
+            for row in rows
+        ]
+        return(lookups, get_location_for_text)
+    return(None, None)
+
+
+def enrich_rows (columns, rows):
+    """
+    csv engine counterpart of enrich_frame: geocode or reverse geocode rows
+    parsed by csv_engine and add the enrichment cells. Enrichment columns
+    already in the input are overwritten in place, new ones are appended, as
+    DataFrame.assign does.
+
+    Parameters
+    ----------
+    columns: list, required
+        Title-cased column names
+    rows: list, required
+        One list of str or None per row
+
+    Returns
+    ------
+        tuple: (column names, rows) of the enriched chunk
+    """
+    lookups, lookup = row_lookups(columns, rows)
+    if lookup is None:
+        return(columns, rows)
+    index = {column: position for position, column in enumerate(columns)}
+    places, inverse = resolve_unique_locations(lookups, lookup)
+    results = [PlaceResult.from_place(place) for place in places]
+    missing = sum(1 for result in results if not result.found)
+    if missing:
+        log.warning("Error: no place found for {} of {} unique keys".format(missing, len(results)))
+    values = [result.csv_values() for result in results]
+    enriched_columns = columns + [column for column in ENRICHMENT_COLUMNS if column not in index]
+    positions = [enriched_columns.index(column) for column in ENRICHMENT_COLUMNS]
+    padding = [None] * (len(enriched_columns) - len(columns))
+    enriched = []
+    for row, position in zip(rows, inverse):
+        row = row + padding
+        for column_position, value in zip(positions, values[position]):
+            row[column_position] = value
+        enriched.append(row)
+    return(enriched_columns, enriched)
+
+
+def uses_csv_engine (raw_format):
+    # the csv engine reads and writes CSV only; Parquet shards always go through pandas
+    return(process_engine == "csv" and raw_format == "csv" and intermediate_format == "csv")
+
+
+def process_shard_with_csv (body, s3_file_key):
+    """
+    csv engine: stream the shard STREAMING_CHUNK_ROWS rows at a time (or
+    whole) through enrich_rows into a multipart upload
+
+    Returns
+    ------
+        dict: the handler's response
+    """
+    with MultipartUpload(s3_client, destination_bucket, s3_file_key) as upload:
+        rows = 0
+        for chunk_number, (columns, chunk) in enumerate(csv_engine.iter_chunks(body, streaming_chunk_rows)):
+            columns, chunk = enrich_rows(columns, chunk)
+            upload.write(csv_engine.encode(columns, chunk, header=(chunk_number == 0)))
+            rows += len(chunk)
+            log.info("Enriched chunk {} ({} rows so far, {} bytes written)".format(chunk_number + 1, rows, upload.bytes_written))
+        response = upload.close()
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if status == 200:
+        print(f"Successful S3 upload response. Status - {status}")
+        return({"Payload": {"shard": s3_file_key}})
+    print(f"Unsuccessful S3 upload response. Status - {status}")
+    return({"Payload": {"status": status}})
+
+
+class HeaderedStream (io.RawIOBase):
+    """
+    Read-only stream of the CSV header followed by a byte-range body
+    """
+
+    def __init__(self, header, body):
+        self._parts = [io.BytesIO(header), body]
+
+    def readable(self):
+        return(True)
+
+    def readinto(self, buffer):
+        while self._parts:
+            data = self._parts[0].read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return(len(data))
+            self._parts.pop(0)
+        return(0)
+
+
+def get_shard (payload):
+    """
+    Open a raw shard. Shards written by the scatter step are whole objects;
+    shards described as a byte range ("source", "start", "end", "header")
+    are read straight from the input object with a ranged GET.
+
+    Returns
+    ------
+        dict: get_object style response whose Body yields the shard as CSV
+    """
+    if "source" not in payload:
+        return(s3_client.get_object(Bucket=payload["bucket"], Key=payload["shard"]))
+    header = payload["header"].encode("utf-8")
+    start, end = int(payload["start"]), int(payload["end"])
+    if end < start:
+        return({"ResponseMetadata": {"HTTPStatusCode": 200}, "Body": io.BytesIO(header)})
+    response = s3_client.get_object(
+        Bucket=payload["bucket"], Key=payload["source"], Range="bytes={}-{}".format(start, end))
+    response["Body"] = io.BufferedReader(HeaderedStream(header, response["Body"]))
+    return(response)
+
+
+def process_shard_in_chunks (body, raw_format, s3_file_key):
+    """
+    Streaming mode: read the shard STREAMING_CHUNK_ROWS rows at a time,
+    enrich each chunk and stream it into a multipart upload, so peak memory
+    is bounded by the chunk size rather than the shard size
+
+    Parameters
+    ----------
+    body: file-like object, required
+        Body of the raw shard
+    raw_format: str, required
+        Format of the raw shard ("csv" or "parquet")
+    s3_file_key: str, required
+        Key of the processed shard in the processed bucket
+
+    Returns
+    ------
+        dict: the handler's response
+    """
+    with MultipartUpload(s3_client, destination_bucket, s3_file_key) as upload:
+        writer = shard_format.FrameWriter(upload, intermediate_format, parquet_compression)
+        for chunk_number, chunk in enumerate(shard_format.iter_frames(body, raw_format, streaming_chunk_rows)):
+            chunk = enrich_frame(chunk.dropna(thresh=2).rename(columns=str.title), typed=(intermediate_format == "parquet"))
+            writer.write(chunk)
+            log.info("Enriched chunk {} ({} rows so far, {} bytes written)".format(chunk_number + 1, writer.rows, upload.bytes_written))
+        writer.close()
+        response = upload.close()
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if status == 200:
+        print(f"Successful S3 multipart upload response. Status - {status}")
+        return({"Payload": {"shard": s3_file_key}})
+    print(f"Unsuccessful S3 multipart upload response. Status - {status}")
+    return({"Payload": {"status": status}})
+
+
+def process_shard_with_checkpoints (body, raw_format, s3_file_key, context, source=""):
+    """
+    Checkpointed mode: enrich the shard CHECKPOINT_ROWS rows at a time and
+    save every chunk to S3 (see checkpoint.ShardCheckpoint), skipping the
+    chunks an earlier invocation already saved. When the next chunk might
+    not finish in the invocation's remaining time, raise ShardCheckpointed
+    so the Map state retries and the next invocation continues from there.
+    Once every chunk is saved they are joined into the processed shard.
+
+    Parameters
+    ----------
+    body: file-like object, required
+        Body of the raw shard
+    raw_format: str, required
+        Format of the raw shard ("csv" or "parquet")
+    s3_file_key: str, required
+        Key of the processed shard in the processed bucket
+    context: object, required
+        Lambda context, or None for no time limit
+    source: str, optional
+        ETag of the raw input; chunks saved from another version are dropped
+
+    Returns
+    ------
+        dict: the handler's response
+    """
+    checkpoint = ShardCheckpoint(
+        s3_client, destination_bucket, s3_file_key, checkpoint_rows, intermediate_format, parquet_compression,
+        source)
+    done = checkpoint.load()
+    if done:
+        log.info("Resuming after {} saved chunks ({} rows)".format(done, checkpoint.rows))
+        shard_metrics.increment("ResumedChunks", done)
+    if uses_csv_engine(raw_format):
+        chunks = csv_engine.iter_chunks(body, checkpoint_rows)
+        def encode(chunk, header):
+            columns, rows = enrich_rows(*chunk)
+            return(csv_engine.encode(columns, rows, header), len(rows))
+    else:
+        chunks = shard_format.iter_frames(body, raw_format, checkpoint_rows)
+        def encode(chunk, header):
+            chunk = enrich_frame(chunk.dropna(thresh=2).rename(columns=str.title), typed=(intermediate_format == "parquet"))
+            return(shard_format.write_frame(chunk, intermediate_format, parquet_compression, header), len(chunk))
+    slowest = 0.0
+    for chunk_number, chunk in enumerate(chunks):
+        if chunk_number < done:
+            continue
+        if context is not None:
+            remaining = context.get_remaining_time_in_millis() / 1000
+            if remaining < max(checkpoint_safety_seconds, 2 * slowest):
+                log.warning("Stopping with {:.0f}s left after {} chunks; the retry resumes from the checkpoint".format(
+                    remaining, chunk_number))
+                raise ShardCheckpointed("{} chunks of {} saved".format(chunk_number, s3_file_key))
+        started = time.perf_counter()
+        # only the first CSV chunk carries the header, so the chunks can be joined byte for byte
+        checkpoint.save(*encode(chunk, header=(chunk_number == 0)))
+        slowest = max(slowest, time.perf_counter() - started)
+        log.info("Saved chunk {} ({} rows so far)".format(chunk_number + 1, checkpoint.rows))
+    response = checkpoint.assemble()
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if status == 200:
+        chunks = len(checkpoint.sizes)
+        checkpoint.clear()
+        print(f"Successful S3 upload of {chunks} checkpointed chunks. Status - {status}")
+        return({"Payload": {"shard": s3_file_key}})
+    print(f"Unsuccessful S3 upload response. Status - {status}")
+    return({"Payload": {"status": status}})
+
+
+def process_shard(event, context=None):
     
     ################################################################
     #     Get Pre-Processed Shard from S3 via a triggered GET      #
     ################################################################
     bucket_name = event["Payload"]["bucket"]
-    s3_file_key = event["Payload"]["shard"]
+    s3_file_key = shard_format.shard_key(event["Payload"]["shard"], intermediate_format)
+    # byte-range shards are slices of the CSV input; shard objects carry their format in the key
+    raw_format = "csv" if "source" in event["Payload"] else shard_format.format_of(event["Payload"]["shard"])
 
     # s3_file_key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8') 
     
-    response = s3_client.get_object(Bucket=bucket_name, Key=s3_file_key)
+    response = get_shard(event["Payload"])
     status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-    if status == 200:
+    if status in (200, 206):
         print(f"Successful S3 get_object response. Status - {status}")
-        data = pd.read_csv(response.get("Body")).dropna(thresh=2)
+        response_lambda={}
+        response_lambda['Payload']={}
+        if checkpoint_rows > 0:
+            return(process_shard_with_checkpoints(
+                response.get("Body"), raw_format, s3_file_key, context, response.get("ETag", "")))
+        if uses_csv_engine(raw_format):
+            return(process_shard_with_csv(response.get("Body"), s3_file_key))
+        if streaming_chunk_rows > 0:
+            return(process_shard_in_chunks(response.get("Body"), raw_format, s3_file_key))
+        data = shard_format.read_frame(response.get("Body"), raw_format).dropna(thresh=2)
         data = data.rename(columns=str.title)
-        columns = data.columns
-        Countries = []
-        Points = []
-        Latitude = []
-        Longitude = []
-        Labels = []
-        Regions = []
-        SubRegions = []
-        Municipalities = []
-        Zipcodes = []
-        Latitudes = []
-        Longitudes = []
-        location_to_cache = {}
-        ###########################
-        #     ReverseGeocoder     #
-        ###########################
-        
-        if "Latitude" and "Longitude" in columns:
-            for index, row in data.iterrows():
-                try:
-                    response_from_cache = get_location_from_cache (ddb_table, str(row.Longitude) +","+ str(row.Latitude))
-                    if "error" in response_from_cache:
-                        try:
-                            print("Making API call to Places API")
-                            response = get_location_for_position(location_index, [row.Longitude, row.Latitude])
-                            json_response = response["Results"][0]["Place"]
-                            print(json_response)
-                        except Exception as e:
-                            print("API Response Error: " + str(e))
-                            print("API Response Error")
-                    else:
-                        print("Found Location in Cache")
-                        
-                        json_response = response_from_cache
-                        print(json_response)
-                        json_response['Geometry']['Point'] = json.loads(json_response['Geometry']['Point'])
-                except Exception as e:
-                    print("Exception reading from Cache: " + str(e))
-                try:
-                    Country = (json_response["Country"])
-                    Countries.append(Country)
-                except Exception as e:
-                    Country = "0"
-                    Countries.append(0)
-                try:
-                    Point = (json_response["Geometry"]["Point"])
-                    Points.append(Point)
-                except Exception as e:
-                    Point = "0"
-                    Points.append(0)
-                try:
-                    Longitude = (Point[0])
-                    print("Longitude: {}".format(Longitude))
-                    Longitudes.append(Longitude)
-                except Exception as e:
-                    Longitude = "0"
-                    Longitudes.append(0)
-                    print("Error: Lon unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Latitude = (Point[1])
-                    print("Latitude: {}".format(Latitude))
-                    Latitudes.append(Latitude)
-                except Exception as e:
-                    Latitude = "0"
-                    Latitudes.append(0)
-                    print("Error: Lat unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Label = (json_response["Label"])
-                    Labels.append(Label)
-                except Exception as e:
-                    Label = "0"
-                    Labels.append(0)
-                    print("Error: Address unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Zipcode = (json_response["PostalCode"])
-                    Zipcodes.append(Zipcode)
-                except Exception as e:
-                    Zipcode = "0"
-                    Zipcodes.append(0)
-                try:
-                    if "Municipality" in (json_response):
-                         Municipality = (json_response["Municipality"])
-                         Municipalities.append(Municipality)
-                    else:
-                         Municipality = "0"
-                         Municipalities.append(0)
-                except Exception as e:
-                    Municipality = "0"
-                    Municipalities.append(0)
-                try:
-                    Region = (json_response["Region"])
-                    Regions.append(Region)
-                except Exception as e:
-                    Region = "0"
-                    Regions.append(0)
-                    print("Error: Region unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    SubRegion = (json_response["SubRegion"])
-                    SubRegions.append(SubRegion)
-                except Exception as e:
-                    SubRegion = "0"
-                    SubRegions.append(0)
-                    print("Error: SubRegion unavailable for given input in row", (len(Points)) + 1)
-                
-                location_to_cache["Geometry"]={}
-                location_to_cache["Geometry"]["Point"] = str(Point)
-                location_to_cache["Country"] = Country
-                location_to_cache["Zipcode"] = Zipcode
-                location_to_cache["Latitude"] = str(Latitude)
-                location_to_cache["Longitude"] = str(Longitude)
-                location_to_cache["Label"] = Label
-                location_to_cache["Municipality"] = Municipality
-                location_to_cache["Region"] = Region
-                location_to_cache["SubRegion"] = SubRegion
-                location_to_cache["PrimaryKey"] = str(row.Longitude) +","+ str(row.Latitude)
-                if "error" in response_from_cache:
-                    print("Writing to Cache: {}".format(location_to_cache["PrimaryKey"]))
-                    write_location_to_cache (ddb_table, location_to_cache)
-            print ("length of Points: {}".format(len(Points)))
-            print ("length of Countries: {}".format(len(Countries)))
-            print ("length of Latitude: {}".format(len(Latitudes)))
-            print ("length of Longitude: {}".format(len(Longitudes)))
-            print ("length of Labels: {}".format(len(Labels)))
-            print ("length of Municipalities: {}".format(len(Municipalities)))
-            print ("length of Regions: {}".format(len(Regions)))
-            print ("length of SubRegions: {}".format(len(SubRegions)))
-            data["Points"] = Points
-            data["Country"] = Countries
-            data["Latitude"] = Latitudes
-            data["Longitude"] = Longitudes
-            data["Label"] = Labels
-            data["Municipality"] = Municipalities
-            data["Region"] = Regions
-            data["SubRegion"] = SubRegions
-            data["Zipcode"] = Zipcodes
-            
-        #########################################################
-        #     Geocoder  (for different possible column labels)  #
-        #########################################################
-        
-
-        elif "Address" in columns:
-            for index, row in data.iterrows():
-                
-                try:
-                    response_from_cache = get_location_from_cache (ddb_table, str(row.Address) + row.City + "," + row.State)
-                    if "error" in response_from_cache:
-                        try:
-                            print("Making API call to Places API")
-                            response = get_location_for_text(location_index, str(row.Address) + row.City + "," + row.State)
-                            json_response = response["Results"][0]["Place"]
-                            print(json_response)
-                        except Exception as e:
-                            print("API Response Error: " + str(e))
-                            print("API Response Error")
-                    else:
-                        print("Found Location in Cache")
-                        json_response = response_from_cache
-                        json_response['Geometry']['Point'] = json.loads(json_response['Geometry']['Point'])
-                        print(json_response)
-                except Exception as e:
-                    print("Exception reading from Cache: " + str(e))
-                try:
-                    Country = (json_response["Country"])
-                    Countries.append(Country)
-                except Exception as e:
-                    Country = "0"
-                    Countries.append(0)
-                try:
-                    Point = (json_response["Geometry"]["Point"])
-                    Points.append(Point)
-                except Exception as e:
-                    Point = "0"
-                    Points.append(0)
-                try:
-                    Longitude = (Point[0])
-                    print("Longitude: {}".format(Longitude))
-                    Longitudes.append(Longitude)
-                except Exception as e:
-                    Longitude = "0"
-                    Longitudes.append(0)
-                    print("Error: Lon unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Latitude = (Point[1])
-                    print("Latitude: {}".format(Latitude))
-                    Latitudes.append(Latitude)
-                except Exception as e:
-                    Latitude = "0"
-                    Latitudes.append(0)
-                    print("Error: Lat unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Label = (json_response["Label"])
-                    Labels.append(Label)
-                except Exception as e:
-                    Label = "0"
-                    Labels.append(0)
-                    print("Error: Address unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    Zipcode = (json_response["PostalCode"])
-                    Zipcodes.append(Zipcode)
-                except Exception as e:
-                    Zipcode = "0"
-                    Zipcodes.append(0)
-                try:
-                    if "Municipality" in (json_response):
-                         Municipality = (json_response["Municipality"])
-                         Municipalities.append(Municipality)
-                    else:
-                         Municipality = "0"
-                         Municipalities.append(0)
-                except Exception as e:
-                    Municipality = "0"
-                    Municipalities.append(0)
-                try:
-                    Region = (json_response["Region"])
-                    Regions.append(Region)
-                except Exception as e:
-                    Region = "0"
-                    Regions.append(0)
-                    print("Error: Region unavailable for given input in row", (len(Points)) + 1)
-                try:
-                    SubRegion = (json_response["SubRegion"])
-                    SubRegions.append(SubRegion)
-                except Exception as e:
-                    SubRegion = "0"
-                    SubRegions.append(0)
-                    print("Error: SubRegion unavailable for given input in row", (len(Points)) + 1)
-                location_to_cache["Geometry"]={}
-                location_to_cache["Geometry"]["Point"] = str(Point)
-                location_to_cache["Country"] = Country
-                location_to_cache["Zipcode"] = Zipcode
-                location_to_cache["Latitude"] = str(Latitude)
-                location_to_cache["Longitude"] = str(Longitude)
-                location_to_cache["Label"] = Label
-                location_to_cache["Municipality"] = Municipality
-                location_to_cache["Region"] = Region
-                location_to_cache["SubRegion"] = SubRegion
-                location_to_cache["PrimaryKey"] = str(row.Address) + str(row.City) + "," + str(row.State)
-                if "error" in response_from_cache:
-                    write_location_to_cache (ddb_table, location_to_cache)
-            print ("length of Points: {}".format(len(Points)))
-            print ("length of Countries: {}".format(len(Countries)))
-            print ("length of Latitude: {}".format(len(Latitudes)))
-            print ("length of Longitude: {}".format(len(Longitudes)))
-            print ("length of Labels: {}".format(len(Labels)))
-            print ("length of Municipalities: {}".format(len(Municipalities)))
-            print ("length of Regions: {}".format(len(Regions)))
-            print ("length of SubRegions: {}".format(len(SubRegions)))
-            data["Points"] = Points
-            data["Country"] = Countries
-            data["Latitude"] = Latitudes
-            data["Longitude"] = Longitudes
-            data["Label"] = Labels
-            data["Municipality"] = Municipalities
-            data["Region"] = Regions
-            data["SubRegion"] = SubRegions
-            data["Zipcode"] = Zipcodes
+        data = enrich_frame(data, typed=(intermediate_format == "parquet"))
         
         ################################################## 
         #     Write processed shard to S3 via a PUT      #
         ##################################################
-        response_lambda={}
-        response_lambda['Payload']={}
-        with io.StringIO() as csv_buffer:
-            data.to_csv(csv_buffer, index=False)
-            response = s3_client.put_object(
-                Bucket=destination_bucket, Key=s3_file_key, Body=csv_buffer.getvalue()
-                )
-            status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-            if status == 200:
-                print(f"Successful S3 put_object response. Status - {status}")
-                response_lambda['Payload']={"shard": s3_file_key}
-            else:
-                print(f"Unsuccessful S3 put_object response. Status - {status}")
-                response_lambda['Payload']={"status": status}
+        response = s3_client.put_object(
+            Bucket=destination_bucket, Key=s3_file_key,
+            Body=shard_format.write_frame(data, intermediate_format, parquet_compression)
+            )
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if status == 200:
+            print(f"Successful S3 put_object response. Status - {status}")
+            response_lambda['Payload']={"shard": s3_file_key}
+        else:
+            print(f"Unsuccessful S3 put_object response. Status - {status}")
+            response_lambda['Payload']={"status": status}
         
     
     return(response_lambda)
+
+
+def lambda_handler(event, context):
+    """
+    Enrich one shard and write one EMF metrics record for it
+
+    Parameters
+    ----------
+    event: dict, required
+        Map state item under "Payload": the shard descriptor from the scatter step
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+
+    Returns
+    ------
+        dict: "Payload" with the processed shard's key, or the failing S3 status
+    """
+    shard = event["Payload"]["shard"]
+    shard_metrics.reset()
+    try:
+        return(process_shard(event, context))
+    finally:
+        shard_metrics.emit(Shard=shard)
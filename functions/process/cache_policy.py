@@ -0,0 +1,115 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import time
+
+###  How long a lookup result stays in the DynamoDB cache and when it is
+###  re-geocoded ahead of its expiry. Forward and reverse results, low
+###  confidence results and failures each get their own TTL; entries close to
+###  expiry are refreshed while they are still served from the cache, for hot
+###  keys at any time and for every key during the low-traffic window, so the
+###  hot set never expires all at once.
+
+DAY = 24 * 60 * 60
+
+
+def parse_window(window):
+    """
+    Parse a "start-end" range of UTC hours, e.g. "1-5" or "22-4"
+
+    Returns
+    ------
+        tuple: (start hour, end hour), or None for an empty window
+    """
+    if not window:
+        return None
+    start, end = (int(hour) % 24 for hour in window.split("-"))
+    return (start, end)
+
+
+class CachePolicy:
+    """
+    TTLs and refresh-ahead rules of the location cache
+
+    Parameters
+    ----------
+    forward_ttl_seconds: int, required
+        TTL of a geocoding (text) result
+    reverse_ttl_seconds: int, required
+        TTL of a reverse geocoding (position) result
+    low_confidence_ttl_seconds: int, required
+        TTL of a result whose Relevance is below low_confidence_relevance
+    low_confidence_relevance: float, required
+    negative_ttl_seconds: int, required
+        TTL of a cached failure
+    refresh_ahead_fraction: float, optional
+        An entry is due for refresh in the last fraction of its TTL; 0 disables refresh-ahead
+    refresh_hot_hits: int, optional
+        Hit count from which a due entry is refreshed outside the window
+    refresh_window: str, optional
+        UTC hours ("start-end") in which every due entry is refreshed
+    clock: function, optional
+        Epoch seconds, replaced in tests
+    """
+
+    def __init__(self, forward_ttl_seconds, reverse_ttl_seconds, low_confidence_ttl_seconds,
+                 low_confidence_relevance, negative_ttl_seconds, refresh_ahead_fraction=0.0,
+                 refresh_hot_hits=10, refresh_window="", clock=time.time):
+        self.forward_ttl_seconds = int(forward_ttl_seconds)
+        self.reverse_ttl_seconds = int(reverse_ttl_seconds)
+        self.low_confidence_ttl_seconds = int(low_confidence_ttl_seconds)
+        self.low_confidence_relevance = float(low_confidence_relevance)
+        self.negative_ttl_seconds = int(negative_ttl_seconds)
+        self.refresh_ahead_fraction = float(refresh_ahead_fraction)
+        self.refresh_hot_hits = int(refresh_hot_hits)
+        self.refresh_window = parse_window(refresh_window)
+        self.clock = clock
+
+    def ttl_seconds(self, place, reverse):
+        """
+        Time to live of a cached place (or failure)
+
+        Parameters
+        ----------
+        place: dict, required
+            Location "Place", possibly with the result's "Relevance", or {"Error": <class>}
+        reverse: bool, required
+            True for a reverse geocoding result
+        """
+        if "Error" in place:
+            return self.negative_ttl_seconds
+        ttl = self.reverse_ttl_seconds if reverse else self.forward_ttl_seconds
+        relevance = place.get("Relevance")
+        if relevance is not None and float(relevance) < self.low_confidence_relevance:
+            ttl = min(ttl, self.low_confidence_ttl_seconds)
+        return ttl
+
+    def expires_at(self, place, reverse):
+        """
+        Returns
+        ------
+            int: epoch seconds at which DynamoDB may delete the entry
+        """
+        return int(self.clock()) + self.ttl_seconds(place, reverse)
+
+    def in_refresh_window(self):
+        if self.refresh_window is None:
+            return False
+        start, end = self.refresh_window
+        hour = time.gmtime(self.clock()).tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def should_refresh(self, place, reverse, hits=0):
+        """
+        A cached result is re-geocoded when it is in the last
+        refresh_ahead_fraction of its TTL and either the key is hot
+        (stored plus current hits) or the refresh window is open. Failures
+        are never refreshed; they expire and are retried as misses.
+        """
+        if self.refresh_ahead_fraction <= 0 or "Error" in place or "ExpiresAt" not in place:
+            return False
+        remaining = int(place["ExpiresAt"]) - self.clock()
+        if remaining > self.refresh_ahead_fraction * self.ttl_seconds(place, reverse):
+            return False
+        return int(place.get("Hits", 0)) + hits >= self.refresh_hot_hits or self.in_refresh_window()
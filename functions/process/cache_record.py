@@ -0,0 +1,137 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import struct
+import zlib
+
+###  Compact encoding of a cached location: every place field, the point and
+###  the queried position packed into one binary DynamoDB attribute instead
+###  of ten string attributes with nested JSON. The first byte is the format
+###  version; anything that changes the layout (including ZDICT) needs a new
+###  version, and decode keeps reading the older ones.
+
+VERSION = 1
+# (record field, place field) in the order they are packed; "0" marks a missing field, as in the record layout
+TEXT_FIELDS = (
+    ("Country", "Country"), ("Zipcode", "PostalCode"), ("Label", "Label"),
+    ("Municipality", "Municipality"), ("Region", "Region"), ("SubRegion", "SubRegion"),
+)
+
+HAS_POINT = 0x01
+HAS_QUERY_POINT = 0x02
+HAS_RELEVANCE = 0x04
+IS_ERROR = 0x08
+COMPRESSED = 0x80
+
+_HEADER = struct.Struct("<BB")
+_POINT = struct.Struct("<dd")
+_RELEVANCE = struct.Struct("<d")
+_LENGTH = struct.Struct("<H")
+# preset dictionary of strings common in Location results, so even single short records compress
+ZDICT = (
+    b"Street, Avenue, Road, Boulevard, Drive, Lane, Court, Place, Highway, "
+    b"County, City of , United States, USA, CAN, MEX, GBR, "
+    b"Connecticut, Massachusetts, New York, Florida, California, Texas, "
+    b"Hartford, Miami-Dade County, Miami, Hartford County, "
+)
+
+
+def _pack_text(value):
+    data = str(value).encode("utf-8")[:0xFFFF]
+    return _LENGTH.pack(len(data)) + data
+
+
+def _point(value):
+    try:
+        longitude, latitude = (float(coordinate) for coordinate in value[:2])
+        return (longitude, latitude)
+    except Exception:
+        return None
+
+
+def _parse_point(point):
+    # the record layout keeps the point as str([lon, lat])
+    if isinstance(point, str):
+        try:
+            return [float(value) for value in point.strip("[]() ").split(",")]
+        except ValueError:
+            return ()
+    return point or ()
+
+
+def encode(record):
+    """
+    Pack a cache record (as built by location_to_cache_record) into bytes
+
+    Parameters
+    ----------
+    record: dict, required
+        Place fields, "Geometry" {"Point": [Longitude, Latitude] or its str()},
+        and optionally "QueryPoint", "Relevance" or "Error"
+
+    Returns
+    ------
+        bytes
+    """
+    flags = 0
+    body = []
+    point = _point(_parse_point((record.get("Geometry") or {}).get("Point")))
+    if point is not None and "Error" not in record:
+        flags |= HAS_POINT
+        body.append(_POINT.pack(*point))
+    query_point = _point(record.get("QueryPoint") or ())
+    if query_point is not None:
+        flags |= HAS_QUERY_POINT
+        body.append(_POINT.pack(*query_point))
+    if record.get("Relevance") is not None:
+        flags |= HAS_RELEVANCE
+        body.append(_RELEVANCE.pack(float(record["Relevance"])))
+    if "Error" in record:
+        flags |= IS_ERROR
+        body.append(_pack_text(record["Error"]))
+    else:
+        body.extend(_pack_text(record.get(field, "0")) for field, place_field in TEXT_FIELDS)
+    body = b"".join(body)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, ZDICT)
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) < len(body):
+        flags |= COMPRESSED
+        body = compressed
+    return _HEADER.pack(VERSION, flags) + body
+
+
+def decode(data):
+    """
+    Unpack bytes written by encode into a Location "Place"
+
+    Returns
+    ------
+        dict: the place fields, "Geometry" {"Point": [Longitude, Latitude]}
+        and "QueryPoint" / "Relevance" when they were stored, or
+        {"Error": <class>} for a cached failure
+    """
+    data = bytes(data)
+    version, flags = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unknown cache record version {}".format(version))
+    body = data[_HEADER.size:]
+    if flags & COMPRESSED:
+        decompressor = zlib.decompressobj(-15, ZDICT)
+        body = decompressor.decompress(body) + decompressor.flush()
+    place = {}
+    offset = 0
+    if flags & HAS_POINT:
+        place["Geometry"] = {"Point": list(_POINT.unpack_from(body, offset))}
+        offset += _POINT.size
+    if flags & HAS_QUERY_POINT:
+        place["QueryPoint"] = list(_POINT.unpack_from(body, offset))
+        offset += _POINT.size
+    if flags & HAS_RELEVANCE:
+        place["Relevance"] = _RELEVANCE.unpack_from(body, offset)[0]
+        offset += _RELEVANCE.size
+    fields = ("Error",) if flags & IS_ERROR else [place_field for field, place_field in TEXT_FIELDS]
+    for field in fields:
+        length = _LENGTH.unpack_from(body, offset)[0]
+        offset += _LENGTH.size
+        place[field] = body[offset:offset + length].decode("utf-8")
+        offset += length
+    return place
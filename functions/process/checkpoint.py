@@ -0,0 +1,149 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import json
+
+import botocore.exceptions
+
+import shard_format
+from s3_multipart import MultipartUpload
+
+###  Progress of a shard kept in S3 while it is processed in chunks: every
+###  enriched chunk is its own object under checkpoints/<shard>/ and a small
+###  cursor object lists the chunks done so far. An invocation that stops
+###  early (or fails) leaves them behind, and the Map state's retry resumes
+###  after the last saved chunk instead of starting the shard again.
+
+CHECKPOINT_PREFIX = "checkpoints/"
+
+
+class ShardCheckpointed(Exception):
+    """
+    Raised to end an invocation before its time runs out once the shard's
+    progress is saved; the Map state retries on this error name and the
+    retry resumes from the checkpoint
+    """
+
+
+class ShardCheckpoint:
+    """
+    Chunk objects and cursor of one processed shard
+
+    Parameters
+    ----------
+    s3_client: botocore client, required
+    bucket: str, required
+        Bucket of the processed shards; the checkpoint lives under CHECKPOINT_PREFIX
+    shard_key: str, required
+        Key of the processed shard the chunks are assembled into
+    chunk_rows: int, required
+        Raw rows per chunk; a cursor saved with another chunk size is ignored
+    fmt: str, required
+        Format of the processed shard ("csv" or "parquet")
+    compression: str, optional
+        Parquet compression codec
+    source: str, optional
+        ETag of the raw input; a cursor saved while reading another version
+        of the input is ignored
+    """
+
+    def __init__(self, s3_client, bucket, shard_key, chunk_rows, fmt, compression=shard_format.DEFAULT_COMPRESSION,
+                 source=""):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.shard_key = shard_key
+        self.chunk_rows = int(chunk_rows)
+        self.fmt = fmt
+        self.compression = compression
+        self.source = source
+        self.prefix = "{}{}/".format(CHECKPOINT_PREFIX, shard_key)
+        self.cursor_key = self.prefix + "cursor.json"
+        # size in bytes of every chunk saved so far, in order
+        self.sizes = []
+        self.rows = 0
+
+    def chunk_key(self, number, fmt=None):
+        return "{}chunk-{:06d}{}".format(self.prefix, number, shard_format.EXTENSIONS[fmt or self.fmt])
+
+    def load(self):
+        """
+        Read the cursor left by an earlier invocation. A cursor saved for
+        another version of the input, another chunk size or another format
+        is discarded together with its chunks.
+
+        Returns
+        ------
+            int: number of chunks already done (0 without a usable cursor)
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.cursor_key)
+            cursor = json.loads(response["Body"].read())
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return 0
+            raise
+        if (cursor.get("source") != self.source or cursor.get("chunk_rows") != self.chunk_rows
+                or cursor.get("format") != self.fmt):
+            fmt = cursor.get("format")
+            stale = [self.chunk_key(number, fmt) for number in range(len(cursor.get("sizes", [])))] \
+                if fmt in shard_format.EXTENSIONS else []
+            self._delete(stale + [self.cursor_key])
+            return 0
+        self.sizes = list(cursor["sizes"])
+        self.rows = int(cursor.get("rows", 0))
+        return len(self.sizes)
+
+    def save(self, body, rows):
+        """
+        Store the next enriched chunk, then move the cursor past it
+
+        Parameters
+        ----------
+        body: bytes, required
+            The chunk encoded in fmt; CSV chunks after the first have no header
+        rows: int, required
+            Rows in the chunk
+        """
+        number = len(self.sizes)
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.chunk_key(number), Body=body)
+        self.sizes.append(len(body))
+        self.rows += rows
+        cursor = {"source": self.source, "chunk_rows": self.chunk_rows, "format": self.fmt,
+                  "sizes": self.sizes, "rows": self.rows}
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.cursor_key, Body=json.dumps(cursor).encode("utf-8"))
+
+    def assemble(self):
+        """
+        Join the chunks into the processed shard. CSV chunks are appended
+        with MultipartUpload.copy (server-side for large chunks); Parquet
+        chunks are re-written one at a time into a single file.
+
+        Returns
+        ------
+            dict: response of the final upload
+        """
+        with MultipartUpload(self.s3_client, self.bucket, self.shard_key) as upload:
+            if self.fmt == "csv":
+                for number, size in enumerate(self.sizes):
+                    if size:
+                        upload.copy(self.bucket, self.chunk_key(number), 0, size)
+            else:
+                writer = shard_format.FrameWriter(upload, self.fmt, self.compression)
+                for number in range(len(self.sizes)):
+                    body = self.s3_client.get_object(Bucket=self.bucket, Key=self.chunk_key(number))["Body"]
+                    writer.write(shard_format.read_frame(body, self.fmt))
+                writer.close()
+            return upload.close()
+
+    def clear(self):
+        """
+        Delete the cursor and the chunk objects
+        """
+        self._delete([self.chunk_key(number) for number in range(len(self.sizes))] + [self.cursor_key])
+        self.sizes = []
+        self.rows = 0
+
+    def _delete(self, keys):
+        for start in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]], "Quiet": True})
@@ -0,0 +1,77 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import csv
+import io
+
+###  Reading and writing of CSV shards with the standard csv module, for the
+###  process function's "csv" engine. Rows stay lists of strings from input
+###  to output, so a shard is enriched without importing pandas or NumPy.
+###  The cells of the input columns are written back as they came, except
+###  for missing values (NA_VALUES), which are written as empty cells like
+###  the pandas engine writes them.
+
+# cells pandas.read_csv reads as missing by default
+NA_VALUES = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+])
+
+
+def iter_chunks(body, chunk_rows=0):
+    """
+    Parse a CSV shard chunk_rows raw rows at a time. Column names are
+    title-cased, missing cells (NA_VALUES) become None, which encode writes
+    as empty cells, and rows with fewer than two values are dropped, as the
+    pandas engine does with rename(columns=str.title) and dropna(thresh=2).
+
+    Parameters
+    ----------
+    body: file-like object, required
+        Binary body of the shard
+    chunk_rows: int, optional
+        Raw rows per chunk; 0 reads the whole shard as one chunk
+
+    Returns
+    ------
+        generator: (column names, rows) per chunk; every row is a list with
+        one str or None per column
+    """
+    reader = csv.reader(io.TextIOWrapper(body, encoding="utf-8-sig", newline=""))
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [column.title() for column in header]
+    width = len(columns)
+    rows = []
+    read = 0
+    yielded = False
+    for row in reader:
+        read += 1
+        values = [None if value in NA_VALUES else value for value in row[:width]]
+        values.extend([None] * (width - len(values)))
+        if len(values) - values.count(None) >= 2:
+            rows.append(values)
+        if chunk_rows and read == chunk_rows:
+            yield columns, rows
+            yielded = True
+            rows = []
+            read = 0
+    if read or not yielded:
+        yield columns, rows
+
+
+def encode(columns, rows, header=True):
+    """
+    Write rows as CSV the way DataFrame.to_csv does (minimal quoting, "\\n"
+    line ends, None as an empty cell)
+
+    Returns
+    ------
+        bytes
+    """
+    with io.StringIO() as buffer:
+        writer = csv.writer(buffer, lineterminator="\n")
+        if header:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
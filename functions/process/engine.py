@@ -0,0 +1,200 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import percentile
+
+###  Bounded worker pool used by the process function to run cache reads,
+###  Location calls and cache writes concurrently, the adaptive limit that
+###  decides how many of those workers may call Location at once, and the
+###  hedging of slow calls (a duplicate request once a call takes longer
+###  than most recent ones). All are created once per container so warm
+###  invocations reuse them.
+
+
+class LookupEngine:
+    """
+    Runs lookups on a bounded pool of worker threads
+
+    Parameters
+    ----------
+    max_in_flight: int, required
+        Maximum number of lookups allowed to be in flight at the same time
+    """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="lookup"
+        )
+
+    def map(self, fn, items):
+        """
+        Apply fn to every item concurrently
+
+        Returns
+        ------
+            list: results of fn, in the same order as items
+        """
+        items = list(items)
+        if self.max_in_flight == 1 or len(items) < 2:
+            return [fn(item) for item in items]
+        futures = [self._executor.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD limit on concurrent calls to a rate-limited API
+
+    The limit grows by about one slot per round of successful calls and is
+    cut multiplicatively when a call is throttled, so the number of calls in
+    flight converges on what the API can sustain. Only one cut is applied
+    per round: calls that started before the latest cut do not cut again.
+
+    Parameters
+    ----------
+    initial: int, required
+        Starting limit
+    maximum: int, required
+        Upper bound, normally the size of the worker pool
+    minimum: int, optional
+        Lower bound
+    decrease: float, optional
+        Factor applied to the limit on throttling
+    """
+
+    def __init__(self, initial, maximum, minimum=1, decrease=0.5):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.decrease = decrease
+        self.limit = float(min(max(int(initial), self.minimum), self.maximum))
+        self.in_flight = 0
+        self._epoch = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot
+
+        Returns
+        ------
+            int: token to hand back to release
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._epoch
+
+    def try_acquire(self):
+        """
+        Take a free slot without waiting
+
+        Returns
+        ------
+            int: token to hand back to release, or None when every slot is taken
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, token, outcome):
+        """
+        Free a slot and adapt the limit
+
+        Parameters
+        ----------
+        token: int, required
+            Value returned by acquire
+        outcome: str, required
+            "success", "throttled" or anything else for a neutral outcome
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome == "throttled" and token == self._epoch:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._epoch += 1
+            self._condition.notify_all()
+
+
+class LatencyTracker:
+    """
+    Latencies of the most recent calls, from which the hedging delay is
+    derived
+
+    Parameters
+    ----------
+    window: int, optional
+        Number of recent calls kept
+    min_samples: int, optional
+        Calls needed before percentile answers
+    """
+
+    def __init__(self, window=500, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, share):
+        """
+        Returns
+        ------
+            float: the share (0-100) percentile in seconds, or None while
+            fewer than min_samples calls were seen
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = list(self._samples)
+        return percentile(samples, share)
+
+
+def hedged_call(executor, primary, start_hedge, delay):
+    """
+    Run primary on the executor and, if it has not finished after delay
+    seconds, a duplicate as well. The first call to succeed wins; the other
+    one runs to completion in the background and its result is dropped. An
+    error is only raised when both calls fail.
+
+    Parameters
+    ----------
+    executor: Executor, required
+        Pool the calls run on; must not be the pool of the caller
+    primary: function, required
+    start_hedge: function, required
+        Called in the caller's thread once the delay has passed; returns the
+        duplicate call, or None to keep waiting for primary alone
+    delay: float, required
+        Seconds to wait for primary before starting the duplicate
+
+    Returns
+    ------
+        tuple: (result of the winning call, True when the duplicate won)
+    """
+    futures = [executor.submit(primary)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        hedge = start_hedge()
+        if hedge is not None:
+            futures.append(executor.submit(hedge))
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # when both finished together the primary is preferred
+        for future in [future for future in futures if future in done]:
+            if future.exception() is None:
+                return future.result(), future is not futures[0]
+            error = error or future.exception()
+    raise error
@@ -0,0 +1,50 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import io
+import os
+
+import boto3
+
+import app
+from spatial_index import SpatialIndex
+
+###  This function scans the DynamoDB location cache, builds a spatial index
+###  over every cached place and writes it to S3, where the process function
+###  picks it up to answer reverse geocoding queries without calling Location.
+
+index_bucket = os.environ.get('SPATIAL_INDEX_BUCKET')
+index_key = os.environ.get('SPATIAL_INDEX_KEY')
+s3_client = boto3.client('s3')
+
+
+def scan_cached_places(table_name):
+    paginator = app.ddb_client.get_paginator("scan")
+    for page in paginator.paginate(TableName=table_name):
+        for item in page.get("Items", []):
+            yield app.item_to_location(item)
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function to export the cache as a spatial index
+
+    Parameters
+    ----------
+    event: dict, required
+        Optional "cell_degrees" overriding the index grid size
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+
+    Returns
+    ------
+        dict: location and size of the exported index
+    """
+    cell_degrees = float((event or {}).get("cell_degrees", 0.01))
+    index = SpatialIndex.from_places(scan_cached_places(app.ddb_table), cell_degrees=cell_degrees)
+    with io.BytesIO() as buffer:
+        index.save(buffer)
+        response = s3_client.put_object(Bucket=index_bucket, Key=index_key, Body=buffer.getvalue())
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    print(f"Exported {len(index)} places to s3://{index_bucket}/{index_key}. Status - {status}")
+    return {"Payload": {"bucket": index_bucket, "key": index_key, "places": len(index), "status": status}}
@@ -0,0 +1,136 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+###  Size-bounded LRU cache with a TTL, kept at module level by the process
+###  function so geocode results survive warm invocations of a container
+###  and hot keys are served from memory before DynamoDB is asked.
+
+# bytes an entry costs besides its key and value: the OrderedDict slot and
+# the (value, expiry, size) tuple, measured with tracemalloc on CPython
+ENTRY_OVERHEAD = 160
+
+
+def deep_size(value):
+    """
+    Memory held by a value and everything it contains, from sys.getsizeof
+    of each dict, list, tuple, str and number; strings shared between
+    entries are counted once per entry, which errs on the safe side
+
+    Returns
+    ------
+        int: bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+class LocationMemoryCache:
+    """
+    Thread-safe LRU cache of Location results
+
+    Parameters
+    ----------
+    max_entries: int, required
+        Maximum number of keys held; 0 disables the cache
+    max_bytes: int, required
+        Upper bound on the memory held by the entries, keys and values
+        included, as measured by deep_size
+    ttl_seconds: int, required
+        Seconds an entry stays valid after it was stored
+    clock: function, optional
+        Monotonic time source, replaced in tests
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds, clock=time.monotonic):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _estimate_size(key, value):
+        return ENTRY_OVERHEAD + deep_size(key) + deep_size(value)
+
+    def get(self, key):
+        """
+        Returns
+        ------
+            the cached value, or None when the key is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        """
+        Returns
+        ------
+            dict: key to cached value for every key found
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def put(self, key, value, ttl_seconds=None):
+        """
+        Store a value; values are shared with callers and must not be mutated.
+        ttl_seconds overrides the cache's TTL for this entry.
+        """
+        if self.max_entries == 0:
+            return
+        size = self._estimate_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+            self._entries[key] = (value, self.clock() + ttl, size)
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        value, expires_at, size = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
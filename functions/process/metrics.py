@@ -0,0 +1,149 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import json
+import random
+import threading
+import time
+
+###  Per-shard counters and latency samples, written to the function's log
+###  as one CloudWatch Embedded Metric Format (EMF) record per shard, so
+###  CloudWatch extracts the metrics without any API call. Also holds the
+###  level filter for the function's log lines.
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, share):
+    """
+    Linearly interpolated percentile (share in 0-100) of a list of numbers,
+    the same as numpy.percentile's default, without importing NumPy
+    """
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * share / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Log:
+    """
+    print() behind a level threshold
+
+    Parameters
+    ----------
+    level: str, optional
+        One of LOG_LEVELS; lines below it are dropped
+    """
+
+    def __init__(self, level="INFO"):
+        self.threshold = LOG_LEVELS.get(str(level).upper(), LOG_LEVELS["INFO"])
+
+    def enabled(self, level):
+        return LOG_LEVELS[level] >= self.threshold
+
+    def _print(self, level, args):
+        if LOG_LEVELS[level] >= self.threshold:
+            print(*args)
+
+    def debug(self, *args):
+        self._print("DEBUG", args)
+
+    def info(self, *args):
+        self._print("INFO", args)
+
+    def warning(self, *args):
+        self._print("WARNING", args)
+
+    def error(self, *args):
+        self._print("ERROR", args)
+
+
+class ShardMetrics:
+    """
+    Thread-safe counters and timings for one shard
+
+    Parameters
+    ----------
+    namespace: str, required
+        CloudWatch namespace of the metrics
+    dimensions: dict, optional
+        Dimension name -> value attached to every record
+    sample_rate: float, optional
+        Fraction of timings also written as their own EMF record (0 disables)
+    clock: function, optional
+        Wall clock in seconds, replaced in tests
+    """
+
+    def __init__(self, namespace, dimensions=None, sample_rate=0.0, clock=time.time):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.sample_rate = float(sample_rate)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+            self.started = self.clock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, milliseconds):
+        """
+        Add one latency sample (milliseconds) to the timing called name
+        """
+        with self._lock:
+            self.timings.setdefault(name, []).append(milliseconds)
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            print(json.dumps(self._record({name: (milliseconds, "Milliseconds")}, {"Sampled": True})))
+
+    def _record(self, values, properties):
+        record = {
+            "_aws": {
+                "Timestamp": int(self.clock() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (value, unit) in values.items()],
+                }],
+            },
+        }
+        record.update(self.dimensions)
+        record.update(properties)
+        record.update({name: value for name, (value, unit) in values.items()})
+        return record
+
+    def summary(self):
+        """
+        Counters, plus count and p50/p95/p99 of every timing
+
+        Returns
+        ------
+            dict: metric name -> (value, CloudWatch unit)
+        """
+        with self._lock:
+            values = {name: (value, "Count") for name, value in sorted(self.counters.items())}
+            for name, samples in sorted(self.timings.items()):
+                for share in PERCENTILES:
+                    values["{}P{}".format(name, share)] = (round(float(percentile(samples, share)), 3), "Milliseconds")
+                values["{}Count".format(name)] = (len(samples), "Count")
+        values["ShardSeconds"] = (round(self.clock() - self.started, 3), "Seconds")
+        return values
+
+    def emit(self, **properties):
+        """
+        Print the shard's EMF record; properties (for example the shard key)
+        are searchable in the log but are not dimensions
+
+        Returns
+        ------
+            dict: the record
+        """
+        record = self._record(self.summary(), properties)
+        print(json.dumps(record))
+        return record
@@ -0,0 +1,144 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+###  Compact result of one lookup and the step that turns a shard's unique
+###  results into its enrichment columns. A PlaceResult is built once per
+###  unique cache key; the per-row columns are then gathered in one NumPy
+###  take over the row -> unique key index instead of appended row by row.
+###  The csv engine uses csv_values instead and never loads NumPy or pandas.
+
+# enrichment columns in the order they are added to the shard
+ENRICHMENT_COLUMNS = [
+    "Points", "Country", "Latitude", "Longitude", "Label",
+    "Municipality", "Region", "SubRegion", "Zipcode",
+]
+# value written for a field the lookup did not return, as the CSV shards always have
+MISSING = 0
+
+_TEXT_FIELDS = {
+    "Country": "country",
+    "Label": "label",
+    "Municipality": "municipality",
+    "Region": "region",
+    "SubRegion": "sub_region",
+    "Zipcode": "postal_code",
+}
+
+
+class PlaceResult:
+    """
+    The fields of a Location "Place" that end up in the output. Missing
+    fields are None.
+    """
+
+    __slots__ = ("point", "country", "label", "postal_code", "municipality", "region", "sub_region")
+
+    def __init__(self, point=None, country=None, label=None, postal_code=None,
+                 municipality=None, region=None, sub_region=None):
+        self.point = point
+        self.country = country
+        self.label = label
+        self.postal_code = postal_code
+        self.municipality = municipality
+        self.region = region
+        self.sub_region = sub_region
+
+    @classmethod
+    def from_place(cls, place):
+        """
+        Build a result from a Location "Place" (or a cached copy of one);
+        an empty or failed lookup gives a result with every field missing
+        """
+        if not place:
+            return cls()
+        point = (place.get("Geometry") or {}).get("Point")
+        if not (isinstance(point, (list, tuple)) and len(point) >= 2):
+            point = None
+        return cls(
+            point=point,
+            country=place.get("Country"),
+            label=place.get("Label"),
+            postal_code=place.get("PostalCode"),
+            municipality=place.get("Municipality"),
+            region=place.get("Region"),
+            sub_region=place.get("SubRegion"),
+        )
+
+    @property
+    def found(self):
+        return self.point is not None
+
+    def csv_values(self):
+        """
+        The enrichment fields as the CSV cells the pandas engine writes for
+        them (MISSING for missing fields), in ENRICHMENT_COLUMNS order
+
+        Returns
+        ------
+            list: one str per enrichment column
+        """
+        missing = str(MISSING)
+        values = {
+            "Points": str(self.point) if self.found else missing,
+            "Latitude": repr(float(self.point[1])) if self.found else missing,
+            "Longitude": repr(float(self.point[0])) if self.found else missing,
+        }
+        for column, field in _TEXT_FIELDS.items():
+            value = getattr(self, field)
+            values[column] = missing if value is None else str(value)
+        return [values[column] for column in ENRICHMENT_COLUMNS]
+
+
+def _object_array(items):
+    import numpy as np
+    # element by element, so list values (points) are stored as objects rather than broadcast
+    array = np.empty(len(items), dtype=object)
+    for position, item in enumerate(items):
+        array[position] = item
+    return array
+
+
+def enrichment_columns(results, inverse, typed=False):
+    """
+    Materialize the enrichment columns for every row
+
+    Parameters
+    ----------
+    results: list, required
+        PlaceResult per unique cache key
+    inverse: sequence of int, required
+        Index into results for every row
+    typed: bool, optional
+        False writes MISSING (0) for missing fields, as the CSV shards
+        always have. True gives string columns, float coordinates and
+        missing values (NA / NaN / None) for typed Parquet shards.
+
+    Returns
+    ------
+        dict: column name -> array with one value per row
+    """
+    import numpy as np
+    import pandas as pd
+    inverse = np.asarray(inverse, dtype=np.intp)
+    missing = None if typed else MISSING
+    unique = {
+        "Points": [result.point if result.found else missing for result in results],
+        "Longitude": [result.point[0] if result.found else missing for result in results],
+        "Latitude": [result.point[1] if result.found else missing for result in results],
+    }
+    for column, field in _TEXT_FIELDS.items():
+        unique[column] = [getattr(result, field) for result in results]
+        if not typed:
+            unique[column] = [MISSING if value is None else value for value in unique[column]]
+    columns = {}
+    for column in ENRICHMENT_COLUMNS:
+        values = _object_array(unique[column])[inverse]
+        if not typed:
+            # plain lists let pandas infer the column types as it did for the row-by-row appends
+            columns[column] = values.tolist()
+        elif column in _TEXT_FIELDS:
+            columns[column] = pd.array(values, dtype="string")
+        elif column in ("Longitude", "Latitude"):
+            columns[column] = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=np.float64)
+        else:
+            columns[column] = values
+    return columns
@@ -0,0 +1,183 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import json
+import os
+import time
+
+import boto3
+import botocore.exceptions
+
+import app
+import csv_engine
+from checkpoint import CHECKPOINT_PREFIX
+
+###  This function warms the DynamoDB location cache from a list of known
+###  addresses (Address, City, State columns) or coordinates (Latitude and
+###  Longitude columns), such as a customer master list. It geocodes only the
+###  keys missing from the cache, spends at most PREWARM_MAX_CALLS Location
+###  calls per pass and writes the results in the cache's record format, so
+###  later jobs are answered from the cache. Progress is kept in S3, so an
+###  invocation that stops (time or budget) is resumed by the next one.
+
+prewarm_bucket = os.environ.get('PREWARM_BUCKET')
+prewarm_key = os.environ.get('PREWARM_KEY', 'prewarm/locations.csv')
+# Location calls allowed per pass over the file; a pass that runs out continues in the next pass
+prewarm_max_calls = int(os.environ.get('PREWARM_MAX_CALLS', '1000'))
+# rows read, checked against the cache and saved in the progress at a time
+prewarm_chunk_rows = int(os.environ.get('PREWARM_CHUNK_ROWS', '1000'))
+# a new pass (and a new call budget) starts this long after the previous one started
+prewarm_interval_hours = float(os.environ.get('PREWARM_INTERVAL_HOURS', '20'))
+PROGRESS_PREFIX = CHECKPOINT_PREFIX + "prewarm/"
+s3_client = boto3.client('s3')
+
+
+def progress_key(key):
+    return(PROGRESS_PREFIX + key + ".json")
+
+
+def load_progress(bucket, key, etag, now):
+    """
+    Read the progress of the warm-up of an input file. Progress saved for
+    another version of the file or another chunk size is ignored. Once the
+    pass interval is over a new pass starts: the call budget is reset and a
+    completed file is read again from the start.
+
+    Returns
+    ------
+        dict: chunks done, calls spent in the pass and when the pass started
+    """
+    fresh = {"etag": etag, "chunk_rows": prewarm_chunk_rows, "chunks": 0, "calls": 0,
+             "pass_started": now, "complete": False}
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=progress_key(key))
+        progress = json.loads(response["Body"].read())
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return(fresh)
+        raise
+    if progress.get("etag") != etag or progress.get("chunk_rows") != prewarm_chunk_rows:
+        return(fresh)
+    if now - progress["pass_started"] >= prewarm_interval_hours * 3600:
+        progress.update(calls=0, pass_started=now)
+        if progress["complete"]:
+            progress.update(chunks=0, complete=False)
+    return(progress)
+
+
+def save_progress(bucket, key, progress):
+    s3_client.put_object(Bucket=bucket, Key=progress_key(key), Body=json.dumps(progress).encode("utf-8"))
+
+
+def warm_chunk(columns, rows, max_calls):
+    """
+    Geocode the keys of one chunk that are missing from the cache, at most
+    max_calls of them, and write the results to the cache
+
+    Returns
+    ------
+        dict: unique keys, keys already cached, Location calls, records
+        written and missing keys left for want of budget
+    """
+    lookups, lookup = app.row_lookups(columns, rows)
+    if lookup is None:
+        raise ValueError("Expected Address, City and State or Latitude and Longitude columns, got {}".format(columns))
+    unique_lookups, _ = app.dedupe_lookups(lookups)
+    queries = dict(unique_lookups)
+    cached = {
+        primary_key
+        for primary_key, place in app.batch_get_locations_from_cache(app.ddb_table, list(queries)).items()
+        if app.cached_place_matches(primary_key, queries[primary_key], place)
+    }
+    missing = [(primary_key, query) for primary_key, query in unique_lookups if primary_key not in cached]
+    calls = missing[:max(0, max_calls)]
+    places = app.lookup_engine.map(lambda item: app.lookup_location(item[1], lookup), calls)
+    reverse = lookup is app.get_location_for_position
+    records = [
+        record for record in (
+            app.store_lookup_result(primary_key, query, place, reverse)
+            for (primary_key, query), place in zip(calls, places))
+        if record is not None
+    ]
+    if records and not app.batch_write_locations_to_cache(app.ddb_table, records):
+        raise RuntimeError("Cannot write {} warmed locations to the cache".format(len(records)))
+    return({"keys": len(unique_lookups), "cached": len(cached), "calls": len(calls),
+            "written": len(records), "deferred": len(missing) - len(calls)})
+
+
+def warm(body, bucket, key, progress, max_calls, context):
+    """
+    Walk the input file chunk by chunk from the saved progress until it is
+    done, the pass's call budget is spent or the invocation's time is short
+
+    Returns
+    ------
+        str: "complete", "budget spent" or "paused"
+    """
+    slowest = 0.0
+    for chunk_number, (columns, rows) in enumerate(csv_engine.iter_chunks(body, prewarm_chunk_rows)):
+        if chunk_number < progress["chunks"]:
+            continue
+        if progress["calls"] >= max_calls:
+            return("budget spent")
+        if context is not None:
+            remaining = context.get_remaining_time_in_millis() / 1000
+            if remaining < max(app.checkpoint_safety_seconds, 2 * slowest):
+                return("paused")
+        started = time.perf_counter()
+        try:
+            stats = warm_chunk(columns, rows, max_calls - progress["calls"])
+        except RuntimeError:
+            # calls already made still count against the budget
+            save_progress(bucket, key, progress)
+            raise
+        slowest = max(slowest, time.perf_counter() - started)
+        progress["calls"] += stats["calls"]
+        for name in ("keys", "cached", "written"):
+            app.shard_metrics.increment("Prewarm" + name.title(), stats[name])
+        app.shard_metrics.increment("PrewarmCalls", stats["calls"])
+        if stats["deferred"]:
+            # the chunk is read again by the next pass; its warmed keys are cache hits by then
+            save_progress(bucket, key, progress)
+            return("budget spent")
+        progress["chunks"] = chunk_number + 1
+        save_progress(bucket, key, progress)
+        app.log.info("Warmed chunk {}: {} keys, {} cached, {} looked up ({} calls this pass)".format(
+            chunk_number + 1, stats["keys"], stats["cached"], stats["calls"], progress["calls"]))
+    progress["complete"] = True
+    save_progress(bucket, key, progress)
+    return("complete")
+
+
+def lambda_handler(event, context):
+    """
+    Lambda function to warm the location cache from a file in S3
+
+    Parameters
+    ----------
+    event: dict, required
+        Optional "bucket", "key" and "max_calls" overriding PREWARM_BUCKET,
+        PREWARM_KEY and PREWARM_MAX_CALLS
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+
+    Returns
+    ------
+        dict: "Payload" with the status of the pass, chunks done and calls spent
+    """
+    event = event or {}
+    bucket = event.get("bucket", prewarm_bucket)
+    key = event.get("key", prewarm_key)
+    max_calls = int(event.get("max_calls", prewarm_max_calls))
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    progress = load_progress(bucket, key, response.get("ETag", ""), time.time())
+    app.shard_metrics.reset()
+    try:
+        if progress["complete"]:
+            status = "complete"
+        else:
+            status = warm(response["Body"], bucket, key, progress, max_calls, context)
+    finally:
+        app.shard_metrics.emit(Prewarm=key)
+    print(f"Cache warm-up of s3://{bucket}/{key}: {status} after {progress['chunks']} chunks, {progress['calls']} calls this pass")
+    return({"Payload": {"key": key, "status": status, "chunks": progress["chunks"], "calls": progress["calls"]}})
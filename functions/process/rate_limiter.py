@@ -0,0 +1,148 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import random
+import threading
+import time
+
+###  Rate limiters for Amazon Location calls. Every process invocation
+###  acquires a token before calling Location so the whole Map state stays
+###  just under the account's requests-per-second quota, instead of finding
+###  the limit through ThrottlingException.
+
+
+class LocalTokenBucket:
+    """
+    In-process token bucket, used in tests and when no shared table is configured
+
+    Parameters
+    ----------
+    rate: float, required
+        Tokens added per second; 0 disables limiting
+    burst: float, optional
+        Bucket capacity, defaults to one second of tokens
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, self.rate))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available and take them
+
+        Returns
+        ------
+            float: seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # tolerate float rounding left over from the refill arithmetic
+                if self._tokens >= tokens - 1e-9:
+                    self._tokens = max(0.0, self._tokens - tokens)
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+
+class DynamoDBTokenBucket:
+    """
+    Token bucket shared by every invocation through a DynamoDB table
+
+    Each second has its own counter item ("<name>#<epoch second>"). An
+    invocation leases a block of tokens with a conditional ADD that only
+    succeeds while the second's total stays within the rate, then hands the
+    block out locally. Leases expire with the second they were taken in.
+
+    Parameters
+    ----------
+    ddb_client: botocore client, required
+    table_name: str, required
+        Table with a string "id" hash key and TTL on "ttl"
+    name: str, required
+        Name of the budget, so several budgets can share the table
+    rate: int, required
+        Calls per second allowed across all invocations; 0 disables limiting
+    lease_size: int, optional
+        Tokens taken per DynamoDB round trip
+    """
+
+    def __init__(self, ddb_client, table_name, name, rate, lease_size=5, clock=time.time, sleep=time.sleep):
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+        self.name = name
+        self.rate = int(rate)
+        self.lease_size = max(1, min(int(lease_size), self.rate or 1))
+        self.clock = clock
+        self.sleep = sleep
+        self._window = None
+        self._leased = 0
+        self._lock = threading.Lock()
+
+    def _lease(self, window):
+        try:
+            self.ddb_client.update_item(
+                TableName=self.table_name,
+                Key={"id": {"S": "{}#{}".format(self.name, window)}},
+                UpdateExpression="ADD #used :lease SET #ttl = :ttl",
+                ConditionExpression="attribute_not_exists(#used) OR #used <= :max",
+                ExpressionAttributeNames={"#used": "used", "#ttl": "ttl"},
+                ExpressionAttributeValues={
+                    ":lease": {"N": str(self.lease_size)},
+                    ":max": {"N": str(self.rate - self.lease_size)},
+                    ":ttl": {"N": str(window + 300)},
+                })
+            return True
+        except self.ddb_client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def acquire(self, tokens=1):
+        """
+        Block until the shared budget has room and take tokens from it
+
+        Returns
+        ------
+            float: seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            # only the local lease is guarded; the DynamoDB round trip and the
+            # wait happen outside the lock so other threads keep spending tokens
+            with self._lock:
+                now = self.clock()
+                window = int(now)
+                if window != self._window:
+                    self._window = window
+                    self._leased = 0
+                if self._leased >= tokens:
+                    self._leased -= tokens
+                    return waited
+            try:
+                leased = self._lease(window)
+            except Exception as e:
+                # the budget is an optimization; never stall the shard on it
+                print({"error":"cannot lease from rate limit table", "exception":str(e)})
+                return waited
+            if leased:
+                with self._lock:
+                    # a lease taken for a second that has since ended has expired with it
+                    if self._window == window:
+                        self._leased += self.lease_size
+                continue
+            # this second's budget is spent; wait for the next one, spreading the restart
+            delay = (window + 1 - now) + random.uniform(0, 0.05)
+            self.sleep(delay)
+            waited += delay
@@ -0,0 +1,165 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import io
+import math
+
+import numpy as np
+
+###  Compact nearest-neighbour index over cached places. The export handler
+###  (export_index.py) builds it from the DynamoDB cache and stores it in S3;
+###  the process function loads it once per container and answers reverse
+###  geocoding queries within a radius locally before calling Location.
+
+FORMAT_VERSION = 1
+PLACE_FIELDS = ("Label", "Country", "PostalCode", "Municipality", "Region", "SubRegion")
+METERS_PER_DEGREE = 111195.0
+
+
+def _encode_strings(values):
+    """
+    Dictionary-encode strings into (codes, utf-8 blob, offsets) arrays
+    """
+    vocabulary, codes = np.unique(np.array([str(value) for value in values], dtype=object), return_inverse=True)
+    encoded = [value.encode("utf-8") for value in vocabulary]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return codes.astype(np.int32), blob, offsets
+
+
+class SpatialIndex:
+    """
+    Places bucketed by a regular latitude/longitude grid
+
+    Parameters
+    ----------
+    longitudes, latitudes: numpy.ndarray, required
+        Point of every place, sorted by grid cell
+    cells: numpy.ndarray, required
+        Sorted grid cell id of every place
+    cell_degrees: float, required
+        Size of a grid cell in degrees
+    fields: dict, required
+        Field name to (codes, blob, offsets) as built by _encode_strings
+    """
+
+    def __init__(self, longitudes, latitudes, cells, cell_degrees, fields):
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.cells = cells
+        self.cell_degrees = float(cell_degrees)
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.cells)
+
+    @staticmethod
+    def _cell_ids(longitudes, latitudes, cell_degrees):
+        columns = int(math.ceil(360.0 / cell_degrees))
+        rows = np.floor((np.asarray(latitudes) + 90.0) / cell_degrees).astype(np.int64)
+        cols = np.floor((np.asarray(longitudes) + 180.0) / cell_degrees).astype(np.int64) % columns
+        return rows * columns + cols
+
+    @classmethod
+    def from_places(cls, places, cell_degrees=0.01):
+        """
+        Build an index from Location places that carry a Geometry Point
+        """
+        points = []
+        kept = []
+        for place in places:
+            try:
+                longitude, latitude = (float(value) for value in place["Geometry"]["Point"][:2])
+            except Exception:
+                continue
+            if longitude == 0 and latitude == 0:
+                continue
+            points.append((longitude, latitude))
+            kept.append(place)
+        points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        cells = cls._cell_ids(points[:, 0], points[:, 1], cell_degrees)
+        order = np.argsort(cells, kind="stable")
+        fields = {
+            field: _encode_strings([kept[i].get(field, "0") for i in order])
+            for field in PLACE_FIELDS
+        }
+        return cls(points[order, 0], points[order, 1], cells[order], cell_degrees, fields)
+
+    def save(self, fileobj):
+        arrays = {
+            "version": np.array([FORMAT_VERSION]),
+            "cell_degrees": np.array([self.cell_degrees]),
+            "longitudes": self.longitudes,
+            "latitudes": self.latitudes,
+            "cells": self.cells,
+        }
+        for field, (codes, blob, offsets) in self.fields.items():
+            arrays[field + "_codes"] = codes
+            arrays[field + "_blob"] = blob
+            arrays[field + "_offsets"] = offsets
+        np.savez_compressed(fileobj, **arrays)
+
+    @classmethod
+    def load(cls, fileobj):
+        if not hasattr(fileobj, "seek"):
+            fileobj = io.BytesIO(fileobj.read())
+        with np.load(fileobj, allow_pickle=False) as arrays:
+            if int(arrays["version"][0]) != FORMAT_VERSION:
+                raise ValueError("Unsupported spatial index version {}".format(int(arrays["version"][0])))
+            fields = {
+                field: (arrays[field + "_codes"], arrays[field + "_blob"], arrays[field + "_offsets"])
+                for field in PLACE_FIELDS
+            }
+            return cls(arrays["longitudes"], arrays["latitudes"], arrays["cells"],
+                       float(arrays["cell_degrees"][0]), fields)
+
+    def _field(self, field, position):
+        codes, blob, offsets = self.fields[field]
+        code = codes[position]
+        return blob[offsets[code]:offsets[code + 1]].tobytes().decode("utf-8")
+
+    def place(self, position):
+        place = {field: self._field(field, position) for field in PLACE_FIELDS}
+        place["Geometry"] = {"Point": [float(self.longitudes[position]), float(self.latitudes[position])]}
+        return place
+
+    def nearest(self, longitude, latitude, radius_m):
+        """
+        Closest indexed place within radius_m of the point
+
+        Returns
+        ------
+            tuple: (place dict, distance in meters), or None when nothing is in range
+        """
+        if len(self) == 0:
+            return None
+        lat_span = radius_m / METERS_PER_DEGREE
+        lon_span = lat_span / max(math.cos(math.radians(latitude)), 1e-6)
+        rows = range(int(math.floor((latitude - lat_span + 90.0) / self.cell_degrees)),
+                     int(math.floor((latitude + lat_span + 90.0) / self.cell_degrees)) + 1)
+        cols = range(int(math.floor((longitude - lon_span + 180.0) / self.cell_degrees)),
+                     int(math.floor((longitude + lon_span + 180.0) / self.cell_degrees)) + 1)
+        columns = int(math.ceil(360.0 / self.cell_degrees))
+        if len(cols) > columns:
+            cols = range(columns)
+        candidates = []
+        for row in rows:
+            for col in cols:
+                cell = row * columns + col % columns
+                start = np.searchsorted(self.cells, cell, side="left")
+                end = np.searchsorted(self.cells, cell, side="right")
+                if end > start:
+                    candidates.append(np.arange(start, end))
+        if not candidates:
+            return None
+        candidates = np.concatenate(candidates)
+        phi_1 = math.radians(latitude)
+        phi_2 = np.radians(self.latitudes[candidates])
+        d_phi = phi_2 - phi_1
+        d_lambda = np.radians(self.longitudes[candidates] - longitude)
+        a = np.sin(d_phi / 2) ** 2 + math.cos(phi_1) * np.cos(phi_2) * np.sin(d_lambda / 2) ** 2
+        distances = 2 * 6371008.8 * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+        best = int(np.argmin(distances))
+        if distances[best] > radius_m:
+            return None
+        return self.place(int(candidates[best])), float(distances[best])
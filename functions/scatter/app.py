@@ -9,15 +9,308 @@ import numpy as np
 import urllib.parse
 import os
 import time
+import zlib
+import math
+import random
+
+import geokeys
+import shard_format
 
 ###  This function gets .csv file from an "input" bucket,
 ###  then splits the file into shards of equal size,
 ###  renames the files, and puts them into a "raw" bucket
 
 destination_bucket = os.environ.get('RAW_SHARDS_BUCKET')
+# "range" splits the file into contiguous runs of rows, "key" routes every row with the
+# same lookup key to the same shard so no two shards pay for the same address
+shard_partitioning = os.environ.get('SHARD_PARTITIONING', 'range')
+# must match the process function so positions sharing a cache entry share a shard
+reverse_cache_mode = os.environ.get('REVERSE_CACHE_MODE', 'exact')
+geohash_precision = int(os.environ.get('GEOHASH_PRECISION', '8'))
+# "pandas" parses the whole file and writes shard objects, "range" only finds
+# line-aligned byte ranges and lets the process function read them from the input object
+scatter_mode = os.environ.get('SCATTER_MODE', 'pandas')
+# in "range" mode, aim for shards of about this many bytes; 0 lets the shard planner decide
+shard_target_bytes = int(os.environ.get('SHARD_TARGET_BYTES', '0'))
+# encoding of the raw shards written in "pandas" mode: "csv" or "parquet"
+intermediate_format = shard_format.check_format(os.environ.get('INTERMEDIATE_FORMAT', 'csv'))
+parquet_compression = os.environ.get('PARQUET_COMPRESSION', shard_format.DEFAULT_COMPRESSION)
+# shard planner inputs: the cache to sample, the per-shard time budget and the
+# Location budget / per-shard concurrency the process function runs with
+ddb_table = os.environ.get("DDB_TABLE_NAME")
+shard_time_budget_seconds = float(os.environ.get('SHARD_TIME_BUDGET_SECONDS', '600'))
+location_rate_limit = float(os.environ.get('LOCATION_RATE_LIMIT', '45'))
+max_in_flight = int(os.environ.get('MAX_IN_FLIGHT', '10'))
+map_max_concurrency = int(os.environ.get('MAP_MAX_CONCURRENCY', '100'))
+max_shards = int(os.environ.get('MAX_SHARDS', '1000'))
+# "inline" returns the shard list in the payload, "manifest" writes it to S3 as JSON Lines for the
+# distributed Map state to read, "auto" does so only when the list would not fit in the payload
+shard_hand_off = os.environ.get('SHARD_HAND_OFF', 'inline')
+manifest_bucket = os.environ.get('MANIFEST_BUCKET', destination_bucket)
 s3_client = boto3.client('s3')
+ddb_client = boto3.client('dynamodb')
 lambda_client = boto3.client('lambda')
 
+# planner cost model: seconds of local work per row, and observed Location round trip
+ROW_SECONDS = 0.002
+LOCATION_CALL_SECONDS = 0.15
+# unique keys checked against the cache to estimate the miss ratio
+SAMPLE_KEYS = 100
+# bytes fetched per ranged GET while looking for a line break
+PROBE_BYTES = 64 * 1024
+
+# column carrying the original row position when shards are partitioned by key
+ROW_ORDER_COLUMN = "_Row_Order"
+# shard manifests are written under this prefix of MANIFEST_BUCKET
+MANIFEST_PREFIX = "manifests/"
+# in "auto" hand-off, larger shard lists go to a manifest; Step Functions payloads are limited to 256 KiB
+INLINE_PAYLOAD_MAX_BYTES = 200 * 1024
+
+
+def lookup_keys(df):
+    """
+    Build the process function's cache key for every row, or None when the
+    dataset has neither position nor address columns
+    """
+    titled = df.rename(columns=str.title)
+    columns = titled.columns
+    if "Latitude" in columns and "Longitude" in columns:
+        if reverse_cache_mode == "geohash":
+            return [
+                geokeys.cell_key(longitude, latitude, geohash_precision)
+                for longitude, latitude in zip(titled["Longitude"], titled["Latitude"])
+            ]
+        return [
+            geokeys.position_key(longitude, latitude)
+            for longitude, latitude in zip(titled["Longitude"], titled["Latitude"])
+        ]
+    elif "Address" in columns:
+        return [
+            geokeys.address_key(address, city, state)
+            for address, city, state in zip(titled["Address"], titled["City"], titled["State"])
+        ]
+    return None
+
+
+def split_by_key(df, number_of_shards, keys):
+    """
+    Split the dataset so rows sharing a lookup key always land in the same
+    shard. The original row order is kept in ROW_ORDER_COLUMN for the gather step.
+
+    Parameters
+    ----------
+    df: DataFrame, required
+    number_of_shards: int, required
+    keys: list, required
+        lookup_keys of df, or None to split by position
+
+    Returns
+    ------
+        list: number_of_shards DataFrames
+    """
+    if keys is None:
+        return [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), number_of_shards)]
+    df = df.assign(**{ROW_ORDER_COLUMN: np.arange(len(df))})
+    shard_ids = np.array([zlib.crc32(key.encode()) % number_of_shards for key in keys])
+    return [df[shard_ids == shard_id] for shard_id in range(number_of_shards)]
+
+
+def sample_miss_ratio(keys):
+    """
+    Estimate the share of unique keys missing from the cache by looking up
+    a random sample of them (keys only) with BatchGetItem
+
+    Returns
+    ------
+        float: estimated miss ratio, 1.0 when the cache cannot be sampled
+    """
+    unique_keys = list(dict.fromkeys(keys))
+    if not unique_keys or not ddb_table:
+        return 1.0
+    sample = random.Random(0).sample(unique_keys, min(SAMPLE_KEYS, len(unique_keys)))
+    try:
+        response = ddb_client.batch_get_item(RequestItems={ddb_table: {
+            "Keys": [{"id": {"S": key}} for key in sample],
+            "ProjectionExpression": "id",
+        }})
+    except Exception as e:
+        print({"error":"cannot sample cache", "exception":str(e)})
+        return 1.0
+    unprocessed = len(response.get("UnprocessedKeys", {}).get(ddb_table, {}).get("Keys", []))
+    checked = len(sample) - unprocessed
+    if checked == 0:
+        return 1.0
+    found = len(response.get("Responses", {}).get(ddb_table, []))
+    return (checked - found) / checked
+
+
+def plan_shards(rows, unique_keys, miss_ratio):
+    """
+    Choose the number of shards so each one finishes within the time budget
+
+    Shards share the Location rate limit while they run together (up to the
+    Map state's MaxConcurrency), and each shard can only keep MAX_IN_FLIGHT
+    calls going. The plan takes the fewest shards (fewest cold starts) whose
+    estimated duration fits the budget, but enough to use the whole rate
+    limit when there are many calls to make.
+
+    Returns
+    ------
+        dict: the plan, reported in the scatter output
+    """
+    location_calls = unique_keys * miss_ratio
+    per_shard_rate = max_in_flight / LOCATION_CALL_SECONDS
+
+    def shard_seconds(number_of_shards):
+        concurrent = min(number_of_shards, map_max_concurrency)
+        rate = min(location_rate_limit / concurrent, per_shard_rate) if location_rate_limit > 0 else per_shard_rate
+        return (rows * ROW_SECONDS + location_calls / rate) / number_of_shards
+
+    # enough shards to saturate the rate limit, once the calls take longer than a single budget
+    saturating = 1
+    if location_rate_limit > 0 and location_calls / location_rate_limit > shard_time_budget_seconds:
+        saturating = int(math.ceil(location_rate_limit / per_shard_rate))
+    number_of_shards = max(1, min(saturating, max_shards, max(1, rows)))
+    while number_of_shards < min(max_shards, max(1, rows)) and shard_seconds(number_of_shards) > shard_time_budget_seconds:
+        number_of_shards += 1
+    plan = {
+        "shards": number_of_shards,
+        "rows": int(rows),
+        "unique_keys": int(unique_keys),
+        "miss_ratio": round(miss_ratio, 3),
+        "expected_location_calls": int(round(location_calls)),
+        "rows_per_shard": int(math.ceil(rows / number_of_shards)),
+        "estimated_shard_seconds": round(shard_seconds(number_of_shards), 1),
+        "time_budget_seconds": shard_time_budget_seconds,
+    }
+    print("Shard plan: {}".format(json.dumps(plan)))
+    return plan
+
+
+def plan_for_frame(df, keys):
+    if keys is None:
+        return plan_shards(len(df), len(df), 1.0)
+    return plan_shards(len(df), len(set(keys)), sample_miss_ratio(keys))
+
+
+def find_line_end(bucket, key, offset, size):
+    """
+    Offset just past the first line break at or after offset, found with
+    ranged GETs so the object is never downloaded whole
+
+    Returns
+    ------
+        int: offset of the next line start, or size when there is none
+    """
+    probe = PROBE_BYTES
+    while offset < size:
+        end = min(size, offset + probe) - 1
+        body = s3_client.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(offset, end))["Body"].read()
+        newline = body.find(b"\n")
+        if newline >= 0:
+            return offset + newline + 1
+        offset = end + 1
+        probe *= 2
+    return size
+
+
+def scatter_by_byte_range(source_bucket, source_object):
+    """
+    Describe shards as line-aligned byte ranges of the input object instead
+    of writing shard objects. Each descriptor carries the CSV header so a
+    shard can be parsed on its own. Rows must not contain quoted line breaks.
+    The shard count comes from SHARD_TARGET_BYTES when set, otherwise from
+    the shard planner run on a sample of the file.
+
+    Returns
+    ------
+        tuple: (shard descriptors for the Map state, shard plan or None)
+    """
+    number_of_shards = 1
+    size = s3_client.head_object(Bucket=source_bucket, Key=source_object)["ContentLength"]
+    data_start = find_line_end(source_bucket, source_object, 0, size)
+    header = s3_client.get_object(
+        Bucket=source_bucket, Key=source_object, Range="bytes=0-{}".format(data_start - 1)
+    )["Body"].read().decode("utf-8")
+    data_size = size - data_start
+    plan = None
+    if shard_target_bytes > 0:
+        number_of_shards = max(1, -(-data_size // shard_target_bytes))
+    elif data_size > 0:
+        plan = plan_from_sample(source_bucket, source_object, header, data_start, size)
+        number_of_shards = plan["shards"]
+    boundaries = [data_start]
+    for i in range(1, number_of_shards):
+        target = data_start + (data_size * i) // number_of_shards
+        boundary = find_line_end(source_bucket, source_object, max(target, boundaries[-1]), size)
+        if boundary >= size:
+            break
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(size)
+
+    shards = []
+    for count, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]), start=1):
+        if end <= start and shards:
+            continue
+        number_label = "LAST" if end == size else str(count)
+        shards.append({
+            'bucket': source_bucket,
+            'shard': source_object[:-4] + "_SHARD_" + number_label + ".csv",
+            'source': source_object,
+            'start': start,
+            'end': end - 1,
+            'header': header,
+        })
+    print("Described {} byte-range shards of {} ({} bytes)".format(len(shards), source_object, size))
+    return shards, plan
+
+
+def plan_from_sample(source_bucket, source_object, header, data_start, size):
+    """
+    Plan a byte-range scatter from the first rows of the file: the row count
+    is extrapolated from their average length, and unique keys and the miss
+    ratio from their keys
+    """
+    end = min(size, data_start + PROBE_BYTES) - 1
+    body = s3_client.get_object(
+        Bucket=source_bucket, Key=source_object, Range="bytes={}-{}".format(data_start, end))["Body"].read()
+    if end < size - 1:
+        body = body[:body.rfind(b"\n") + 1]
+    sample = pd.read_csv(io.BytesIO(header.encode("utf-8") + body))
+    if len(sample) == 0:
+        return plan_shards(1, 1, 1.0)
+    rows = (size - data_start) * len(sample) / max(1, len(body))
+    keys = lookup_keys(sample)
+    if keys is None:
+        return plan_shards(rows, rows, 1.0)
+    unique_ratio = len(set(keys)) / len(sample)
+    return plan_shards(rows, rows * unique_ratio, sample_miss_ratio(keys))
+
+
+def hand_off(shards, plan, source_object):
+    """
+    Build the scatter output. Inline, the Map state iterates "Shards". With
+    a manifest, the shard descriptors are written to S3 one JSON object per
+    line and the output only names the manifest under "Manifest"; the
+    distributed Map state reads the items from it and the gather function
+    reads the shard list from it, so the shard count is not bound by the
+    payload size.
+
+    Returns
+    ------
+        dict: the "Payload" of the scatter function
+    """
+    payload = {'Shards': shards, 'Plan': plan}
+    if shard_hand_off == "inline" or (
+            shard_hand_off == "auto" and len(json.dumps(payload)) <= INLINE_PAYLOAD_MAX_BYTES):
+        return payload
+    key = MANIFEST_PREFIX + source_object[:-4] + "/shards.jsonl"
+    body = "".join(json.dumps(shard) + "\n" for shard in shards).encode("utf-8")
+    s3_client.put_object(Bucket=manifest_bucket, Key=key, Body=body)
+    print("Wrote a manifest of {} shards to s3://{}/{}".format(len(shards), manifest_bucket, key))
+    return {'Manifest': {'bucket': manifest_bucket, 'key': key, 'shards': len(shards)}, 'Plan': plan}
+
 
 def lambda_handler(event, context):
     """
@@ -38,66 +331,72 @@ def lambda_handler(event, context):
     source_bucket = event['Payload']['detail']['bucket']['name']
     source_object = event['Payload']['detail']['object']['key']
 
-    if source_object.endswith(".csv"):
+    if source_object.endswith(".csv") and scatter_mode == "range":
+        shards, plan = scatter_by_byte_range(source_bucket, source_object)
+        return({'Payload': hand_off(shards, plan, source_object)})
+    elif source_object.endswith(".csv"):
         
         response = s3_client.get_object(Bucket=source_bucket, Key=source_object)
         data = pd.read_csv(response.get("Body"))
         df = data.dropna(thresh=2)
 
-        # break up the dataset into x number of shards (to avoid the default 50 Request Per Second API Throtling restrictions for AWS Location Service, this is left at 4)
-        data_set_size = round(len(df))
-        number_of_shards = 10
-        shard_length = int(data_set_size / number_of_shards)
-        shards = np.array_split(df, number_of_shards)
+        # break up the dataset into as many shards as the planner needs to finish each one within the time budget
+        keys = lookup_keys(df)
+        plan = plan_for_frame(df, keys)
+        number_of_shards = plan["shards"]
+        if shard_partitioning == "key":
+            shards = split_by_key(df, number_of_shards, keys)
+        else:
+            shards = [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), number_of_shards)]
 
         # using a for loop, take each data shard and write it individually to s3 with a unique suffix identifier of "_SHARD_X"
         count = 0
         response_lambda = {}
         response_lambda['Payload']={}
         response_lambda['Payload']['Shards']=[]
+        response_lambda['Payload']['Plan']=plan
         # response_lambda['Payload']['Bucket']=destination_bucket
 
+        shard_extension = shard_format.EXTENSIONS[intermediate_format]
         for i in shards:
             if count < (number_of_shards-1):
-                with io.StringIO() as csv_buffer:
-                    shards[count].to_csv(csv_buffer, index=False)
-                    count += 1  
-                    number_label = str(count)
-                    shard = source_object[:-4] + "_SHARD_" + number_label + ".csv"
-                    response = s3_client.put_object(
-                        Bucket=destination_bucket, Key=shard,
-                        Body=csv_buffer.getvalue()
-                    )
-                    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-                    if status == 200:
-                        print(f"Successful S3 put_object response. Status - {status}")
-                    else:
-                        print(f"Unsuccessful S3 put_object response. Status - {status}")
-                    
-                    print(shard)
-                    print(response_lambda['Payload']['Shards'])
-                    item = {'bucket': destination_bucket, 'shard': shard}
-                    response_lambda['Payload']['Shards'].append(item)
+                body = shard_format.write_frame(shards[count], intermediate_format, parquet_compression)
+                count += 1  
+                number_label = str(count)
+                shard = source_object[:-4] + "_SHARD_" + number_label + shard_extension
+                response = s3_client.put_object(
+                    Bucket=destination_bucket, Key=shard,
+                    Body=body
+                )
+                status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                if status == 200:
+                    print(f"Successful S3 put_object response. Status - {status}")
+                else:
+                    print(f"Unsuccessful S3 put_object response. Status - {status}")
+                
+                print(shard)
+                item = {'bucket': destination_bucket, 'shard': shard}
+                response_lambda['Payload']['Shards'].append(item)
                 print(number_of_shards)
                 print(count)
             # Take the last shard and write it to S3 with a unique suffix identifier of "_SHARD_LAST"
             else:
-                with io.StringIO() as csv_buffer:
-                    shards[-1].to_csv(csv_buffer, index=False)
-                    shard = source_object[:-4] + "_SHARD_" + "LAST" + ".csv"
-                    response = s3_client.put_object(
-                        Bucket=destination_bucket, Key=source_object[:-4] + "_SHARD_" + "LAST" + ".csv",
-                        Body=csv_buffer.getvalue()
-                    )
-                    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-                    if status == 200:
-                        print(f"Successful S3 put_object response. Status - {status}")
-                    else:
-                        print(f"Unsuccessful S3 put_object response. Status - {status}")
-
-                    item = {'bucket': destination_bucket, 'shard': shard}
-                    response_lambda['Payload']['Shards'].append(item)
+                body = shard_format.write_frame(shards[-1], intermediate_format, parquet_compression)
+                shard = source_object[:-4] + "_SHARD_" + "LAST" + shard_extension
+                response = s3_client.put_object(
+                    Bucket=destination_bucket, Key=shard,
+                    Body=body
+                )
+                status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                if status == 200:
+                    print(f"Successful S3 put_object response. Status - {status}")
+                else:
+                    print(f"Unsuccessful S3 put_object response. Status - {status}")
+
+                item = {'bucket': destination_bucket, 'shard': shard}
+                response_lambda['Payload']['Shards'].append(item)
         
+        response_lambda['Payload'] = hand_off(response_lambda['Payload']['Shards'], plan, source_object)
         return(response_lambda)
     else:
         raise Exception("Error: Step Functions can only process a CSV file")
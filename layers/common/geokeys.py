@@ -0,0 +1,179 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+import math
+import re
+
+###  Canonical cache keys shared by the scatter and process functions
+###  (packaged as a Lambda layer). Both functions must build identical keys
+###  so shards partitioned by key and the cache agree on what "the same
+###  address" means.
+
+# bump when the normalization rules change; old keys are simply no longer read
+KEY_VERSION = "v1"
+KEY_DELIMITER = "|"
+
+# USPS Publication 28 street suffix abbreviations (most common forms)
+STREET_SUFFIXES = {
+    "alley": "aly", "allee": "aly", "annex": "anx", "arcade": "arc", "avenue": "ave", "av": "ave",
+    "aven": "ave", "avenu": "ave", "avn": "ave", "avnue": "ave", "bayou": "byu", "beach": "bch",
+    "bend": "bnd", "bluff": "blf", "boulevard": "blvd", "boul": "blvd", "boulv": "blvd",
+    "branch": "br", "bridge": "brg", "brook": "brk", "bypass": "byp", "causeway": "cswy",
+    "center": "ctr", "centre": "ctr", "circle": "cir", "circ": "cir", "cliff": "clf", "club": "clb",
+    "common": "cmn", "corner": "cor", "course": "crse", "court": "ct", "cove": "cv", "creek": "crk",
+    "crescent": "cres", "crossing": "xing", "drive": "dr", "drv": "dr", "estate": "est",
+    "estates": "ests", "expressway": "expy", "extension": "ext", "field": "fld", "fields": "flds",
+    "freeway": "fwy", "garden": "gdn", "gardens": "gdns", "gateway": "gtwy", "glen": "gln",
+    "green": "grn", "grove": "grv", "harbor": "hbr", "heights": "hts", "highway": "hwy",
+    "hill": "hl", "hills": "hls", "hollow": "holw", "island": "is", "junction": "jct",
+    "lake": "lk", "lakes": "lks", "landing": "lndg", "lane": "ln", "loop": "loop", "manor": "mnr",
+    "meadow": "mdw", "meadows": "mdws", "mill": "ml", "mount": "mt", "mountain": "mtn",
+    "orchard": "orch", "parkway": "pkwy", "parkwy": "pkwy", "pkway": "pkwy", "pike": "pike",
+    "place": "pl", "plaza": "plz", "point": "pt", "port": "prt", "ridge": "rdg", "river": "riv",
+    "road": "rd", "route": "rte", "square": "sq", "station": "sta", "street": "st", "str": "st",
+    "strt": "st", "terrace": "ter", "trace": "trce", "trail": "trl", "turnpike": "tpke",
+    "valley": "vly", "view": "vw", "village": "vlg", "ville": "vl", "vista": "vis",
+    "walk": "walk", "way": "way",
+}
+
+DIRECTIONALS = {
+    "north": "n", "south": "s", "east": "e", "west": "w",
+    "northeast": "ne", "northwest": "nw", "southeast": "se", "southwest": "sw",
+}
+
+# secondary unit designators
+UNIT_DESIGNATORS = {
+    "apartment": "apt", "building": "bldg", "department": "dept", "floor": "fl", "suite": "ste",
+    "unit": "unit", "room": "rm", "number": "#", "no": "#",
+}
+
+STATES = {
+    "alabama": "al", "alaska": "ak", "arizona": "az", "arkansas": "ar", "california": "ca",
+    "colorado": "co", "connecticut": "ct", "delaware": "de", "district of columbia": "dc",
+    "florida": "fl", "georgia": "ga", "hawaii": "hi", "idaho": "id", "illinois": "il",
+    "indiana": "in", "iowa": "ia", "kansas": "ks", "kentucky": "ky", "louisiana": "la",
+    "maine": "me", "maryland": "md", "massachusetts": "ma", "michigan": "mi", "minnesota": "mn",
+    "mississippi": "ms", "missouri": "mo", "montana": "mt", "nebraska": "ne", "nevada": "nv",
+    "new hampshire": "nh", "new jersey": "nj", "new mexico": "nm", "new york": "ny",
+    "north carolina": "nc", "north dakota": "nd", "ohio": "oh", "oklahoma": "ok", "oregon": "or",
+    "pennsylvania": "pa", "puerto rico": "pr", "rhode island": "ri", "south carolina": "sc",
+    "south dakota": "sd", "tennessee": "tn", "texas": "tx", "utah": "ut", "vermont": "vt",
+    "virginia": "va", "washington": "wa", "west virginia": "wv", "wisconsin": "wi", "wyoming": "wy",
+}
+
+ADDRESS_TOKENS = {**STREET_SUFFIXES, **DIRECTIONALS, **UNIT_DESIGNATORS}
+
+# anything that is not a letter, digit or "#" separates tokens (this also removes the key delimiter)
+_SEPARATORS = re.compile(r"[^\w#]+|_")
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def normalize_text(value):
+    """
+    Casefold, strip punctuation and collapse whitespace
+    """
+    if _is_missing(value):
+        return ""
+    return " ".join(_SEPARATORS.sub(" ", str(value).casefold()).split())
+
+
+def normalize_address(address):
+    """
+    Normalize a street line, abbreviating suffixes, directionals and unit
+    designators to their USPS forms ("North Main Street" -> "n main st")
+    """
+    tokens = normalize_text(address).replace("#", " # ").split()
+    return " ".join(ADDRESS_TOKENS.get(token, token) for token in tokens)
+
+
+def normalize_state(state):
+    state = normalize_text(state)
+    return STATES.get(state, state)
+
+
+def address_key(address, city, state):
+    """
+    Cache key for forward geocoding
+
+    Returns
+    ------
+        str: "<version>|addr|<address>|<city>|<state>"
+    """
+    return KEY_DELIMITER.join(
+        [KEY_VERSION, "addr", normalize_address(address), normalize_text(city), normalize_state(state)])
+
+
+def address_query(address, city, state):
+    """
+    Free-form text sent to the Location API for forward geocoding
+    """
+    return ", ".join(str(part).strip() for part in (address, city, state) if not _is_missing(part))
+
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_M = 6371008.8
+
+
+def geohash_encode(latitude, longitude, precision):
+    """
+    Standard base32 geohash of a point
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def haversine_m(longitude_1, latitude_1, longitude_2, latitude_2):
+    """
+    Great-circle distance between two points in meters
+    """
+    phi_1 = math.radians(latitude_1)
+    phi_2 = math.radians(latitude_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(longitude_2 - longitude_1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def position_key(longitude, latitude):
+    """
+    Exact cache key for reverse geocoding ("<longitude>,<latitude>")
+    """
+    return str(float(longitude)) + "," + str(float(latitude))
+
+
+def cell_key(longitude, latitude, precision):
+    """
+    Cache key for reverse geocoding by geohash cell
+
+    Returns
+    ------
+        str: "<version>|gh<precision>|<geohash>"
+    """
+    return KEY_DELIMITER.join(
+        [KEY_VERSION, "gh" + str(precision), geohash_encode(float(latitude), float(longitude), precision)])
+
+
+def is_cell_key(key):
+    return key.startswith(KEY_DELIMITER.join([KEY_VERSION, "gh"]))
@@ -0,0 +1,146 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+###  Streaming writer for S3 objects. Bytes are buffered into parts and sent
+###  with a multipart upload as soon as a part is full, so a function can
+###  write an object far larger than its memory. Small objects fall back to
+###  a single put_object. Byte ranges of other S3 objects can be appended
+###  with copy(), which copies large ranges server-side.
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+
+class MultipartUpload:
+    """
+    Write an S3 object incrementally
+
+    Parameters
+    ----------
+    s3_client: botocore client, required
+    bucket: str, required
+    key: str, required
+    part_size: int, optional
+        Bytes buffered before a part is uploaded (at least 5 MiB)
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(MIN_PART_SIZE, int(part_size))
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.bytes_copied = 0
+        self.response = None
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            if self.response is None:
+                self.close()
+        else:
+            self.abort()
+        return False
+
+    def _start(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response["UploadId"]
+
+    def _upload_buffer(self):
+        self._start()
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer))
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """
+        Append str (encoded as UTF-8) or bytes to the object
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_buffer()
+
+    def _read_range(self, bucket, key, start, end):
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(start, end - 1))
+        return response["Body"].read()
+
+    def copy(self, source_bucket, source_key, start, end):
+        """
+        Append bytes start (inclusive) to end (exclusive) of another S3 object
+
+        Ranges of at least 5 MiB are copied server-side with upload_part_copy,
+        so the bytes never pass through the function. Shorter ranges, and the
+        bytes needed to top up a partly filled buffer to a valid part, are
+        downloaded with a ranged GET and buffered like write().
+
+        Parameters
+        ----------
+        source_bucket: str, required
+        source_key: str, required
+        start: int, required
+        end: int, required
+        """
+        if end <= start:
+            # an empty range has nothing to append, and "bytes=0--1" is not a valid Range
+            return
+        if self._buffer and len(self._buffer) < MIN_PART_SIZE:
+            top_up = min(end, start + MIN_PART_SIZE - len(self._buffer))
+            self.write(self._read_range(source_bucket, source_key, start, top_up))
+            start = top_up
+        if end - start < MIN_PART_SIZE:
+            if end > start:
+                self.write(self._read_range(source_bucket, source_key, start, end))
+            return
+        if self._buffer:
+            self._upload_buffer()
+        self._start()
+        # equal slices keep every part between the minimum and maximum part size
+        slices = -(-(end - start) // MAX_PART_SIZE)
+        bounds = [start + (end - start) * i // slices for i in range(slices + 1)]
+        for first, stop in zip(bounds, bounds[1:]):
+            part_number = len(self.parts) + 1
+            response = self.s3_client.upload_part_copy(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number,
+                CopySource={"Bucket": source_bucket, "Key": source_key},
+                CopySourceRange="bytes={}-{}".format(first, stop - 1))
+            self.parts.append({"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]})
+        self.bytes_written += end - start
+        self.bytes_copied += end - start
+
+    def close(self):
+        """
+        Finish the object
+
+        Returns
+        ------
+            dict: response of complete_multipart_upload or put_object
+        """
+        if self.response is not None:
+            return self.response
+        if self.upload_id is None:
+            self.response = self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer or not self.parts:
+                self._upload_buffer()
+            self.response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts})
+        self._buffer = bytearray()
+        return self.response
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
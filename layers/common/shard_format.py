@@ -0,0 +1,174 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import importlib.util
+import io
+
+###  Encoding of the intermediate shards passed from scatter to process to
+###  gather. "csv" keeps the original text shards. "parquet" writes typed,
+###  compressed columnar shards, so numbers are not re-parsed at every hop
+###  and readers can load only the columns they need. pandas is imported on
+###  the first read or write of a frame and pyarrow only when Parquet is
+###  used, so functions that only move bytes never load them.
+
+FORMATS = ("csv", "parquet")
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet"}
+DEFAULT_COMPRESSION = "zstd"
+
+
+def check_format(shard_format):
+    if shard_format not in FORMATS:
+        raise ValueError("Unknown shard format {!r}, expected one of {}".format(shard_format, FORMATS))
+    if shard_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        # pyarrow is not in the functions' requirements; Parquet stacks use the images/parquet image
+        raise ImportError("Parquet shards need pyarrow; deploy the functions from images/parquet/Dockerfile")
+    return shard_format
+
+
+def shard_key(key, shard_format):
+    """
+    Replace the extension of an object key with the one of shard_format
+    """
+    stem = key.rsplit(".", 1)[0] if "." in key.rsplit("/", 1)[-1] else key
+    return stem + EXTENSIONS[check_format(shard_format)]
+
+
+def format_of(key):
+    """
+    Shard format of an object key, from its extension (CSV by default)
+    """
+    return "parquet" if key.endswith(EXTENSIONS["parquet"]) else "csv"
+
+
+def _lists_for_csv(df):
+    # list columns read back from Parquet are numpy arrays; write them the way
+    # the CSV shards always have, as Python lists
+    import numpy as np
+    columns = {}
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if len(values) and isinstance(values.iloc[0], np.ndarray):
+            columns[column] = df[column].map(lambda value: value.tolist() if isinstance(value, np.ndarray) else value)
+    return df.assign(**columns) if columns else df
+
+
+def write_frame(df, shard_format, compression=DEFAULT_COMPRESSION, header=True):
+    """
+    Serialize a DataFrame as one shard; header=False leaves out the CSV
+    header line, for pieces that are appended to another CSV shard
+
+    Returns
+    ------
+        bytes: the encoded shard
+    """
+    if check_format(shard_format) == "csv":
+        return _lists_for_csv(df).to_csv(index=False, header=header).encode("utf-8")
+    with io.BytesIO() as buffer:
+        df.to_parquet(buffer, engine="pyarrow", index=False, compression=compression)
+        return buffer.getvalue()
+
+
+def read_frame(body, shard_format, columns=None):
+    """
+    Parse one shard
+
+    Parameters
+    ----------
+    body: bytes or file-like object, required
+    shard_format: str, required
+    columns: list, optional
+        Only load these columns. Parquet skips the others on disk; CSV
+        still parses every line.
+
+    Returns
+    ------
+        DataFrame
+    """
+    import pandas as pd
+    if isinstance(body, (bytes, bytearray)):
+        body = io.BytesIO(body)
+    if check_format(shard_format) == "csv":
+        return pd.read_csv(body, usecols=columns)
+    if not hasattr(body, "seek"):
+        body = io.BytesIO(body.read())
+    return pd.read_parquet(body, engine="pyarrow", columns=columns)
+
+
+def iter_frames(body, shard_format, chunk_rows):
+    """
+    Parse one shard chunk_rows rows at a time
+    """
+    if check_format(shard_format) == "csv":
+        import pandas as pd
+        yield from pd.read_csv(body, chunksize=chunk_rows)
+        return
+    import pyarrow.parquet as pq
+    if not hasattr(body, "seek"):
+        body = io.BytesIO(body.read())
+    for batch in pq.ParquetFile(body).iter_batches(batch_size=chunk_rows):
+        yield batch.to_pandas()
+
+
+class _SinkFile(io.RawIOBase):
+    # file object view of a sink that only has write(), as pyarrow expects
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sink.write(bytes(data))
+        return len(data)
+
+
+class FrameWriter:
+    """
+    Write DataFrames one after another as a single shard into a file-like
+    sink (for example s3_multipart.MultipartUpload). CSV shards get the
+    header once; Parquet shards get one row group per DataFrame, cast to
+    the schema of the first one.
+
+    Parameters
+    ----------
+    sink: object with write(bytes), required
+    shard_format: str, required
+    compression: str, optional
+        Parquet codec
+    """
+
+    def __init__(self, sink, shard_format, compression=DEFAULT_COMPRESSION):
+        self.sink = sink
+        self.shard_format = check_format(shard_format)
+        self.compression = compression
+        self.columns = None
+        self.rows = 0
+        self._writer = None
+
+    def write(self, df):
+        first = self.columns is None
+        if first:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            raise ValueError("Columns {} do not match the first frame's {}".format(list(df.columns), self.columns))
+        if self.shard_format == "csv":
+            self.sink.write(_lists_for_csv(df).to_csv(index=False, header=first))
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(_SinkFile(self.sink), table.schema, compression=self.compression)
+            elif not table.schema.equals(self._writer.schema):
+                table = table.cast(self._writer.schema)
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Finish the shard (writes the Parquet footer); the sink stays open
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,78 @@
+"""
+Synthetic input files for the benchmark. Every row is drawn from a pool of
+unique addresses or positions whose size sets the duplicate ratio, so the
+cache and de-duplication paths see realistic repetition. The same seed
+always produces the same file.
+"""
+
+import io
+import random
+
+import pandas as pd
+
+STREETS = ["Main", "Elm", "Oak", "Maple", "Park", "Washington", "Lake", "Hill", "Pine", "Cedar"]
+SUFFIXES = ["St", "Street", "Ave", "Avenue", "Rd", "Blvd"]
+CITIES = [("Hartford", "CT"), ("Boston", "MA"), ("Albany", "NY"), ("Providence", "RI"), ("Burlington", "VT")]
+
+
+def unique_count(rows, duplicate_ratio):
+    """
+    Size of the pool that gives roughly duplicate_ratio repeated rows
+    """
+    return max(1, int(round(rows * (1.0 - duplicate_ratio))))
+
+
+def synthetic_frame(rows, duplicate_ratio=0.0, kind="address", seed=0):
+    """
+    Build a dataset
+
+    Parameters
+    ----------
+    rows: int, required
+    duplicate_ratio: float, optional
+        Share of rows repeating a key seen elsewhere in the file (0 to <1)
+    kind: str, optional
+        "address" (Address/City/State, forward geocoding) or "position"
+        (Latitude/Longitude, reverse geocoding)
+    seed: int, optional
+
+    Returns
+    ------
+        DataFrame
+    """
+    generator = random.Random(seed)
+    pool_size = unique_count(rows, duplicate_ratio)
+    if kind == "address":
+        pool = [
+            ("{} {} {}".format(generator.randint(1, 9999), generator.choice(STREETS), generator.choice(SUFFIXES)),)
+            + generator.choice(CITIES)
+            for _ in range(pool_size)
+        ]
+        columns = ["Address", "City", "State"]
+    elif kind == "position":
+        pool = [
+            (round(generator.uniform(41.0, 42.5), 6), round(generator.uniform(-73.5, -71.5), 6))
+            for _ in range(pool_size)
+        ]
+        columns = ["Latitude", "Longitude"]
+    else:
+        raise ValueError("Unknown dataset kind {!r}".format(kind))
+    # every pool entry appears at least once, the rest are repeats
+    picks = list(range(pool_size)) + [generator.randrange(pool_size) for _ in range(rows - pool_size)]
+    generator.shuffle(picks)
+    data = pd.DataFrame([pool[pick] for pick in picks], columns=columns)
+    data.insert(0, "Id", range(rows))
+    return data
+
+
+def synthetic_csv(rows, duplicate_ratio=0.0, kind="address", seed=0):
+    """
+    The dataset of synthetic_frame as the CSV file a user would upload
+
+    Returns
+    ------
+        bytes
+    """
+    with io.StringIO() as buffer:
+        synthetic_frame(rows, duplicate_ratio, kind, seed).to_csv(buffer, index=False)
+        return buffer.getvalue().encode("utf-8")
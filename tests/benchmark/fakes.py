@@ -0,0 +1,301 @@
+"""
+In-process stand-ins for the S3, DynamoDB and Location clients the three
+functions use. They implement only the calls the functions make, keep
+everything in memory and can add latency, throttling and errors so a run
+behaves like the deployed services without leaving the machine. The unit
+tests use them too (see the fixtures in tests/conftest.py).
+"""
+
+import hashlib
+import io
+import itertools
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import s3_multipart
+
+
+def _client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+def _etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+def _byte_range(header, size):
+    start, end = (int(value) for value in header[len("bytes="):].split("-"))
+    return start, min(end, size - 1)
+
+
+class FakeS3:
+    """
+    Parameters
+    ----------
+    objects: dict, optional
+        Initial objects by (bucket, key)
+
+    Besides the objects, it records every GET as (key, bytes returned) in
+    reads, every copied part as (source key, bytes) in copies and the ids
+    of aborted uploads in aborted.
+    """
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.uploads = {}
+        self.reads = []
+        self.copies = []
+        self.aborted = []
+        self.requests = 0
+        self._upload_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+
+    def head_object(self, Bucket, Key):
+        self._count()
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._count()
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("NoSuchKey", "GetObject")
+        body = self.objects[(Bucket, Key)]
+        response = {"ResponseMetadata": {"HTTPStatusCode": 200}, "ETag": _etag(body)}
+        if Range:
+            start, end = _byte_range(Range, len(body))
+            response["ResponseMetadata"]["HTTPStatusCode"] = 206
+            response["ContentRange"] = "bytes {}-{}/{}".format(start, end, len(body))
+            body = body[start:end + 1]
+        with self._lock:
+            self.reads.append((Key, len(body)))
+        response["Body"] = io.BytesIO(body)
+        return response
+
+    def put_object(self, Bucket, Key, Body):
+        self._count()
+        self.objects[(Bucket, Key)] = Body.encode() if isinstance(Body, str) else bytes(Body)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}, "ETag": _etag(self.objects[(Bucket, Key)])}
+
+    def delete_objects(self, Bucket, Delete):
+        self._count()
+        for entry in Delete["Objects"]:
+            self.objects.pop((Bucket, entry["Key"]), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._count()
+        with self._lock:
+            upload_id = "upload-{}".format(next(self._upload_ids))
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._count()
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": str(PartNumber)}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange):
+        self._count()
+        source = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+        start, end = _byte_range(CopySourceRange, len(source))
+        self.uploads[UploadId][PartNumber] = source[start:end + 1]
+        with self._lock:
+            self.copies.append((CopySource["Key"], end + 1 - start))
+        return {"CopyPartResult": {"ETag": str(PartNumber)}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._count()
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        if numbers != sorted(parts):
+            raise _client_error("InvalidPartOrder", "CompleteMultipartUpload")
+        # like S3, every part but the last must be at least the minimum part size
+        if any(len(parts[number]) < s3_multipart.MIN_PART_SIZE for number in numbers[:-1]):
+            raise _client_error("EntityTooSmall", "CompleteMultipartUpload")
+        self.objects[(Bucket, Key)] = b"".join(parts[number] for number in numbers)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._count()
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(UploadId)
+
+
+class FakeDynamoDB:
+    """
+    Parameters
+    ----------
+    latency_ms: float, optional
+        Added to every request
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.items = {}
+        self.batch_gets = []
+        self.batch_writes = []
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def get_item(self, TableName, Key):
+        self._request()
+        item = self.items.get(Key["id"]["S"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self._request()
+        self.items[Item["id"]["S"]] = Item
+        return {}
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues, **kwargs):
+        self._request()
+        item = self.items.get(Key["id"]["S"])
+        if item is None:
+            raise _client_error("ConditionalCheckFailedException", "UpdateItem")
+        hits = int(item.get("Hits", {"N": "0"})["N"]) + int(ExpressionAttributeValues[":hits"]["N"])
+        item["Hits"] = {"N": str(hits)}
+        item["LastAccess"] = ExpressionAttributeValues[":now"]
+        return {}
+
+    def batch_get_item(self, RequestItems):
+        self._request()
+        self.batch_gets.append(RequestItems)
+        (table, request), = RequestItems.items()
+        if len(request["Keys"]) > 100:
+            raise _client_error("ValidationException", "BatchGetItem")
+        found = []
+        for key in request["Keys"]:
+            item = self.items.get(key["id"]["S"])
+            if item is not None:
+                found.append({"id": item["id"]} if request.get("ProjectionExpression") == "id" else item)
+        return {"Responses": {table: found}, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        self._request()
+        self.batch_writes.append(RequestItems)
+        (table, requests), = RequestItems.items()
+        if len(requests) > 25:
+            raise _client_error("ValidationException", "BatchWriteItem")
+        for request in requests:
+            item = request["PutRequest"]["Item"]
+            self.items[item["id"]["S"]] = item
+        return {"UnprocessedItems": {}}
+
+    def scan(self, TableName, **kwargs):
+        self._request()
+        return {"Items": list(self.items.values())}
+
+
+class ThrottlingDynamoDB(FakeDynamoDB):
+    """
+    Leaves the last key or item of every batch unprocessed on the first
+    attempt, like a throttled table
+    """
+
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.throttled = set()
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        last = request["Keys"][-1]["id"]["S"]
+        if last not in self.throttled:
+            self.throttled.add(last)
+            response = super().batch_get_item({table: {"Keys": request["Keys"][:-1]}})
+            response["UnprocessedKeys"] = {table: {"Keys": request["Keys"][-1:]}}
+            return response
+        return super().batch_get_item(RequestItems)
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        last = requests[-1]["PutRequest"]["Item"]["id"]["S"]
+        if last not in self.throttled:
+            self.throttled.add(last)
+            super().batch_write_item({table: requests[:-1]})
+            return {"UnprocessedItems": {table: requests[-1:]}}
+        return super().batch_write_item(RequestItems)
+
+
+class FakeLocation:
+    """
+    Location client returning a synthetic place for every query. Every
+    call is recorded in calls: the text, or the position as a tuple.
+
+    Parameters
+    ----------
+    latency_ms: float, optional
+        Mean call latency; each call takes between half and one and a half times as long
+    throttle_rate: float, optional
+        Share of calls failing with ThrottlingException
+    error_rate: float, optional
+        Share of calls failing with InternalServerException
+    not_found_rate: float, optional
+        Share of calls returning no result
+    slow_rate: float, optional
+        Share of calls taking slow_ms instead, the latency tail
+    slow_ms: float, optional
+    seed: int, optional
+    """
+
+    def __init__(self, latency_ms=0.0, throttle_rate=0.0, error_rate=0.0, not_found_rate=0.0,
+                 slow_rate=0.0, slow_ms=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.calls = []
+        self.throttled = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, operation, query):
+        with self._lock:
+            self.calls.append(query)
+            draw = self._random.random()
+            jitter = self._random.uniform(0.5, 1.5)
+            slow = self._random.random() < self.slow_rate
+        if slow:
+            time.sleep(self.slow_ms / 1000)
+        elif self.latency_ms:
+            time.sleep(self.latency_ms * jitter / 1000)
+        if draw < self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            raise _client_error("ThrottlingException", operation)
+        draw -= self.throttle_rate
+        if draw < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise _client_error("InternalServerException", operation)
+        return draw - self.error_rate < self.not_found_rate
+
+    def _place(self, label, lon, lat):
+        return {"Results": [{"Place": {
+            "Label": label, "Geometry": {"Point": [lon, lat]}, "Country": "USA",
+            "PostalCode": "06103", "Municipality": "Hartford", "Region": "Connecticut",
+            "SubRegion": "Hartford County"}}]}
+
+    def search_place_index_for_text(self, IndexName, Text):
+        if self._call("SearchPlaceIndexForText", Text):
+            return {"Results": []}
+        return self._place(Text, -72.67, 41.76)
+
+    def search_place_index_for_position(self, IndexName, Position):
+        if self._call("SearchPlaceIndexForPosition", tuple(Position)):
+            return {"Results": []}
+        return self._place("{:.5f}, {:.5f}".format(Position[1], Position[0]), Position[0], Position[1])
@@ -0,0 +1,273 @@
+"""
+End-to-end benchmark of the scatter -> process -> gather handlers, run
+in-process against the fakes in tests/benchmark/fakes.py.
+
+    python -m tests.benchmark.harness --rows 1000 10000 --duplicates 0 0.5 0.9
+
+For every dataset it reports throughput, the time and peak traced memory
+of each stage, the Location traffic and the per-shard metrics the process
+function emits. Shards run one after another; the Map state's wall time is
+estimated by scheduling the measured shard times on MAP_MAX_CONCURRENCY
+workers. Use --no-memory for timings without tracemalloc overhead.
+"""
+
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# same layout as tests/conftest.py: the layer and the process function's siblings import by plain name
+for path in ("layers/common", "functions/process", ""):
+    if os.path.join(ROOT, path) not in sys.path:
+        sys.path.insert(0, os.path.join(ROOT, path))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from functions.gather import app as gather  # noqa: E402
+from functions.process import app as process  # noqa: E402
+from functions.scatter import app as scatter  # noqa: E402
+from tests.benchmark.datasets import synthetic_csv, unique_count  # noqa: E402
+from tests.benchmark.fakes import FakeDynamoDB, FakeLocation, FakeS3  # noqa: E402
+
+CACHE_TABLE = "LocationCache"
+
+
+class Stage:
+    """
+    Wall time and peak traced memory of a block
+    """
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.seconds = 0.0
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._started
+        if self.trace_memory:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+
+def map_wall_seconds(shard_seconds, concurrency):
+    """
+    Wall time of the Map state if the shards ran on `concurrency` workers,
+    each taking the next shard as soon as it is free
+    """
+    workers = [0.0] * max(1, min(concurrency, len(shard_seconds) or 1))
+    for seconds in shard_seconds:
+        heapq.heappush(workers, heapq.heappop(workers) + seconds)
+    return max(workers)
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+@contextlib.contextmanager
+def stack(s3, ddb, location, options):
+    """
+    Point the three handlers at the fakes for the duration of a run
+    """
+    patches = [
+        (scatter, "s3_client", s3), (scatter, "ddb_client", ddb), (scatter, "destination_bucket", "raw"),
+        (scatter, "ddb_table", CACHE_TABLE), (scatter, "scatter_mode", options.scatter_mode),
+        (scatter, "shard_partitioning", options.shard_partitioning),
+        (scatter, "location_rate_limit", options.rate_limit or 1000),
+        (scatter, "shard_hand_off", options.hand_off), (scatter, "manifest_bucket", "raw"),
+        (process, "s3_client", s3), (process, "ddb_client", ddb), (process, "location", location),
+        (process, "destination_bucket", "processed"), (process, "ddb_table", CACHE_TABLE),
+        (process, "location_rate_limiter", process.LocalTokenBucket(options.rate_limit)),
+        (process, "location_concurrency", process.AdaptiveConcurrencyLimit(
+            initial=int(os.environ.get("LOCATION_INITIAL_CONCURRENCY", "4")), maximum=process.max_in_flight)),
+        (process, "log", process.Log(options.log_level)),
+        (process, "hedge_percentile", options.hedge_percentile), (process, "location_latency", process.LatencyTracker()),
+        (gather, "s3_client", s3), (gather, "process_shards_bucket", "processed"),
+        (gather, "destination_bucket", "destination"), (gather, "gather_mode", options.gather_mode),
+    ]
+    with contextlib.ExitStack() as patched:
+        for module, name, value in patches:
+            patched.enter_context(mock.patch.object(module, name, value))
+        yield
+
+
+def new_memory_cache():
+    return process.LocationMemoryCache(
+        process.memory_cache.max_entries, process.memory_cache.max_bytes, process.memory_cache.ttl_seconds)
+
+
+def run_pipeline(data, s3, ddb, location, options, key="benchmark/input.csv"):
+    """
+    Upload data to the fake input bucket and run scatter, every shard
+    through process, then gather
+
+    Returns
+    ------
+        dict: measurements of the run
+    """
+    s3.objects[("input", key)] = data
+    captured = io.StringIO()
+    shard_seconds = []
+    memory_cache = new_memory_cache()
+    with stack(s3, ddb, location, options), contextlib.redirect_stdout(captured):
+        event = {"Payload": {"detail": {"bucket": {"name": "input"}, "object": {"key": key}}}}
+        with Stage(options.memory) as scatter_stage:
+            scattered = scatter.lambda_handler(event, None)["Payload"]
+        if "Manifest" in scattered:
+            # the distributed Map state reads the shard descriptors from the manifest
+            manifest = s3.objects[(scattered["Manifest"]["bucket"], scattered["Manifest"]["key"])]
+            shards = [json.loads(line) for line in manifest.splitlines()]
+        else:
+            shards = scattered["Shards"]
+        outputs = []
+        with Stage(options.memory) as process_stage:
+            for shard in shards:
+                if not options.warm_containers:
+                    # every Map iteration may land on a new container with an empty memory cache
+                    memory_cache = new_memory_cache()
+                with mock.patch.object(process, "memory_cache", memory_cache):
+                    started = time.perf_counter()
+                    outputs.append(process.lambda_handler({"Payload": shard}, None)["Payload"])
+                    shard_seconds.append(time.perf_counter() - started)
+        with Stage(options.memory) as gather_stage:
+            gather.lambda_handler({"Payload": scattered if "Manifest" in scattered else outputs}, None)
+    records = [json.loads(line) for line in captured.getvalue().splitlines() if line.startswith('{"_aws"')]
+    map_seconds = map_wall_seconds(shard_seconds, scatter.map_max_concurrency)
+    end_to_end = scatter_stage.seconds + map_seconds + gather_stage.seconds
+    output = [value for (bucket, name), value in s3.objects.items() if bucket == "destination"]
+    return {
+        "shards": len(shards),
+        "output_rows": output[-1].count(b"\n") - 1 if output else 0,
+        "scatter_seconds": round(scatter_stage.seconds, 4),
+        "process_seconds_total": round(process_stage.seconds, 4),
+        "process_seconds_p50": round(percentile(shard_seconds, 0.5), 4),
+        "process_seconds_max": round(max(shard_seconds, default=0.0), 4),
+        "map_wall_seconds": round(map_seconds, 4),
+        "gather_seconds": round(gather_stage.seconds, 4),
+        "end_to_end_seconds": round(end_to_end, 4),
+        "scatter_peak_mib": round(scatter_stage.peak_bytes / 2**20, 2),
+        "process_peak_mib": round(process_stage.peak_bytes / 2**20, 2),
+        "gather_peak_mib": round(gather_stage.peak_bytes / 2**20, 2),
+        "cache_hits": sum(record.get(name, 0) for record in records
+                          for name in ("MemoryCacheHits", "DynamoDBCacheHits", "SpatialIndexHits")),
+        "cache_misses": sum(record.get("CacheMisses", 0) for record in records),
+        "location_hedges": sum(record.get("LocationHedges", 0) for record in records),
+        "location_latency_p95_ms": max((record.get("LocationLatencyP95", 0) for record in records), default=0),
+        "log": captured.getvalue(),
+    }
+
+
+def benchmark(rows, duplicate_ratio, kind, options):
+    """
+    Run one dataset options.passes times against the same cache table; the
+    later passes show the warm-cache path
+
+    Returns
+    ------
+        list: one result dict per pass
+    """
+    data = synthetic_csv(rows, duplicate_ratio, kind, seed=options.seed)
+    ddb = FakeDynamoDB(latency_ms=options.ddb_latency_ms)
+    results = []
+    for run in range(options.passes):
+        location = FakeLocation(
+            latency_ms=options.latency_ms, throttle_rate=options.throttle_rate,
+            error_rate=options.error_rate, not_found_rate=options.not_found_rate,
+            slow_rate=options.slow_rate, slow_ms=options.slow_ms, seed=options.seed + run)
+        s3 = FakeS3()
+        result = run_pipeline(data, s3, ddb, location, options)
+        log = result.pop("log")
+        if options.verbose:
+            print(log)
+        result.update({
+            "kind": kind, "rows": rows, "duplicate_ratio": duplicate_ratio,
+            "unique_keys": unique_count(rows, duplicate_ratio), "pass": run + 1,
+            "rows_per_second": round(rows / result["end_to_end_seconds"], 1) if result["end_to_end_seconds"] else 0.0,
+            "location_calls": len(location.calls), "location_throttled": location.throttled,
+            "location_errors": location.errors, "dynamodb_requests": ddb.requests, "s3_requests": s3.requests,
+        })
+        results.append(result)
+    return results
+
+
+COLUMNS = [
+    ("kind", "kind"), ("rows", "rows"), ("output_rows", "out"), ("duplicate_ratio", "dup"), ("pass", "pass"), ("shards", "shards"),
+    ("rows_per_second", "rows/s"), ("end_to_end_seconds", "e2e s"), ("scatter_seconds", "scatter s"),
+    ("map_wall_seconds", "map s"), ("process_seconds_max", "shard max s"), ("gather_seconds", "gather s"),
+    ("location_calls", "calls"), ("location_throttled", "throttled"), ("location_hedges", "hedges"), ("cache_hits", "hits"),
+    ("process_peak_mib", "process MiB"), ("gather_peak_mib", "gather MiB"),
+]
+
+
+def format_table(results):
+    rows = [[str(result[key]) for key, title in COLUMNS] for result in results]
+    widths = [max(len(title), *(len(row[i]) for row in rows)) for i, (key, title) in enumerate(COLUMNS)]
+    lines = ["  ".join(title.rjust(width) for (key, title), width in zip(COLUMNS, widths))]
+    lines += ["  ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows]
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--duplicates", type=float, nargs="+", default=[0.0, 0.5, 0.9],
+                        help="share of rows repeating another row's key")
+    parser.add_argument("--kind", choices=["address", "position"], nargs="+", default=["address"])
+    parser.add_argument("--passes", type=int, default=2, help="runs per dataset against the same cache table")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="mean Location call latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of Location calls taking --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=1000.0)
+    parser.add_argument("--hedge-percentile", type=float, default=process.hedge_percentile,
+                        help="hedge Location calls slower than this percentile, 0 disables")
+    parser.add_argument("--ddb-latency-ms", type=float, default=5.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Location calls per second, 0 for no limit")
+    parser.add_argument("--scatter-mode", choices=["pandas", "range"], default=scatter.scatter_mode)
+    parser.add_argument("--shard-partitioning", choices=["range", "key"], default=scatter.shard_partitioning)
+    parser.add_argument("--hand-off", choices=["inline", "manifest", "auto"], default=scatter.shard_hand_off)
+    parser.add_argument("--gather-mode", choices=["pandas", "stream"], default="stream")
+    parser.add_argument("--warm-containers", action="store_true",
+                        help="keep one memory cache across shards, as if one container ran them all")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="print the functions' log output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = []
+    for kind in options.kind:
+        for rows in options.rows:
+            for duplicate_ratio in options.duplicates:
+                results.extend(benchmark(rows, duplicate_ratio, kind, options))
+    print(format_table(results))
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
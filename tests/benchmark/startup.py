@@ -0,0 +1,146 @@
+"""
+Cold start benchmark of the process function's engines. Every run starts a
+fresh Python process, as a cold Lambda container would, imports the
+function and processes one shard against the fakes in tests/benchmark/fakes.py.
+
+    python -m tests.benchmark.startup --rows 1000 --runs 5
+
+For each engine it reports the median and worst import time, first shard
+time and process wall time, the peak resident memory, and whether pandas
+and NumPy were loaded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ENGINES = ["pandas", "csv"]
+
+
+def child(engine, input_path):
+    """
+    Runs in the fresh process: import the function, enrich one shard and
+    print the measurements as JSON
+    """
+    import contextlib
+    import io
+    import resource
+
+    os.environ["PROCESS_ENGINE"] = engine
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    for path in ("layers/common", "functions/process", ""):
+        sys.path.insert(0, os.path.join(ROOT, path))
+    started = time.perf_counter()
+    from functions.process import app
+    imported = time.perf_counter()
+
+    from tests.benchmark.fakes import FakeDynamoDB, FakeLocation, FakeS3
+    s3 = FakeS3()
+    with open(input_path, "rb") as data:
+        s3.objects[("raw", "shard.csv")] = data.read()
+    app.s3_client = s3
+    app.ddb_client = FakeDynamoDB()
+    app.location = FakeLocation()
+    app.destination_bucket = "processed"
+    app.ddb_table = "LocationCache"
+    app.location_rate_limiter = app.LocalTokenBucket(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.lambda_handler({"Payload": {"bucket": "raw", "shard": "shard.csv"}}, None)
+    processed = time.perf_counter()
+    print(json.dumps({
+        "import_seconds": imported - started,
+        "first_shard_seconds": processed - imported,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "pandas_loaded": "pandas" in sys.modules,
+        "numpy_loaded": "numpy" in sys.modules,
+    }))
+
+
+def measure(engine, input_path):
+    """
+    One cold run of an engine in a new interpreter
+
+    Returns
+    ------
+        dict: the child's measurements plus the process wall time
+    """
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "tests.benchmark.startup", "--child", engine, "--input", input_path],
+        cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - started
+    return result
+
+
+def summarize(engine, runs):
+    summary = {"engine": engine, "runs": len(runs)}
+    for name in ("import_seconds", "first_shard_seconds", "process_seconds"):
+        values = [run[name] for run in runs]
+        summary[name + "_median"] = round(statistics.median(values), 4)
+        summary[name + "_max"] = round(max(values), 4)
+    summary["peak_rss_mib"] = round(max(run["peak_rss_mib"] for run in runs), 1)
+    summary["pandas_loaded"] = any(run["pandas_loaded"] for run in runs)
+    summary["numpy_loaded"] = any(run["numpy_loaded"] for run in runs)
+    return summary
+
+
+def benchmark(engines, rows, runs, duplicate_ratio=0.5, seed=0):
+    """
+    Returns
+    ------
+        list: one summary dict per engine
+    """
+    from tests.benchmark.datasets import synthetic_csv
+    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as data:
+        data.write(synthetic_csv(rows, duplicate_ratio, seed=seed))
+    try:
+        return [summarize(engine, [measure(engine, data.name) for _ in range(runs)]) for engine in engines]
+    finally:
+        os.unlink(data.name)
+
+
+def format_table(summaries):
+    keys = list(summaries[0])
+    rows = [[str(summary[key]) for key in keys] for summary in summaries]
+    widths = [max(len(key), *(len(row[i]) for row in rows)) for i, key in enumerate(keys)]
+    lines = ["  ".join(key.rjust(width) for key, width in zip(keys, widths))]
+    lines += ["  ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows]
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=ENGINES, nargs="+", default=ENGINES)
+    parser.add_argument("--rows", type=int, default=1000, help="rows in the shard")
+    parser.add_argument("--duplicates", type=float, default=0.5, help="share of rows repeating another row's key")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per engine")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", choices=ENGINES, help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.child:
+        child(options.child, options.input)
+        return None
+    summaries = benchmark(options.engine, options.rows, options.runs, options.duplicates)
+    print(format_table(summaries))
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump(summaries, output, indent=2)
+    return summaries
+
+
+if __name__ == "__main__":
+    main()
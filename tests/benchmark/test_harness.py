@@ -0,0 +1,51 @@
+from tests.benchmark import harness
+from tests.benchmark.datasets import synthetic_frame
+
+
+def test_dataset_has_the_requested_duplicate_ratio():
+    data = synthetic_frame(1000, duplicate_ratio=0.75, seed=1)
+
+    assert len(data) == 1000
+    assert len(data.drop_duplicates(["Address", "City", "State"])) <= 250
+    assert synthetic_frame(50, 0.5, "position", seed=1).equals(synthetic_frame(50, 0.5, "position", seed=1))
+
+
+def test_map_wall_time_schedules_shards_on_workers():
+    assert harness.map_wall_seconds([3, 1, 1, 1], 2) == 3
+    assert harness.map_wall_seconds([1, 1, 1, 1], 1) == 4
+
+
+def test_pipeline_runs_end_to_end_and_second_pass_hits_the_cache():
+    options = harness.parse_args([
+        "--rows", "300", "--duplicates", "0.5", "--kind", "address", "position",
+        "--latency-ms", "0", "--ddb-latency-ms", "0", "--throttle-rate", "0.1", "--no-memory"])
+
+    results = [result for kind in options.kind for result in harness.benchmark(300, 0.5, kind, options)]
+
+    assert len(results) == 4
+    for first, second in zip(results[::2], results[1::2]):
+        assert first["output_rows"] == second["output_rows"] == 300
+        assert first["location_calls"] >= first["unique_keys"] > 0
+        assert second["location_calls"] == 0
+        assert second["cache_hits"] == first["unique_keys"]
+
+
+def test_csv_engine_cold_start_does_not_load_pandas():
+    from tests.benchmark import startup
+
+    summary, = startup.benchmark(["csv"], rows=50, runs=1)
+
+    assert summary["runs"] == 1
+    assert not summary["pandas_loaded"] and not summary["numpy_loaded"]
+
+
+def test_pipeline_runs_through_a_shard_manifest(mocker):
+    options = harness.parse_args([
+        "--rows", "400", "--kind", "address", "--scatter-mode", "range", "--hand-off", "manifest",
+        "--latency-ms", "0", "--ddb-latency-ms", "0", "--passes", "1", "--no-memory"])
+    mocker.patch.object(harness.scatter, "shard_target_bytes", 1024)
+
+    result, = harness.benchmark(400, 0.5, "address", options)
+
+    assert result["shards"] > 10
+    assert result["output_rows"] == 400
@@ -0,0 +1,34 @@
+import os
+import sys
+
+# Each Lambda function is packaged from its own directory, so modules inside
+# a function import their siblings (and the shared layer) by plain name.
+# Mirror that layout here. Only the process function has sibling modules;
+# adding the other function directories would make "app" ambiguous.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ("layers/common", "functions/process"):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+import pytest  # noqa: E402
+
+from tests.benchmark.fakes import FakeDynamoDB, FakeLocation, FakeS3  # noqa: E402
+
+
+# In-memory S3, DynamoDB and Location clients shared by the unit tests and the benchmark
+@pytest.fixture
+def fake_s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def fake_dynamodb():
+    return FakeDynamoDB()
+
+
+@pytest.fixture
+def fake_location():
+    return FakeLocation()
@@ -0,0 +1,45 @@
+from functions.process.cache_policy import DAY, CachePolicy, parse_window
+
+NOON = 1700000000 - 1700000000 % DAY + 12 * 3600
+
+
+def _policy(**kwargs):
+    options = dict(
+        forward_ttl_seconds=7 * DAY, reverse_ttl_seconds=30 * DAY, low_confidence_ttl_seconds=DAY,
+        low_confidence_relevance=0.8, negative_ttl_seconds=3600, refresh_ahead_fraction=0.2,
+        refresh_hot_hits=10, clock=lambda: NOON)
+    options.update(kwargs)
+    return CachePolicy(**options)
+
+
+def test_ttl_depends_on_lookup_type_confidence_and_failure():
+    policy = _policy()
+
+    assert policy.ttl_seconds({"Label": "a"}, reverse=False) == 7 * DAY
+    assert policy.ttl_seconds({"Label": "a", "Relevance": 0.95}, reverse=True) == 30 * DAY
+    assert policy.ttl_seconds({"Label": "a", "Relevance": 0.5}, reverse=True) == DAY
+    assert policy.ttl_seconds({"Error": "NoResult"}, reverse=False) == 3600
+    assert policy.expires_at({"Label": "a"}, reverse=False) == NOON + 7 * DAY
+
+
+def test_only_due_hot_entries_are_refreshed_outside_the_window():
+    policy = _policy()
+    due = {"Label": "a", "ExpiresAt": NOON + DAY}
+    fresh = {"Label": "a", "ExpiresAt": NOON + 6 * DAY}
+
+    assert not policy.should_refresh(fresh, reverse=False, hits=100)
+    assert not policy.should_refresh(due, reverse=False, hits=3)
+    assert policy.should_refresh(dict(due, Hits=8), reverse=False, hits=3)
+    assert not policy.should_refresh({"Error": "NoResult", "ExpiresAt": NOON}, reverse=False, hits=100)
+    assert not policy.should_refresh({"Label": "a"}, reverse=False, hits=100)
+    assert not _policy(refresh_ahead_fraction=0).should_refresh(due, reverse=False, hits=100)
+
+
+def test_refresh_window_wraps_around_midnight():
+    due = {"Label": "a", "ExpiresAt": NOON + DAY}
+
+    assert parse_window("") is None
+    assert parse_window("22-4") == (22, 4)
+    assert _policy(refresh_window="11-13").should_refresh(due, reverse=False)
+    assert not _policy(refresh_window="22-4").should_refresh(due, reverse=False)
+    assert _policy(refresh_window="22-4", clock=lambda: NOON + 13 * 3600).in_refresh_window()
@@ -0,0 +1,48 @@
+import pytest
+
+from functions.process import cache_record
+
+RECORD = {
+    "PrimaryKey": "v1|addr|1 main st|hartford|ct",
+    "Geometry": {"Point": "[-72.6851, 41.7637]"},
+    "Country": "USA", "Zipcode": "06103", "Label": "1 Main St, Hartford, CT, USA",
+    "Municipality": "Hartford", "Region": "Connecticut", "SubRegion": "Hartford County",
+    "Latitude": "41.7637", "Longitude": "-72.6851",
+}
+
+
+def test_round_trip_of_a_place():
+    data = cache_record.encode(dict(RECORD, Relevance=0.87))
+
+    place = cache_record.decode(data)
+
+    assert data[0] == cache_record.VERSION
+    assert place == {
+        "Geometry": {"Point": [-72.6851, 41.7637]}, "Relevance": 0.87,
+        "Country": "USA", "PostalCode": "06103", "Label": "1 Main St, Hartford, CT, USA",
+        "Municipality": "Hartford", "Region": "Connecticut", "SubRegion": "Hartford County",
+    }
+
+
+def test_compressed_record_is_smaller_than_the_string_attributes():
+    data = cache_record.encode(RECORD)
+
+    assert data[1] & cache_record.COMPRESSED
+    assert len(data) < sum(len(str(value)) for value in RECORD.values()) / 2
+
+
+def test_failures_and_missing_points():
+    failure = cache_record.decode(cache_record.encode(
+        {"PrimaryKey": "k", "Error": "NoResult", "QueryPoint": [-72.5, 41.5]}))
+    missing = cache_record.decode(cache_record.encode(dict(RECORD, Geometry={"Point": "0"})))
+
+    assert failure == {"Error": "NoResult", "QueryPoint": [-72.5, 41.5]}
+    assert "Geometry" not in missing
+    assert missing["Label"] == RECORD["Label"]
+
+
+def test_unknown_version_is_rejected():
+    data = cache_record.encode(RECORD)
+
+    with pytest.raises(ValueError):
+        cache_record.decode(bytes([99]) + data[1:])
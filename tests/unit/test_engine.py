@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from functions.process.engine import LatencyTracker, LookupEngine, hedged_call
+
+
+def test_map_preserves_input_order():
+    engine = LookupEngine(8)
+
+    def slow_square(value):
+        # later items finish first
+        time.sleep((10 - value) / 1000)
+        return value * value
+
+    assert engine.map(slow_square, range(10)) == [v * v for v in range(10)]
+
+
+def test_map_bounds_in_flight_work():
+    engine = LookupEngine(3)
+    lock = threading.Lock()
+    state = {"current": 0, "peak": 0}
+
+    def work(value):
+        with lock:
+            state["current"] += 1
+            state["peak"] = max(state["peak"], state["current"])
+        time.sleep(0.005)
+        with lock:
+            state["current"] -= 1
+        return value
+
+    assert engine.map(work, range(20)) == list(range(20))
+    assert state["peak"] <= 3
+
+
+def test_single_worker_runs_inline():
+    engine = LookupEngine(0)
+    assert engine.max_in_flight == 1
+    assert engine.map(str, [1, 2]) == ["1", "2"]
+
+
+def test_adaptive_limit_grows_on_success_and_halves_on_throttling():
+    from functions.process.engine import AdaptiveConcurrencyLimit
+
+    limit = AdaptiveConcurrencyLimit(initial=4, maximum=16)
+    for _ in range(40):
+        limit.release(limit.acquire(), "success")
+    grown = limit.limit
+    assert 8 < grown <= 16
+
+    # two calls from the same round are throttled: only one cut is applied
+    first, second = limit.acquire(), limit.acquire()
+    limit.release(first, "throttled")
+    limit.release(second, "throttled")
+    assert limit.limit == grown / 2
+    assert limit.in_flight == 0
+
+
+def test_adaptive_limit_blocks_beyond_the_limit():
+    from functions.process.engine import AdaptiveConcurrencyLimit
+
+    limit = AdaptiveConcurrencyLimit(initial=1, maximum=1)
+    token = limit.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(limit.acquire()))
+    waiter.start()
+    waiter.join(0.05)
+    assert acquired == []
+    limit.release(token, "error")
+    waiter.join(1)
+    assert len(acquired) == 1
+
+
+def test_latency_tracker_needs_enough_samples():
+    tracker = LatencyTracker(window=100, min_samples=20)
+    for value in range(19):
+        tracker.add(value / 1000)
+
+    assert tracker.percentile(95) is None
+    tracker.add(0.019)
+    assert tracker.percentile(50) == pytest.approx(0.0095)
+    for _ in range(100):
+        tracker.add(1.0)
+    assert tracker.percentile(50) == 1.0
+
+
+def test_hedged_call_returns_the_first_success():
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(4)
+    released = threading.Event()
+
+    def slow_primary():
+        released.wait(5)
+        return "primary"
+
+    def failing():
+        raise RuntimeError("failed")
+
+    def slow_failing():
+        time.sleep(0.05)
+        failing()
+
+    try:
+        assert hedged_call(executor, lambda: "primary", lambda: lambda: "hedge", 1) == ("primary", False)
+        assert hedged_call(executor, slow_primary, lambda: lambda: "hedge", 0.01) == ("hedge", True)
+        # a fast failure is not hedged
+        with pytest.raises(RuntimeError):
+            hedged_call(executor, failing, lambda: lambda: "hedge", 1)
+        # a failed hedge waits for the primary
+        threading.Timer(0.05, released.set).start()
+        assert hedged_call(executor, slow_primary, lambda: failing, 0.01) == ("primary", False)
+        with pytest.raises(RuntimeError):
+            hedged_call(executor, slow_failing, lambda: failing, 0.01)
+        # without a duplicate the primary is awaited
+        assert hedged_call(executor, lambda: time.sleep(0.05) or "primary", lambda: None, 0.01) == ("primary", False)
+    finally:
+        released.set()
+        executor.shutdown()
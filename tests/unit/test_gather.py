@@ -1,4 +1,8 @@
+import io
+
+import s3_multipart
 from functions.gather import app
+from tests.benchmark.fakes import FakeS3
 
 
 def test_detect_language():
@@ -9,3 +13,105 @@ def test_detect_language():
 
     assert "Payload" in data
     assert "Shards" in data['Payload']
+
+
+def shard_csv(header, first, count):
+    return (header + "".join("{0} Main Street,{0}\n".format(i) for i in range(first, first + count))).encode()
+
+
+def gather(mocker, objects, mode="stream"):
+    s3 = FakeS3(objects)
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "process_shards_bucket", "processed")
+    mocker.patch.object(app, "destination_bucket", "destination")
+    mocker.patch.object(app, "gather_mode", mode)
+    mocker.patch.object(app, "MIN_PART_SIZE", 200)
+    mocker.patch.object(s3_multipart, "MIN_PART_SIZE", 200)
+    shards = sorted(key for bucket, key in objects)
+    response = app.lambda_handler({"Payload": [{"shard": key} for key in shards]}, "")
+    output = [value for (bucket, key), value in s3.objects.items() if bucket == "destination"]
+    return response, output[0], s3
+
+
+def test_stream_gather_writes_the_header_once(mocker):
+    header = "Address,Row\n"
+    objects = {
+        ("processed", "in_SHARD_1.csv"): shard_csv(header, 0, 3),
+        ("processed", "in_SHARD_2.csv"): shard_csv(header, 3, 40),
+        ("processed", "in_SHARD_3.csv"): shard_csv(header, 43, 2),
+        ("processed", "in_SHARD_LAST.csv"): shard_csv(header, 45, 1),
+    }
+
+    response, output, s3 = gather(mocker, objects)
+
+    assert output == shard_csv(header, 0, 46)
+    assert [key for key, size in s3.copies] == ["in_SHARD_2.csv"]
+    assert "Processed file uploaded to" in response["Payload"]["status"]
+
+
+def test_stream_gather_falls_back_to_pandas_for_key_partitioned_shards(mocker):
+    objects = {
+        ("processed", "in_SHARD_1.csv"): b"Address,_Row_Order\nb,1\nd,3\n",
+        ("processed", "in_SHARD_LAST.csv"): b"Address,_Row_Order\na,0\nc,2\n",
+    }
+
+    response, output, s3 = gather(mocker, objects)
+
+    assert output == b"Address\na\nb\nc\nd\n"
+    assert s3.copies == []
+
+
+def test_pandas_and_stream_gather_agree(mocker):
+    header = "Address,Row\n"
+    objects = {
+        ("processed", "in_SHARD_{}.csv".format(i)): shard_csv(header, i * 10, 10) for i in range(5)
+    }
+
+    _, streamed, _ = gather(mocker, dict(objects), mode="stream")
+    _, loaded, _ = gather(mocker, dict(objects), mode="pandas")
+
+    assert streamed == loaded
+
+
+def test_parquet_shards_are_gathered_shard_by_shard(mocker):
+    import pandas as pd
+    import shard_format
+
+    header = "Address,Row\n"
+    csv_objects = {
+        ("processed", "in_SHARD_{}.csv".format(i)): shard_csv(header, i * 10, 10) for i in range(3)
+    }
+    parquet_objects = {
+        ("processed", "in_SHARD_{}.parquet".format(i)):
+            shard_format.write_frame(pd.read_csv(io.BytesIO(body)), "parquet")
+        for i, body in enumerate(csv_objects.values())
+    }
+
+    _, from_csv, _ = gather(mocker, dict(csv_objects))
+    response, from_parquet, _ = gather(mocker, dict(parquet_objects))
+    mocker.patch.object(app, "output_format", "parquet")
+    response, parquet_output, _ = gather(mocker, dict(parquet_objects))
+
+    assert from_parquet == from_csv
+    assert "PROCESSED_DATA_in.parquet" in response["Payload"]["status"]
+    assert list(pd.read_parquet(io.BytesIO(parquet_output))["Row"]) == list(range(30))
+
+
+def test_shard_list_is_read_from_the_manifest(mocker):
+    import json
+
+    header = "Address,Row\n"
+    objects = {("processed", "in_SHARD_{}.csv".format(i)): shard_csv(header, i * 10, 10) for i in range(3)}
+    raw_shards = [{"bucket": "raw", "shard": "in_SHARD_{}.csv".format(i)} for i in range(3)]
+    objects[("raw", "manifests/in/shards.jsonl")] = "".join(json.dumps(shard) + "\n" for shard in raw_shards).encode()
+    s3 = FakeS3(objects)
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "process_shards_bucket", "processed")
+    mocker.patch.object(app, "destination_bucket", "destination")
+    mocker.patch.object(app, "gather_mode", "stream")
+
+    response = app.lambda_handler({"Payload": {
+        "Manifest": {"bucket": "raw", "key": "manifests/in/shards.jsonl", "shards": 3}, "Plan": None}}, "")
+
+    assert "PROCESSED_DATA_in.csv" in response["Payload"]["status"]
+    assert s3.objects[("destination", "processed_data/in/PROCESSED_DATA_in.csv")] == shard_csv(header, 0, 30)
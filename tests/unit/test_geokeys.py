@@ -0,0 +1,42 @@
+import geokeys
+
+
+def test_equivalent_addresses_share_a_key():
+    key = geokeys.address_key("123 North Main Street", "Hartford", "Connecticut")
+
+    assert key == "v1|addr|123 n main st|hartford|ct"
+    assert geokeys.address_key("  123 N. Main St ", "HARTFORD", "CT") == key
+    assert geokeys.address_key("123 n main st.", "hartford ", "ct") == key
+
+
+def test_fields_are_delimited():
+    assert geokeys.address_key("1 Main St", "Hartford East", "CT") != geokeys.address_key(
+        "1 Main St Hartford", "East", "CT")
+    assert "|" not in geokeys.normalize_text("a|b")
+
+
+def test_unit_designators_and_missing_values():
+    assert geokeys.normalize_address("10 Elm Avenue, Apartment #4") == "10 elm ave apt # 4"
+    assert geokeys.address_key("10 Elm Ave", float("nan"), None) == "v1|addr|10 elm ave||"
+
+
+def test_address_query_separates_fields():
+    assert geokeys.address_query("1 Main St", "Hartford", "CT") == "1 Main St, Hartford, CT"
+
+
+def test_geohash_matches_reference_values():
+    assert geokeys.geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geokeys.geohash_encode(41.7637, -72.6851, 6) == "drkmd4"
+
+
+def test_nearby_points_share_a_cell_key():
+    key = geokeys.cell_key(-72.68510, 41.76370, 7)
+
+    assert key.startswith("v1|gh7|")
+    assert geokeys.cell_key(-72.68511, 41.76371, 7) == key
+    assert geokeys.cell_key(-72.70000, 41.76370, 7) != key
+
+
+def test_haversine_and_exact_position_key():
+    assert abs(geokeys.haversine_m(-72.0, 41.0, -72.0, 42.0) - 111195) < 10
+    assert geokeys.position_key(-72.5, 41) == "-72.5,41.0"
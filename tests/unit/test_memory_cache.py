@@ -0,0 +1,74 @@
+from functions.process.memory_cache import LocationMemoryCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hit_miss_counters_and_ttl():
+    clock = FakeClock()
+    cache = LocationMemoryCache(10, 1024 * 1024, 30, clock=clock)
+    cache.put("a", {"Label": "A"})
+
+    assert cache.get("a") == {"Label": "A"}
+    assert cache.get("b") is None
+    clock.now = 31
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used_entry():
+    cache = LocationMemoryCache(2, 1024 * 1024, 30)
+    cache.put("a", {"Label": "A"})
+    cache.put("b", {"Label": "B"})
+    cache.get("a")
+    cache.put("c", {"Label": "C"})
+
+    assert cache.get_many(["a", "b", "c"]) == {"a": {"Label": "A"}, "c": {"Label": "C"}}
+    assert cache.evictions == 1
+
+
+def test_respects_memory_limit():
+    cache = LocationMemoryCache(100, 4000, 30)
+    for i in range(20):
+        cache.put("key-{}".format(i), {"Label": "x" * 20})
+
+    assert cache.size_bytes <= 4000
+    assert 0 < len(cache) < 20
+    assert cache.get("key-19") is not None
+
+
+def test_disabled_cache_stores_nothing():
+    cache = LocationMemoryCache(0, 1024, 30)
+    cache.put("a", {"Label": "A"})
+    assert cache.get("a") is None
+
+
+def test_size_estimate_tracks_real_memory():
+    import json
+    import tracemalloc
+
+    def place(i):
+        # decoded from JSON, so no string is shared with the test's literals
+        return json.loads(json.dumps({
+            "Label": "{} Main Street, Hartford, CT 06103, USA".format(i), "Geometry": {"Point": [-72.6, 41.7 + i]},
+            "Country": "USA", "PostalCode": "06103", "Municipality": "Hartford", "Region": "Connecticut",
+            "SubRegion": "Hartford County", "Relevance": 1.0, "QueryPoint": [-72.6, 41.7 + i]}))
+
+    cache = LocationMemoryCache(10000, 1024 * 1024 * 1024, 30)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(2000):
+            cache.put("v1|{}|main st|hartford|ct".format(i), place(i))
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    assert 0.8 * held <= cache.size_bytes <= 1.5 * held
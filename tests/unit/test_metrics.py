@@ -0,0 +1,56 @@
+import json
+
+from metrics import Log, ShardMetrics
+
+
+def test_log_drops_lines_below_the_level(capsys):
+    log = Log("warning")
+    log.debug("per row")
+    log.info("per step")
+    log.warning("throttled")
+    log.error("failed")
+
+    assert capsys.readouterr().out.splitlines() == ["throttled", "failed"]
+    assert Log("nonsense").enabled("INFO") and not Log().enabled("DEBUG")
+
+
+def test_shard_record_is_embedded_metric_format(capsys):
+    now = [1000.0]
+    metrics = ShardMetrics("Test", dimensions={"FunctionName": "process"}, clock=lambda: now[0])
+    metrics.increment("Rows", 10)
+    metrics.increment("Rows", 5)
+    for latency in range(1, 101):
+        metrics.record("LocationLatency", latency)
+    now[0] += 2.5
+
+    record = metrics.emit(Shard="in_SHARD_1.csv")
+
+    assert json.loads(capsys.readouterr().out) == record
+    directive = record["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["FunctionName"]]
+    names = {metric["Name"] for metric in directive["Metrics"]}
+    assert {"Rows", "LocationLatencyP50", "LocationLatencyP95", "LocationLatencyP99", "ShardSeconds"} <= names
+    assert record["Rows"] == 15
+    assert record["LocationLatencyP50"] == 50.5
+    assert record["LocationLatencyCount"] == 100
+    assert record["ShardSeconds"] == 2.5
+    assert record["Shard"] == "in_SHARD_1.csv"
+    assert record["FunctionName"] == "process"
+
+
+def test_reset_starts_a_new_shard():
+    metrics = ShardMetrics("Test")
+    metrics.increment("Rows")
+    metrics.reset()
+
+    assert "Rows" not in metrics.summary()
+
+
+def test_sampled_timings_are_written_on_their_own(capsys):
+    metrics = ShardMetrics("Test", sample_rate=1.0)
+    metrics.record("DynamoDBReadLatency", 7.0)
+
+    record = json.loads(capsys.readouterr().out)
+    assert record["DynamoDBReadLatency"] == 7.0
+    assert record["Sampled"] is True
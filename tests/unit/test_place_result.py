@@ -0,0 +1,44 @@
+import pandas as pd
+
+from place_result import ENRICHMENT_COLUMNS, PlaceResult, enrichment_columns
+
+
+PLACE = {
+    "Label": "1 Main St, Hartford, CT", "Geometry": {"Point": [-72.67, 41.76]}, "Country": "USA",
+    "PostalCode": "06103", "Region": "Connecticut", "SubRegion": "Hartford County",
+}
+
+
+def test_from_place_keeps_only_output_fields():
+    result = PlaceResult.from_place(PLACE)
+
+    assert result.found
+    assert result.point == [-72.67, 41.76]
+    assert result.postal_code == "06103"
+    assert result.municipality is None
+    assert not PlaceResult.from_place({}).found
+    assert not hasattr(result, "__dict__")
+
+
+def test_columns_fan_out_unique_results_to_rows():
+    results = [PlaceResult.from_place(PLACE), PlaceResult.from_place({})]
+
+    columns = enrichment_columns(results, [0, 1, 0])
+
+    assert list(columns) == ENRICHMENT_COLUMNS
+    assert columns["Label"] == ["1 Main St, Hartford, CT", 0, "1 Main St, Hartford, CT"]
+    assert columns["Municipality"] == [0, 0, 0]
+    assert columns["Latitude"] == [41.76, 0, 41.76]
+    assert columns["Points"] == [[-72.67, 41.76], 0, [-72.67, 41.76]]
+
+
+def test_typed_columns_use_missing_values():
+    results = [PlaceResult.from_place(PLACE), PlaceResult.from_place({})]
+
+    data = pd.DataFrame(enrichment_columns(results, [1, 0], typed=True))
+
+    assert data["Zipcode"].dtype == "string"
+    assert pd.isna(data["Zipcode"][0]) and data["Zipcode"][1] == "06103"
+    assert data["Longitude"].dtype == "float64"
+    assert pd.isna(data["Longitude"][0]) and data["Longitude"][1] == -72.67
+    assert data["Points"][0] is None
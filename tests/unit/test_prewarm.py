@@ -0,0 +1,68 @@
+from functions.process import prewarm
+from tests.benchmark.fakes import FakeDynamoDB, FakeLocation, FakeS3
+
+# the warm-up handler imports the process function's module as "app", like in Lambda
+app = prewarm.app
+
+
+def _setup(mocker, csv_text):
+    s3 = FakeS3({("artifacts", "prewarm/customers.csv"): csv_text.encode()})
+    ddb = FakeDynamoDB()
+    location = FakeLocation()
+    mocker.patch.object(prewarm, "s3_client", s3)
+    mocker.patch.object(prewarm, "prewarm_bucket", "artifacts")
+    mocker.patch.object(prewarm, "prewarm_key", "prewarm/customers.csv")
+    mocker.patch.object(prewarm, "prewarm_chunk_rows", 5)
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "ddb_table", "LocationCache")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    return s3, ddb, location
+
+
+def test_warm_up_spends_its_budget_and_resumes_in_the_next_pass(mocker):
+    csv_text = "address,city,state\n" + "".join("{} Main St,Hartford,CT\n".format(i % 9) for i in range(12))
+    s3, ddb, location = _setup(mocker, csv_text)
+    # a known key is not looked up again
+    app.batch_write_locations_to_cache("LocationCache", [app.location_to_cache_record(
+        app.geokeys.address_key("0 Main St", "Hartford", "CT"), {"Label": "seeded"})])
+
+    result = prewarm.lambda_handler({"max_calls": 3}, None)
+
+    assert result["Payload"] == {"key": "prewarm/customers.csv", "status": "budget spent", "chunks": 0, "calls": 3}
+    assert location.calls == ["1 Main St, Hartford, CT", "2 Main St, Hartford, CT", "3 Main St, Hartford, CT"]
+    # the budget is per pass
+    assert prewarm.lambda_handler({"max_calls": 3}, None)["Payload"]["calls"] == 3
+    assert len(location.calls) == 3
+
+    mocker.patch.object(prewarm, "prewarm_interval_hours", 0)
+    context = mocker.Mock()
+    context.get_remaining_time_in_millis.return_value = 1000
+    assert prewarm.lambda_handler({}, context)["Payload"]["status"] == "paused"
+    assert len(location.calls) == 3
+
+    result = prewarm.lambda_handler({}, None)
+
+    assert result["Payload"] == {"key": "prewarm/customers.csv", "status": "complete", "chunks": 3, "calls": 5}
+    assert len(location.calls) == 8
+    assert len(ddb.items) == 9
+    place = app.get_location_from_cache("LocationCache", app.geokeys.address_key("8 Main St", "Hartford", "CT"))
+    assert place["Label"] == "8 Main St, Hartford, CT"
+    assert place["ExpiresAt"] > 0
+
+    # a new pass over a warm cache makes no calls
+    assert prewarm.lambda_handler({}, None)["Payload"]["status"] == "complete"
+    assert len(location.calls) == 8
+
+
+def test_warm_up_of_coordinates_restarts_when_the_file_changes(mocker):
+    s3, ddb, location = _setup(mocker, "latitude,longitude\n41.5,-72.5\n41.6,-72.6\n41.5,-72.5\n")
+
+    assert prewarm.lambda_handler({}, None)["Payload"]["status"] == "complete"
+    assert location.calls == [(-72.5, 41.5), (-72.6, 41.6)]
+    assert app.get_location_from_cache("LocationCache", app.geokeys.position_key(-72.6, 41.6))["QueryPoint"] == [-72.6, 41.6]
+
+    etag = s3.get_object(Bucket="artifacts", Key="prewarm/customers.csv")["ETag"]
+    assert prewarm.load_progress("artifacts", "prewarm/customers.csv", etag, 0)["complete"]
+    progress = prewarm.load_progress("artifacts", "prewarm/customers.csv", '"new etag"', 0)
+    assert progress["chunks"] == 0 and not progress["complete"]
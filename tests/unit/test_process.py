@@ -1,4 +1,7 @@
+import pytest
+
 from functions.process import app
+from tests.benchmark.fakes import FakeDynamoDB, FakeLocation, FakeS3, ThrottlingDynamoDB
 
 
 def test_process():
@@ -15,3 +18,651 @@ def test_process():
 
     assert data["type"] == "sell"
     assert data["price"] == str(stock_price)
+
+
+def _run_shard(mocker, csv_text):
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    ddb = FakeDynamoDB()
+    location = FakeLocation()
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    result = app.lambda_handler({"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}, None)
+    return result, s3, ddb, location
+
+
+def test_forward_geocode_shard(mocker):
+    import io
+    import pandas as pd
+
+    csv_text = "address,city,state\n1 Main St,Hartford,CT\n2 Elm St,Hartford,CT\n1 main street,HARTFORD,CT\n"
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    assert result["Payload"] == {"shard": "in_SHARD_1.csv"}
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert list(output["Address"]) == ["1 Main St", "2 Elm St", "1 main street"]
+    assert list(output["Zipcode"].astype(str)) == ["6103", "6103", "6103"]
+    assert list(output["Label"]) == [
+        "1 Main St, Hartford, CT", "2 Elm St, Hartford, CT", "1 Main St, Hartford, CT"]
+    assert len(ddb.items) == 2
+    assert len(location.calls) == 2
+
+
+def test_reverse_geocode_shard(mocker):
+    import io
+    import pandas as pd
+
+    csv_text = "latitude,longitude,price\n41.5,-72.5,10\n41.6,-72.6,20\n"
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert list(output["Longitude"]) == [-72.5, -72.6]
+    assert list(output["Latitude"]) == [41.5, 41.6]
+    assert list(output["Label"]) == ["41.50000, -72.50000", "41.60000, -72.60000"]
+    assert sorted(location.calls) == [(-72.6, 41.6), (-72.5, 41.5)]
+
+
+def test_batch_cache_round_trip_retries_unprocessed(mocker):
+    ddb = ThrottlingDynamoDB()
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app.time, "sleep")
+    records = [
+        app.location_to_cache_record("key-{}".format(i), {
+            "Label": "label-{}".format(i), "Geometry": {"Point": [-72.0, 41.0 + i]}})
+        for i in range(60)
+    ]
+
+    assert app.batch_write_locations_to_cache("table", records)
+    assert len(ddb.items) == 60
+    assert all(len(batch["table"]) <= 25 for batch in ddb.batch_writes)
+
+    ddb.throttled.clear()
+    found = app.batch_get_locations_from_cache("table", ["key-{}".format(i) for i in range(150)] + ["key-0"])
+    assert len(found) == 60
+    assert found["key-7"]["Label"] == "label-7"
+    assert found["key-7"]["Geometry"]["Point"] == [-72.0, 48.0]
+
+
+def test_unreadable_cache_records_are_treated_as_misses(mocker, fake_dynamodb):
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "shard_metrics", app.ShardMetrics("test"))
+    for key, label in (("good", "kept"), ("corrupt", "lost"), ("future", "lost")):
+        record = app.location_to_cache_record(key, {"Label": label, "Geometry": {"Point": [-72.0, 41.0]}})
+        fake_dynamodb.put_item("table", app.location_to_item(record, 100))
+    fake_dynamodb.items["corrupt"]["Rec"]["B"] = b"\x01"
+    fake_dynamodb.items["future"]["Rec"]["B"] = b"\xff" + bytes(fake_dynamodb.items["future"]["Rec"]["B"])[1:]
+
+    found = app.batch_get_locations_from_cache("table", ["good", "corrupt", "future"])
+
+    assert list(found) == ["good"]
+    assert app.shard_metrics.counters["CacheDecodeErrors"] == 2
+
+
+def test_dedupe_lookups():
+    lookups = [("a", "qa"), ("b", "qb"), ("a", "qa2"), ("c", "qc"), ("b", "qb")]
+
+    unique_lookups, inverse = app.dedupe_lookups(lookups)
+
+    assert unique_lookups == [("a", "qa"), ("b", "qb"), ("c", "qc")]
+    assert inverse == [0, 1, 0, 2, 1]
+
+
+def test_warm_invocation_is_served_from_memory(mocker, fake_dynamodb, fake_location):
+    csv_text = "address,city,state\n1 Main St,Hartford,CT\n"
+    memory_cache = app.LocationMemoryCache(1000, 1024 * 1024, 60)
+    ddb = fake_dynamodb
+    location = fake_location
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "memory_cache", memory_cache)
+    event = {"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}
+
+    app.lambda_handler(event, None)
+    app.lambda_handler(event, None)
+
+    assert len(location.calls) == 1
+    assert len(ddb.batch_gets) == 1
+    assert memory_cache.hits == 1
+
+
+def test_geohash_mode_shares_results_between_nearby_points(mocker):
+    import io
+    import pandas as pd
+
+    mocker.patch.object(app, "reverse_cache_mode", "geohash")
+    mocker.patch.object(app, "geohash_precision", 7)
+    mocker.patch.object(app, "reverse_cache_tolerance_m", 50)
+    # the first two pings are ~1.5 m apart, the third is in another cell
+    csv_text = "latitude,longitude\n41.763700,-72.685100\n41.763710,-72.685110\n41.800000,-72.700000\n"
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert len(output) == 3
+    assert len(location.calls) == 2
+    assert all(key.startswith("v1|gh7|") for key in ddb.items)
+    assert all("QueryPoint" in app.item_to_location(item) for item in ddb.items.values())
+
+
+def test_cell_hit_outside_tolerance_is_a_miss(mocker):
+    mocker.patch.object(app, "reverse_cache_tolerance_m", 5)
+    cell = "v1|gh6|drkmd4"
+    place = {"QueryPoint": [-72.6851, 41.7637], "Geometry": {"Point": [-72.6851, 41.7637]}}
+
+    assert app.cached_place_matches(cell, [-72.68511, 41.76371], place)
+    assert not app.cached_place_matches(cell, [-72.6900, 41.7637], place)
+    assert app.cached_place_matches("-72.69,41.7637", [-72.6900, 41.7637], place)
+
+
+def test_rows_beyond_tolerance_of_cached_cell_place_are_looked_up_by_position(mocker, fake_dynamodb, fake_location):
+    mocker.patch.object(app, "reverse_cache_mode", "geohash")
+    mocker.patch.object(app, "geohash_precision", 6)
+    mocker.patch.object(app, "reverse_cache_tolerance_m", 10)
+    location = fake_location
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    # ~8 m apart in a row: the second point is within the tolerance of the first, not of the cached point
+    cached_point, first, second = [-72.68510, 41.7637], (-72.68500, 41.7637), (-72.68490, 41.7637)
+    cell = app.geokeys.cell_key(*cached_point, 6)
+    assert app.geokeys.cell_key(*first, 6) == app.geokeys.cell_key(*second, 6) == cell
+    app.memory_cache.put(cell, {"Label": "cached", "QueryPoint": cached_point, "Geometry": {"Point": cached_point}})
+
+    lookups = app.position_lookups([first, second])
+    assert [key for key, query in lookups] == [cell, cell]
+    unique_places, inverse = app.resolve_unique_locations(lookups, app.get_location_for_position)
+
+    assert [unique_places[position]["Label"] for position in inverse] == ["cached", "41.76370, -72.68490"]
+    assert location.calls == [second]
+    assert app.memory_cache.get_many([app.geokeys.position_key(*second)])
+
+
+def test_positions_are_answered_from_spatial_index(mocker):
+    import io
+    import pandas as pd
+    from functions.process.spatial_index import SpatialIndex
+
+    index = SpatialIndex.from_places([{
+        "Label": "depot", "Country": "USA", "PostalCode": "06103", "Municipality": "Hartford",
+        "Region": "Connecticut", "SubRegion": "Hartford County", "Geometry": {"Point": [-72.6851, 41.7637]}}])
+    mocker.patch.object(app, "spatial_index_key", "spatial-index/places.npz")
+    mocker.patch.object(app, "_spatial_index", {"index": index})
+    csv_text = "latitude,longitude\n41.76371,-72.68512\n41.9,-72.9\n"
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert list(output["Label"]) == ["depot", "41.90000, -72.90000"]
+    assert location.calls == [(-72.9, 41.9)]
+
+
+def _client_error(code):
+    import botocore.exceptions
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, "SearchPlaceIndexForText")
+
+
+def test_throttling_is_retried_with_jittered_backoff(mocker):
+    sleep = mocker.patch.object(app.time, "sleep")
+    location = mocker.Mock()
+    location.search_place_index_for_text.side_effect = [
+        _client_error("ThrottlingException"), _client_error("TooManyRequestsException"), {"Results": []}]
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "location_concurrency", app.AdaptiveConcurrencyLimit(4, 8))
+
+    assert app.get_location_for_text("index", "1 Main St") == {"Results": []}
+    assert sleep.call_count == 2
+    assert all(0 <= call.args[0] <= app.backoff_cap_ms / 1000 for call in sleep.call_args_list)
+    assert app.location_concurrency.limit < 4
+
+
+def test_validation_errors_fail_fast(mocker):
+    sleep = mocker.patch.object(app.time, "sleep")
+    location = mocker.Mock()
+    location.search_place_index_for_text.side_effect = _client_error("ValidationException")
+    mocker.patch.object(app, "location", location)
+
+    assert app.get_location_for_text("index", "???") == {"Error": app.INVALID_INPUT}
+    assert location.search_place_index_for_text.call_count == 1
+    sleep.assert_not_called()
+
+
+class UnresolvableLocation(FakeLocation):
+    """Finds nothing for "junk", rejects "???" and keeps throttling "busy"."""
+
+    def search_place_index_for_text(self, IndexName, Text):
+        self.calls.append(Text)
+        if Text.startswith("junk"):
+            return {"Results": []}
+        if Text.startswith("???"):
+            raise _client_error("ValidationException")
+        if Text.startswith("busy"):
+            raise _client_error("ThrottlingException")
+        return self._place(Text, -72.67, 41.76)
+
+
+def test_failed_lookups_are_cached_by_error_class(mocker, fake_dynamodb):
+    import io
+    import pandas as pd
+
+    mocker.patch.object(app.time, "sleep")
+    mocker.patch.object(app, "location_concurrency", app.AdaptiveConcurrencyLimit(4, 8))
+    csv_text = "address,city,state\njunk,x,y\n???,x,y\nbusy,x,y\n1 Main St,Hartford,CT\n"
+    location = UnresolvableLocation()
+    mocker.patch.object(app, "location", location)
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    ddb = fake_dynamodb
+    memory_cache = app.LocationMemoryCache(1000, 1024 * 1024, 3600)
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "memory_cache", memory_cache)
+    mocker.patch.object(app, "destination_bucket", "processed")
+    event = {"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}
+
+    app.lambda_handler(event, None)
+
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert list(output["Label"].astype(str)) == ["0", "0", "0", "1 Main St, Hartford, CT"]
+    cached = [app.item_to_location(item) for item in ddb.items.values()]
+    errors = {place["Error"] for place in cached if "Error" in place}
+    # permanent failures go to DynamoDB, a key that gave up after retries does not
+    assert errors == {app.NO_RESULT, app.INVALID_INPUT}
+    assert len(ddb.items) == 3
+    assert all(place["ExpiresAt"] <= app.time.time() + app.cache_policy.negative_ttl_seconds
+               for place in cached if "Error" in place)
+
+    # a fresh container answers the permanent failures from DynamoDB and only retries the throttled key
+    location.calls.clear()
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 3600))
+    app.lambda_handler(event, None)
+    assert all(call.startswith("busy") for call in location.calls)
+
+    # the warm container remembers every failure and makes no call at all
+    location.calls.clear()
+    mocker.patch.object(app, "memory_cache", memory_cache)
+    app.lambda_handler(event, None)
+    assert location.calls == []
+
+
+def test_access_errors_are_not_cached(mocker):
+    location = mocker.Mock()
+    location.search_place_index_for_text.side_effect = _client_error("AccessDeniedException")
+    mocker.patch.object(app, "location", location)
+    memory_cache = app.LocationMemoryCache(1000, 1024 * 1024, 60)
+    mocker.patch.object(app, "memory_cache", memory_cache)
+
+    place = app.lookup_location("1 Main St", app.get_location_for_text)
+
+    assert place == {"Error": app.FAILED}
+    assert not app.remember_location("key", place)
+    assert len(memory_cache) == 0
+
+
+def test_streaming_mode_matches_whole_shard_output(mocker):
+    csv_text = "address,city,state\n" + "".join(
+        "{} Main St,Hartford,CT\n".format(i % 7) for i in range(23))
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+    whole = s3.objects[("processed", "in_SHARD_1.csv")]
+
+    mocker.patch.object(app, "streaming_chunk_rows", 5)
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    assert result["Payload"] == {"shard": "in_SHARD_1.csv"}
+    assert s3.objects[("processed", "in_SHARD_1.csv")] == whole
+
+
+def test_byte_range_shard_is_read_from_the_input_object(mocker, fake_dynamodb, fake_location):
+    import io
+    import pandas as pd
+
+    data = b"address,city,state\n1 Main St,Hartford,CT\n2 Elm St,Hartford,CT\n3 Oak Ave,Hartford,CT\n"
+    start = data.index(b"2 Elm")
+    end = data.index(b"3 Oak") - 1
+    s3 = FakeS3({("input", "in.csv"): data})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "location", fake_location)
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    payload = {"bucket": "input", "shard": "in_SHARD_2.csv", "source": "in.csv",
+               "start": start, "end": end, "header": "address,city,state\n"}
+
+    for chunk_rows in (0, 1):
+        mocker.patch.object(app, "streaming_chunk_rows", chunk_rows)
+        result = app.lambda_handler({"Payload": payload}, None)
+
+        assert result["Payload"] == {"shard": "in_SHARD_2.csv"}
+        output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_2.csv")]))
+        assert list(output["Address"]) == ["2 Elm St"]
+
+
+def test_parquet_shards_keep_enrichment_types(mocker, fake_dynamodb):
+    import io
+    import pandas as pd
+    import shard_format
+
+    class PartialLocation(FakeLocation):
+        def search_place_index_for_text(self, IndexName, Text):
+            if Text.startswith("Nowhere"):
+                return {"Results": []}
+            return super().search_place_index_for_text(IndexName, Text)
+
+    raw = pd.DataFrame({"address": ["1 Main St", "Nowhere"], "city": ["Hartford"] * 2, "state": ["CT"] * 2})
+    s3 = FakeS3({("raw", "in_SHARD_1.parquet"): shard_format.write_frame(raw, "parquet")})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "location", PartialLocation())
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    mocker.patch.object(app, "intermediate_format", "parquet")
+
+    result = app.lambda_handler({"Payload": {"bucket": "raw", "shard": "in_SHARD_1.parquet"}}, None)
+
+    assert result["Payload"] == {"shard": "in_SHARD_1.parquet"}
+    output = pd.read_parquet(io.BytesIO(s3.objects[("processed", "in_SHARD_1.parquet")]))
+    assert output["Zipcode"][0] == "06103"
+    assert pd.isna(output["Zipcode"][1]) and pd.isna(output["Latitude"][1])
+    assert list(output["Points"][0]) == [-72.67, 41.76]
+
+
+def test_shard_metrics_are_emitted_once_per_shard(mocker, capsys, fake_dynamodb, fake_location):
+    import json
+
+    calls = {"count": 0}
+    location = fake_location
+    place = location.search_place_index_for_text
+
+    def throttle_first_call(IndexName, Text):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise _client_error("ThrottlingException")
+        return place(IndexName, Text)
+
+    location.search_place_index_for_text = throttle_first_call
+    mocker.patch.object(app, "backoff_delay", lambda retries: 0)
+    mocker.patch.object(app, "log", app.Log("INFO"))
+    csv_text = "address,city,state\n1 Main St,Hartford,CT\n1 Main St,Hartford,CT\n2 Elm St,Hartford,CT\n"
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+
+    app.lambda_handler({"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}, None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert len(records) == 1
+    record = records[0]
+    assert record["Shard"] == "in_SHARD_1.csv"
+    assert (record["Rows"], record["UniqueKeys"], record["CacheMisses"]) == (3, 2, 2)
+    assert (record["LocationCalls"], record["LocationThrottles"], record["LocationRetries"]) == (3, 1, 1)
+    assert record["LocationLatencyCount"] == 2
+    assert "DynamoDBReadLatencyP99" in record
+
+
+def test_hot_entries_are_refreshed_ahead_of_expiry(mocker, fake_dynamodb, fake_location):
+    import io
+    import pandas as pd
+
+    now = app.time.time()
+    mocker.patch.object(app, "cache_policy", app.CachePolicy(
+        forward_ttl_seconds=1000, reverse_ttl_seconds=1000, low_confidence_ttl_seconds=100,
+        low_confidence_relevance=0.8, negative_ttl_seconds=50, refresh_ahead_fraction=0.2,
+        refresh_hot_hits=3, clock=lambda: now))
+    csv_text = "address,city,state\n" + "1 Main St,Hartford,CT\n" * 2 + "2 Elm St,Hartford,CT\n"
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    ddb = fake_dynamodb
+    for address, hits in (("1 Main St", 5), ("2 Elm St", 0)):
+        record = app.location_to_cache_record(app.geokeys.address_key(address, "Hartford", "CT"), {
+            "Label": "old " + address, "Geometry": {"Point": [-72.0, 41.0]}, "Hits": hits})
+        ddb.put_item("table", app.location_to_item(record, int(now) + 100))
+    location = fake_location
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    mocker.patch.object(app, "track_cache_access", True)
+    mocker.patch.object(app, "cache_access_flush_seconds", 0)
+    mocker.patch.object(app, "_pending_access", app.Counter())
+
+    app.lambda_handler({"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}, None)
+
+    # both entries are in the last fifth of their TTL, only the hot one is re-geocoded
+    assert location.calls == ["1 Main St, Hartford, CT"]
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    assert list(output["Label"]) == ["1 Main St, Hartford, CT"] * 2 + ["old 2 Elm St"]
+    hot = ddb.items[app.geokeys.address_key("1 Main St", "Hartford", "CT")]
+    cold = ddb.items[app.geokeys.address_key("2 Elm St", "Hartford", "CT")]
+    assert int(hot["ttl"]["N"]) == int(now) + 1000
+    # the refresh write carries the hot entry's hits, the cold one gets a counter update
+    assert hot["Hits"]["N"] == "7" and "LastAccess" in hot
+    assert cold["Hits"]["N"] == "1" and cold["ttl"]["N"] == str(int(now) + 100)
+    assert "LastAccess" in cold
+
+
+def test_cache_access_is_counted_for_dynamodb_hits_and_flushed_in_batches(mocker):
+    csv_text = "address,city,state\n" + "".join("{} Main St,Hartford,CT\n".format(i % 4) for i in range(10))
+    mocker.patch.object(app, "track_cache_access", True)
+    mocker.patch.object(app, "cache_access_flush_seconds", 3600)
+    mocker.patch.object(app, "cache_access_max_writes", 2)
+    mocker.patch.object(app, "_pending_access", app.Counter())
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+    updates = mocker.spy(ddb, "update_item")
+
+    # a cold cache, a shard from DynamoDB and a shard from memory: no counter writes before the interval
+    memory_cache = app.LocationMemoryCache(1000, 1024 * 1024, 60)
+    mocker.patch.object(app, "memory_cache", memory_cache)
+    mocker.patch.object(app, "s3_client", s3)
+    for _ in range(2):
+        app.lambda_handler({"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}, None)
+    assert updates.call_count == 0
+    assert sum(app._pending_access.values()) == 10
+
+    assert app.flush_cache_access("table", force=True) == 2
+    hits = sorted(int(item.get("Hits", {"N": "0"})["N"]) for item in ddb.items.values())
+    assert hits == [0, 0, 3, 3]
+    assert not app._pending_access
+
+
+def test_legacy_cache_items_are_still_read(mocker):
+    place = {"Label": "depot", "Country": "USA", "PostalCode": "06103", "Municipality": "Hartford",
+             "Region": "Connecticut", "SubRegion": "Hartford County", "Geometry": {"Point": [-72.6851, 41.7637]},
+             "QueryPoint": [-72.685, 41.764], "Relevance": 0.9}
+    record = app.location_to_cache_record("k", place)
+    compact = app.location_to_item(record, 100)
+    mocker.patch.object(app, "cache_record_format", "legacy")
+    legacy = app.location_to_item(record, 100)
+
+    assert set(compact) == {"id", "Rec", "ttl"}
+    assert "Geometry" in legacy
+    for item in (compact, legacy):
+        cached = app.item_to_location(item)
+        assert cached["Geometry"]["Point"] == [-72.6851, 41.7637]
+        assert cached["QueryPoint"] == [-72.685, 41.764]
+        assert cached["ExpiresAt"] == 100
+        assert app.PlaceResult.from_place(cached).postal_code == "06103"
+
+
+@pytest.mark.parametrize("fmt, engine", [("csv", "pandas"), ("parquet", "pandas"), ("csv", "csv")])
+def test_checkpointed_shard_resumes_after_stopping_early(mocker, fmt, engine, fake_dynamodb, fake_location):
+    import io
+    import pandas as pd
+
+    csv_text = "address,city,state\n" + "".join("{} Main St,Hartford,CT\n".format(i) for i in range(23))
+    mocker.patch.object(app, "intermediate_format", fmt)
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+    key = "in_SHARD_1" + app.shard_format.EXTENSIONS[fmt]
+    whole = app.shard_format.read_frame(io.BytesIO(s3.objects[("processed", key)]), fmt)
+
+    mocker.patch.object(app, "checkpoint_rows", 5)
+    mocker.patch.object(app, "process_engine", engine)
+    mocker.patch.object(app, "checkpoint_safety_seconds", 60)
+    location = fake_location
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): csv_text.encode()})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    event = {"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}
+    context = mocker.Mock()
+    # time for three chunks, then the fourth would not fit
+    context.get_remaining_time_in_millis.side_effect = [900000, 900000, 900000, 30000]
+
+    with pytest.raises(app.ShardCheckpointed):
+        app.lambda_handler(event, context)
+    assert len(location.calls) == 15
+    assert ("processed", key) not in s3.objects
+
+    context.get_remaining_time_in_millis.side_effect = None
+    context.get_remaining_time_in_millis.return_value = 900000
+    result = app.lambda_handler(event, context)
+
+    assert result["Payload"] == {"shard": key}
+    assert len(location.calls) == 23
+    resumed = app.shard_format.read_frame(io.BytesIO(s3.objects[("processed", key)]), fmt)
+    pd.testing.assert_frame_equal(resumed, whole)
+    assert not [name for bucket, name in s3.objects if name.startswith("checkpoints/")]
+
+
+def test_checkpoint_of_a_replaced_input_is_discarded(mocker, fake_dynamodb, fake_location):
+    import io
+
+    old_text = "address,city,state\n" + "".join("{} Main St,Hartford,CT\n".format(i) for i in range(12))
+    new_text = "address,city,state\n" + "".join("{} Elm St,Hartford,CT\n".format(i) for i in range(8))
+    mocker.patch.object(app, "intermediate_format", "csv")
+    mocker.patch.object(app, "destination_bucket", "processed")
+    mocker.patch.object(app, "checkpoint_rows", 5)
+    mocker.patch.object(app, "checkpoint_safety_seconds", 60)
+    s3 = FakeS3({("raw", "in_SHARD_1.csv"): old_text.encode()})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_client", fake_dynamodb)
+    mocker.patch.object(app, "location", fake_location)
+    mocker.patch.object(app, "memory_cache", app.LocationMemoryCache(1000, 1024 * 1024, 60))
+    event = {"Payload": {"bucket": "raw", "shard": "in_SHARD_1.csv"}}
+    context = mocker.Mock()
+    # time for two chunks of the old input, then the third would not fit
+    context.get_remaining_time_in_millis.side_effect = [900000, 900000, 30000]
+    with pytest.raises(app.ShardCheckpointed):
+        app.lambda_handler(event, context)
+
+    s3.objects[("raw", "in_SHARD_1.csv")] = new_text.encode()
+    context.get_remaining_time_in_millis.side_effect = None
+    context.get_remaining_time_in_millis.return_value = 900000
+    result = app.lambda_handler(event, context)
+
+    assert result["Payload"] == {"shard": "in_SHARD_1.csv"}
+    output = app.shard_format.read_frame(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]), "csv")
+    assert list(output["Address"]) == ["{} Elm St".format(i) for i in range(8)]
+    assert not [name for bucket, name in s3.objects if name.startswith("checkpoints/")]
+
+
+@pytest.mark.parametrize("csv_text", [
+    'address,city,state,note\n1 Main St,Hartford,CT,"a, b"\n2 Elm St,Hartford,CT,\n1 main street,HARTFORD,CT,x\nlonely,,,\n',
+    "latitude,longitude,price\n41.5,-72.5,10\n41.6,-72.6,NA\n41.5,-72.5,30\n",
+])
+@pytest.mark.parametrize("chunk_rows", [0, 2])
+def test_csv_engine_matches_pandas_engine(mocker, csv_text, chunk_rows):
+    import io
+    import pandas as pd
+
+    mocker.patch.object(app, "streaming_chunk_rows", chunk_rows)
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+    expected = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+
+    mocker.patch.object(app, "process_engine", "csv")
+    mocker.patch.object(app, "enrich_frame", side_effect=AssertionError("pandas engine used"))
+    result, s3, ddb, location = _run_shard(mocker, csv_text)
+
+    assert result["Payload"] == {"shard": "in_SHARD_1.csv"}
+    output = pd.read_csv(io.BytesIO(s3.objects[("processed", "in_SHARD_1.csv")]))
+    pd.testing.assert_frame_equal(output, expected)
+
+
+def test_slow_location_calls_are_hedged_and_timeouts_retried(mocker):
+    import threading
+    import botocore.exceptions
+
+    released = threading.Event()
+    calls = []
+
+    def search(IndexName, Text):
+        calls.append(Text)
+        if len(calls) == 1:
+            # the first request hangs until the test ends
+            released.wait(5)
+        if len(calls) == 3:
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url="https://places.geo")
+        return {"Results": [{"Place": {"Label": Text}}]}
+
+    location = mocker.Mock()
+    location.search_place_index_for_text.side_effect = search
+    limiter = mocker.Mock()
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "location_rate_limiter", limiter)
+    mocker.patch.object(app, "hedge_percentile", 95)
+    mocker.patch.object(app, "hedge_min_delay_ms", 10)
+    mocker.patch.object(app, "location_latency", app.LatencyTracker(min_samples=1))
+    mocker.patch.object(app, "backoff_base_ms", 1)
+    app.location_latency.add(0.001)
+    app.shard_metrics.reset()
+    try:
+        assert app.get_location_for_text("index", "1 Main St")["Results"][0]["Place"]["Label"] == "1 Main St"
+        # the third request misses its deadline, the hedge delay passes again and the retry answers
+        assert app.get_location_for_text("index", "2 Main St")["Results"][0]["Place"]["Label"] == "2 Main St"
+    finally:
+        released.set()
+
+    counters = app.shard_metrics.counters
+    assert counters["LocationHedges"] == 1 and counters["LocationHedgeWins"] == 1
+    assert counters["LocationTimeouts"] == 1
+    assert counters["LocationCalls"] == 4 == limiter.acquire.call_count
+
+
+def test_hedges_need_a_concurrency_slot_and_only_successes_are_timed(mocker):
+    import threading
+
+    released = threading.Event()
+    calls = []
+
+    def search(IndexName, Text):
+        calls.append(Text)
+        if len(calls) == 1:
+            raise _client_error("ThrottlingException")
+        released.wait(5)
+        return {"Results": [{"Place": {"Label": Text}}]}
+
+    location = mocker.Mock()
+    location.search_place_index_for_text.side_effect = search
+    mocker.patch.object(app, "location", location)
+    mocker.patch.object(app, "location_rate_limiter", mocker.Mock())
+    # one slot, held by the request itself
+    mocker.patch.object(app, "location_concurrency", app.AdaptiveConcurrencyLimit(1, 1))
+    mocker.patch.object(app, "hedge_percentile", 95)
+    mocker.patch.object(app, "hedge_min_delay_ms", 10)
+    mocker.patch.object(app, "location_latency", app.LatencyTracker(min_samples=1))
+    mocker.patch.object(app, "backoff_base_ms", 1)
+    app.location_latency.add(0.001)
+    timed = mocker.spy(app.location_latency, "add")
+    app.shard_metrics.reset()
+    threading.Timer(0.1, released.set).start()
+    try:
+        assert app.get_location_for_text("index", "1 Main St")["Results"][0]["Place"]["Label"] == "1 Main St"
+    finally:
+        released.set()
+
+    assert len(calls) == 2
+    assert "LocationHedges" not in app.shard_metrics.counters
+    # the throttled response is not timed
+    assert timed.call_count == 1
+    assert app.location_concurrency.in_flight == 0
+
+
+def test_csv_engine_writes_missing_cells_empty():
+    import io
+
+    (columns, rows), = app.csv_engine.iter_chunks(io.BytesIO(b"address,note,price\n1 Main St,NA,010.50\n"))
+
+    assert app.csv_engine.encode(columns, rows) == b"Address,Note,Price\n1 Main St,,010.50\n"
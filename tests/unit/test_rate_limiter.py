@@ -0,0 +1,91 @@
+import botocore.exceptions
+
+from functions.process.rate_limiter import DynamoDBTokenBucket, LocalTokenBucket
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_local_bucket_paces_calls_to_the_rate():
+    clock = FakeClock()
+    bucket = LocalTokenBucket(10, clock=clock, sleep=clock.sleep)
+
+    for _ in range(30):
+        bucket.acquire()
+
+    # 10 tokens of burst, then 20 more at 10/s
+    assert 1.9 <= clock.now <= 2.1
+
+
+def test_local_bucket_disabled_at_zero_rate():
+    bucket = LocalTokenBucket(0)
+    assert bucket.acquire() == 0.0
+
+
+class FakeCounterTable:
+    class exceptions:
+        ConditionalCheckFailedException = botocore.exceptions.ClientError
+
+    def __init__(self):
+        self.counters = {}
+
+    def update_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues, **kwargs):
+        key = Key["id"]["S"]
+        used = self.counters.get(key)
+        maximum = int(ExpressionAttributeValues[":max"]["N"])
+        if used is not None and used > maximum:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        self.counters[key] = (used or 0) + int(ExpressionAttributeValues[":lease"]["N"])
+        return {}
+
+
+def test_shared_bucket_never_exceeds_rate_across_invocations():
+    clock = FakeClock(1000.0)
+    table = FakeCounterTable()
+    buckets = [
+        DynamoDBTokenBucket(table, "limits", "location", 20, lease_size=5, clock=clock, sleep=clock.sleep)
+        for _ in range(3)
+    ]
+
+    for i in range(90):
+        buckets[i % 3].acquire()
+
+    assert all(used <= 20 for used in table.counters.values())
+    assert len(table.counters) >= 5
+    assert clock.now >= 1004
+
+
+def test_shared_bucket_leases_from_several_threads_at_once():
+    import threading
+
+    class SlowCounterTable(FakeCounterTable):
+        def __init__(self):
+            super().__init__()
+            self.together = threading.Barrier(2, timeout=5)
+
+        def update_item(self, **kwargs):
+            # both threads must be inside the DynamoDB call at the same time
+            self.together.wait()
+            return super().update_item(**kwargs)
+
+    clock = FakeClock(1000.0)
+    table = SlowCounterTable()
+    bucket = DynamoDBTokenBucket(table, "limits", "location", 20, lease_size=5, clock=clock, sleep=clock.sleep)
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not table.together.broken
+    assert table.counters == {"location#1000": 10}
+    assert bucket._leased == 8
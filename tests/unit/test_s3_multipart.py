@@ -0,0 +1,74 @@
+import pytest
+
+import s3_multipart
+from s3_multipart import MIN_PART_SIZE, MultipartUpload
+
+
+def test_small_object_is_a_single_put(fake_s3):
+    with MultipartUpload(fake_s3, "bucket", "key") as upload:
+        upload.write("a,b\n")
+        upload.write(b"1,2\n")
+
+    assert fake_s3.objects[("bucket", "key")] == b"a,b\n1,2\n"
+    assert fake_s3.uploads == {}
+
+
+def test_large_object_is_streamed_in_parts(fake_s3):
+    chunk = b"x" * (1024 * 1024)
+    with MultipartUpload(fake_s3, "bucket", "key", part_size=MIN_PART_SIZE) as upload:
+        for _ in range(12):
+            upload.write(chunk)
+        response = upload.close()
+
+    assert response["ResponseMetadata"]["HTTPStatusCode"] == 200
+    assert len(upload.parts) == 3
+    assert fake_s3.objects[("bucket", "key")] == chunk * 12
+
+
+def test_failure_aborts_the_upload(fake_s3):
+    with pytest.raises(RuntimeError):
+        with MultipartUpload(fake_s3, "bucket", "key", part_size=MIN_PART_SIZE) as upload:
+            upload.write(b"x" * MIN_PART_SIZE)
+            raise RuntimeError("enrichment failed")
+
+    assert fake_s3.aborted == ["upload-1"]
+    assert ("bucket", "key") not in fake_s3.objects
+
+
+def test_copy_appends_large_ranges_server_side(mocker, fake_s3):
+    mocker.patch.object(s3_multipart, "MIN_PART_SIZE", 100)
+    fake_s3.objects[("source", "big")] = bytes(range(256)) * 2
+    fake_s3.objects[("source", "small")] = b"tail\n"
+    with MultipartUpload(fake_s3, "bucket", "key") as upload:
+        upload.write(b"header\n")
+        upload.copy("source", "big", 12, 512)
+        upload.copy("source", "small", 0, 5)
+
+    expected = b"header\n" + fake_s3.objects[("source", "big")][12:] + b"tail\n"
+    assert fake_s3.objects[("bucket", "key")] == expected
+    # the header is topped up to a full part from the source, the rest is copied
+    assert [size for key, size in fake_s3.reads] == [93, 5]
+    assert [size for key, size in fake_s3.copies] == [407]
+    assert upload.bytes_copied == 407
+    assert upload.bytes_written == len(expected)
+
+
+def test_copy_downloads_ranges_below_the_part_size(mocker, fake_s3):
+    mocker.patch.object(s3_multipart, "MIN_PART_SIZE", 100)
+    fake_s3.objects[("source", "shard")] = b"x" * 50
+    with MultipartUpload(fake_s3, "bucket", "key") as upload:
+        upload.copy("source", "shard", 10, 50)
+
+    assert fake_s3.objects[("bucket", "key")] == b"x" * 40
+    assert fake_s3.copies == []
+
+
+def test_copy_skips_empty_ranges(mocker, fake_s3):
+    mocker.patch.object(s3_multipart, "MIN_PART_SIZE", 100)
+    fake_s3.objects[("source", "empty")] = b""
+    with MultipartUpload(fake_s3, "bucket", "key") as upload:
+        upload.write(b"header\n")
+        upload.copy("source", "empty", 0, 0)
+
+    assert fake_s3.objects[("bucket", "key")] == b"header\n"
+    assert fake_s3.reads == []
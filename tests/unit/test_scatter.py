@@ -1,4 +1,5 @@
 from functions.scatter import app
+from tests.benchmark.fakes import FakeS3
 
 
 def test_scatter():
@@ -9,3 +10,138 @@ def test_scatter():
 
     assert "Payload" in data
     assert "Shards" in data['Payload']
+
+
+def test_split_by_key_keeps_duplicate_keys_together():
+    import pandas as pd
+
+    df = pd.DataFrame({
+        "Address": ["1 Main St", "2 Elm St", "1 Main St", "3 Oak Ave", "2 Elm St"],
+        "City": ["Hartford"] * 5,
+        "State": ["CT"] * 5,
+    })
+
+    shards = app.split_by_key(df, 3, app.lookup_keys(df))
+
+    assert len(shards) == 3
+    assert sum(len(shard) for shard in shards) == 5
+    for shard in shards:
+        for address in set(shard["Address"]):
+            assert (shard["Address"] == address).sum() == (df["Address"] == address).sum()
+    row_order = sorted(order for shard in shards for order in shard[app.ROW_ORDER_COLUMN])
+    assert row_order == [0, 1, 2, 3, 4]
+
+
+def test_scatter_by_byte_range_emits_line_aligned_shards(mocker):
+    rows = "".join("{} Main Street,Hartford,CT\n".format(i) for i in range(500))
+    data = ("address,city,state\n" + rows).encode()
+    s3 = FakeS3({("input", "jobs/in.csv"): data})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "PROBE_BYTES", 64)
+    mocker.patch.object(app, "shard_target_bytes", len(rows) // 4 + 1)
+
+    shards, plan = app.scatter_by_byte_range("input", "jobs/in.csv")
+
+    assert len(shards) == 4
+    assert shards[-1]["shard"] == "jobs/in_SHARD_LAST.csv"
+    assert all(shard["header"] == "address,city,state\n" for shard in shards)
+    pieces = [data[shard["start"]:shard["end"] + 1] for shard in shards]
+    assert b"".join(pieces) == rows.encode()
+    assert all(piece.endswith(b"\n") for piece in pieces)
+    assert sum(size for key, size in s3.reads) < len(data) / 2
+
+
+def test_scatter_by_byte_range_header_only_file(mocker):
+    s3 = FakeS3({("input", "in.csv"): b"latitude,longitude\n"})
+    mocker.patch.object(app, "s3_client", s3)
+
+    shards, plan = app.scatter_by_byte_range("input", "in.csv")
+
+    assert len(shards) == 1
+    assert shards[0]["end"] < shards[0]["start"]
+
+
+def test_plan_small_file_uses_one_shard():
+    plan = app.plan_shards(rows=50, unique_keys=40, miss_ratio=1.0)
+
+    assert plan["shards"] == 1
+    assert plan["expected_location_calls"] == 40
+
+
+def test_plan_keeps_each_shard_within_budget(mocker):
+    mocker.patch.object(app, "shard_time_budget_seconds", 600)
+    mocker.patch.object(app, "location_rate_limit", 45)
+
+    warm = app.plan_shards(rows=2000000, unique_keys=500000, miss_ratio=0.01)
+    cold = app.plan_shards(rows=2000000, unique_keys=500000, miss_ratio=0.5)
+
+    assert 1 < warm["shards"] < cold["shards"]
+    assert warm["estimated_shard_seconds"] <= 600
+    assert cold["estimated_shard_seconds"] <= 600
+    # calls are rate limited: cold shards cannot run all at once within the budget
+    assert cold["shards"] > app.map_max_concurrency
+
+
+def test_sample_miss_ratio_reads_keys_only(mocker):
+    ddb = mocker.Mock()
+    ddb.batch_get_item.return_value = {"Responses": {"cache": [{"id": {"S": "a"}}]}}
+    mocker.patch.object(app, "ddb_client", ddb)
+    mocker.patch.object(app, "ddb_table", "cache")
+
+    assert app.sample_miss_ratio(["a", "b", "a", "c", "d"]) == 0.75
+    request = ddb.batch_get_item.call_args.kwargs["RequestItems"]["cache"]
+    assert request["ProjectionExpression"] == "id"
+    assert len(request["Keys"]) == 4
+
+
+def test_range_scatter_plans_from_a_sample(mocker):
+    rows = "".join("{} Main Street,Hartford,CT\n".format(i % 50) for i in range(5000))
+    s3 = FakeS3({("input", "in.csv"): ("address,city,state\n" + rows).encode()})
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "ddb_table", None)
+    mocker.patch.object(app, "shard_time_budget_seconds", 5)
+
+    shards, plan = app.scatter_by_byte_range("input", "in.csv")
+
+    assert 4500 < plan["rows"] < 5500
+    assert plan["unique_keys"] < plan["rows"] / 10
+    assert len(shards) == plan["shards"] > 1
+
+
+def test_pandas_scatter_writes_parquet_shards(mocker, fake_s3):
+    import io
+    import pandas as pd
+
+    fake_s3.objects[("input", "in.csv")] = b"latitude,longitude\n41.5,-72.5\n41.6,-72.6\n"
+    mocker.patch.object(app, "s3_client", fake_s3)
+    mocker.patch.object(app, "destination_bucket", "raw")
+    mocker.patch.object(app, "scatter_mode", "pandas")
+    mocker.patch.object(app, "intermediate_format", "parquet")
+    mocker.patch.object(app, "sample_miss_ratio", lambda keys: 1.0)
+    event = {"Payload": {"detail": {"bucket": {"name": "input"}, "object": {"key": "in.csv"}}}}
+
+    result = app.lambda_handler(event, None)
+
+    assert [shard["shard"] for shard in result["Payload"]["Shards"]] == ["in_SHARD_LAST.parquet"]
+    shard = pd.read_parquet(io.BytesIO(fake_s3.objects[("raw", "in_SHARD_LAST.parquet")]))
+    assert list(shard["latitude"]) == [41.5, 41.6]
+
+
+def test_large_shard_lists_are_handed_off_through_a_manifest(mocker):
+    import json
+
+    s3 = mocker.Mock()
+    mocker.patch.object(app, "s3_client", s3)
+    mocker.patch.object(app, "manifest_bucket", "raw")
+    shards = [{"bucket": "raw", "shard": "jobs/in_SHARD_{}.csv".format(i)} for i in range(5000)]
+
+    mocker.patch.object(app, "shard_hand_off", "auto")
+    assert app.hand_off(shards[:10], {"shards": 10}, "jobs/in.csv") == {"Shards": shards[:10], "Plan": {"shards": 10}}
+    payload = app.hand_off(shards, {"shards": 5000}, "jobs/in.csv")
+
+    assert payload == {"Manifest": {"bucket": "raw", "key": "manifests/jobs/in/shards.jsonl", "shards": 5000},
+                       "Plan": {"shards": 5000}}
+    body = s3.put_object.call_args.kwargs["Body"]
+    assert [json.loads(line) for line in body.splitlines()] == shards
+    mocker.patch.object(app, "shard_hand_off", "inline")
+    assert "Shards" in app.hand_off(shards, None, "jobs/in.csv")
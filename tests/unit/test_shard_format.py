@@ -0,0 +1,74 @@
+import io
+
+import pandas as pd
+import pytest
+
+import shard_format
+
+
+class Sink:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data.encode() if isinstance(data, str) else data
+
+
+def frame():
+    return pd.DataFrame({
+        "Address": ["1 Main St", "2 Elm St"],
+        "Zipcode": pd.array(["06103", None], dtype="string"),
+        "Points": [[-72.67, 41.76], None],
+        "Latitude": [41.76, float("nan")],
+    })
+
+
+def test_parquet_round_trip_keeps_types():
+    data = shard_format.read_frame(shard_format.write_frame(frame(), "parquet"), "parquet")
+
+    assert list(data["Zipcode"].astype(object)) == ["06103", pd.NA]
+    assert list(data["Points"][0]) == [-72.67, 41.76]
+    assert data["Latitude"].dtype == "float64"
+
+
+def test_parquet_reads_only_the_projected_columns():
+    data = shard_format.read_frame(shard_format.write_frame(frame(), "parquet"), "parquet", columns=["Address"])
+
+    assert list(data.columns) == ["Address"]
+
+
+def test_csv_from_parquet_writes_lists_like_csv_shards():
+    data = shard_format.read_frame(shard_format.write_frame(frame(), "parquet"), "parquet")
+
+    assert shard_format.write_frame(data, "csv") == shard_format.write_frame(frame(), "csv")
+
+
+@pytest.mark.parametrize("fmt", shard_format.FORMATS)
+def test_frame_writer_matches_a_single_write(fmt):
+    sink = Sink()
+    writer = shard_format.FrameWriter(sink, fmt)
+    writer.write(frame().iloc[:1])
+    writer.write(frame().iloc[1:])
+    writer.close()
+
+    chunks = list(shard_format.iter_frames(io.BytesIO(bytes(sink.data)), fmt, 1))
+    whole = shard_format.read_frame(shard_format.write_frame(frame(), fmt), fmt)
+    assert writer.rows == 2
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), whole, check_dtype=False)
+
+
+def test_shard_keys_carry_the_format():
+    assert shard_format.shard_key("jobs/in_SHARD_1.csv", "parquet") == "jobs/in_SHARD_1.parquet"
+    assert shard_format.format_of("jobs/in_SHARD_1.parquet") == "parquet"
+    assert shard_format.format_of("jobs/in_SHARD_1.csv") == "csv"
+    with pytest.raises(ValueError):
+        shard_format.check_format("json")
+
+
+def test_parquet_without_pyarrow_fails_early(mocker):
+    mocker.patch.object(shard_format.importlib.util, "find_spec", return_value=None)
+
+    assert shard_format.check_format("csv") == "csv"
+    with pytest.raises(ImportError):
+        shard_format.check_format("parquet")
@@ -0,0 +1,67 @@
+import io
+
+from functions.process.spatial_index import SpatialIndex
+
+
+def _place(label, longitude, latitude):
+    return {"Label": label, "Country": "USA", "PostalCode": "06103", "Municipality": "Hartford",
+            "Region": "Connecticut", "SubRegion": "Hartford County",
+            "Geometry": {"Point": [longitude, latitude]}}
+
+
+PLACES = [
+    _place("depot", -72.6851, 41.7637),
+    _place("store", -72.6900, 41.7700),
+    _place("far away", -80.1918, 25.7617),
+    _place("antimeridian", 179.9999, 0.0),
+    {"Label": "no point"},
+]
+
+
+def test_nearest_within_radius():
+    index = SpatialIndex.from_places(PLACES)
+
+    place, distance = index.nearest(-72.68512, 41.76371, 25)
+    assert place["Label"] == "depot"
+    assert place["Region"] == "Connecticut"
+    assert distance < 5
+    assert index.nearest(-72.6851, 41.7637 + 0.001, 25) is None
+    assert index.nearest(-179.9999, 0.0, 50)[0]["Label"] == "antimeridian"
+
+
+def test_round_trip_through_file():
+    buffer = io.BytesIO()
+    SpatialIndex.from_places(PLACES).save(buffer)
+    buffer.seek(0)
+
+    index = SpatialIndex.load(buffer)
+
+    assert len(index) == 4
+    assert index.nearest(-80.1918, 25.7617, 10)[0]["Label"] == "far away"
+
+
+def test_export_handler_writes_index(mocker):
+    from functions.process import export_index
+
+    # the export handler imports the process function's module as "app", like in Lambda
+    app = export_index.app
+
+    class FakePaginator:
+        def paginate(self, TableName):
+            item = app.location_to_item(app.location_to_cache_record("k", PLACES[0]), 0)
+            yield {"Items": [item]}
+
+    s3 = mocker.Mock()
+    s3.put_object.return_value = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+    mocker.patch.object(export_index, "s3_client", s3)
+    mocker.patch.object(export_index, "index_bucket", "artifacts")
+    mocker.patch.object(export_index, "index_key", "spatial-index/places.npz")
+    mocker.patch.object(app.ddb_client, "get_paginator", return_value=FakePaginator())
+
+    result = export_index.lambda_handler({}, None)
+
+    assert result["Payload"]["places"] == 1
+    body = s3.put_object.call_args.kwargs["Body"]
+    place, distance = SpatialIndex.load(io.BytesIO(body)).nearest(-72.6851, 41.7637, 5)
+    assert place["Label"] == "depot"
+    assert place["PostalCode"] == "06103"